@@ -1,8 +1,26 @@
 import random
 import pandas as pd
+import numpy as np
 from datetime import datetime
-from openai import OpenAI
+from openai import NOT_GIVEN
 import os,time,json,re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from ZhiBiao.rate_limiter import get_rate_limiter, call_with_rate_limit, estimate_tokens
+from ZhiBiao.response_cache import get_response_cache, make_cache_key
+from ZhiBiao.llm_client import get_openai_client
+from ZhiBiao.request_policy import (DEFAULT_ROW_RETRIES, RequestCancelledError, build_http_timeout, call_with_hedging,
+                                    call_with_row_retries, check_stream_deadlines, get_latency_tracker, resolve_timeouts)
+
+# 快速评分：评测模板只要求输出 "N分"，单项评测默认最多生成的token数；合并评测按评测项数放大
+SCORE_MAX_TOKENS = 16
+# 分数前后不能紧跟数字、小数点、"/" 或范围连接符，也不能是"满分"，避免把 "1-5分"、"1~5分"、"4/5分"、"满分5分" 中的数字当作分数
+SCORE_PATTERN = re.compile(r'(?<![\d./\-~～到至—])(?<!满分)(\d+(?:\.\d+)?)(?![\d./])\s*分')
+# 快速评分只在分数前有 "得分"、"评分"、"分数"、"打分" 等明确标记时提前结束读取；
+# 复述评分标准的 "1分：..." 等没有标记的分数不能确定是最终结果，读完整个回复
+MARKED_SCORE_PATTERN = re.compile(r'(?:得分|评分|分数|打分)(?:结果)?\s*(?:为|是)?\s*[:：]?\s*' + SCORE_PATTERN.pattern)
+# 评测模板中问题（text1）和回答（text2）的占位符
+PLACEHOLDER_PATTERN = re.compile(r'text1|text2')
 
 def extract_and_save_to_excel(file_path, split_by='\n', extraction_type='count', count=None, percentage=None, output_dir=None):
     """
@@ -170,7 +188,187 @@ def extract_and_save_to_excel_folder(folder_path, split_by='\n', extraction_type
 
 
 
-def ai_prompt_query(file_path, output_response_column_name, key, url, model_name, prompt):
+def compile_prompt_template(template):
+    """
+    把评测模板编译为固定前缀和可变后缀：评分标准部分（"问答数据"之前；没有该标记时为第一个占位符所在行之前）
+    作为系统消息，所有请求完全相同，可以命中推理服务（vLLM、SGLang 等）的前缀缓存；
+    其余部分（问答数据和输出要求）作为用户消息模板，每条请求只替换这一小段。
+
+    :param template: 评测模板，使用 text1 / text2 作为问题和回答的占位符
+    :return: (系统消息, 用户消息模板)；模板中没有占位符时系统消息为 None，用户消息模板为整个模板
+    """
+    first_placeholder = PLACEHOLDER_PATTERN.search(template)
+    if first_placeholder is None:
+        return None, template
+    split_index = template.rfind('问答数据', 0, first_placeholder.start())
+    if split_index < 0:
+        split_index = template.rfind('\n', 0, first_placeholder.start()) + 1
+    system_prompt = template[:split_index].strip()
+    return system_prompt or None, template[split_index:].strip()
+
+def render_prompt(user_template, question, answer):
+    """
+    一次扫描替换用户消息模板中的占位符；问题或回答中本身含有 "text1"/"text2" 时不会被再次替换。
+    """
+    values = {'text1': str(question), 'text2': str(answer)}
+    return PLACEHOLDER_PATTERN.sub(lambda match: values[match.group(0)], user_template)
+
+def _build_judge_messages(questions, system_prompt=None):
+    messages = [{"role": "user", "content": str(questions)}]
+    if system_prompt:
+        messages.insert(0, {"role": "system", "content": system_prompt})
+    return messages
+
+def _prompt_query_single(client, model_name, questions, timeouts=None, system_prompt=None):
+    """
+    发送一条已替换好的提示词，返回模型的完整回复。评测不需要首token时间，因此使用非流式请求。
+
+    :param timeouts: resolve_timeouts 返回的超时配置（可选）
+    :param system_prompt: 系统消息（可选），即编译后模板的固定前缀
+    """
+    messages = _build_judge_messages(questions, system_prompt)
+
+    response = client.chat.completions.create(
+        model=model_name,
+        messages=messages,
+        stream=False,
+        timeout=build_http_timeout(timeouts, stream=False) if timeouts else NOT_GIVEN
+    )
+
+    message = response.choices[0].message if response.choices else None
+    # 模型生成的直接文本回复
+    full_response = (message.content if message else None) or ""
+    return full_response
+
+def extract_complete_score(response_text, criterion_names=None):
+    """
+    判断到目前为止的回复是否已包含完整的分数。
+
+    :param response_text: 已收到的回复文本
+    :param criterion_names: 合并评测的评测项名称列表；为 None 时按单项评测判断，只认带明确标记的分数（如 "得分：4分"）
+    :return: 合并评测时为截止到 JSON 结束的回复文本，单项评测时为分数本身（"N分"，与合并评测各项的格式一致）；
+             还没有完整或明确的分数时返回 None
+    """
+    if criterion_names:
+        # 合并评测：JSON 对象闭合且包含全部评测项的分数
+        closing_index = response_text.rfind('}')
+        if closing_index < 0:
+            return None
+        score_text = response_text[:closing_index + 1]
+        return score_text if len(parse_combined_scores(score_text, criterion_names)) == len(criterion_names) else None
+    # 只保留带标记的分数本身：回复在分数前复述的评分标准不写入单元格，analyze_excel 只会取到这一个分数
+    score_match = MARKED_SCORE_PATTERN.search(response_text)
+    return f"{float(score_match.group(1)):g}分" if score_match else None
+
+def _prompt_query_score_stream(client, model_name, questions, timeouts=None, criterion_names=None,
+                               max_tokens=SCORE_MAX_TOKENS, cancel_event=None, system_prompt=None):
+    """
+    快速评分：以流式请求发送评测提示词，边接收边解析分数，解析到明确的分数后立即关闭流，不再读取后续输出。
+    没有明确分数的回复（如只回复 "4分"，或复述了评分标准）读完整个回复后原样返回，与不启用快速评分时一致。
+    请求带 max_tokens 限制输出长度；回复因 max_tokens 截断且没有明确分数时（如推理模型的推理内容占满了额度，
+    或回复复述了评分标准），不限制长度重新请求一次。
+
+    :param timeouts: resolve_timeouts 返回的超时配置（可选）
+    :param criterion_names: 合并评测的评测项名称列表（可选），见 extract_complete_score
+    :param max_tokens: 最多生成的token数，为 None 或 0 时不限制
+    :param cancel_event: threading.Event（可选），被设置时关闭流并抛出 RequestCancelledError
+    :param system_prompt: 系统消息（可选），即编译后模板的固定前缀
+    :return: 解析到的分数（见 extract_complete_score）；流结束仍未解析到明确的分数时返回完整回复
+    """
+    messages = _build_judge_messages(questions, system_prompt)
+    start_time = time.perf_counter()
+    response_stream = client.chat.completions.create(
+        model=model_name,
+        messages=messages,
+        stream=True,
+        max_tokens=max_tokens or NOT_GIVEN,
+        timeout=build_http_timeout(timeouts, stream=True) if timeouts else NOT_GIVEN
+    )
+
+    full_response = ""
+    first_chunk_time = None
+    finish_reason = None
+    # 提前返回或出错时都要关闭流，连接才会归还到共享连接池
+    try:
+        for chunk in response_stream:
+            if cancel_event is not None and cancel_event.is_set():
+                raise RequestCancelledError("对冲请求已由另一次请求完成")
+            if timeouts:
+                check_stream_deadlines(timeouts, start_time, first_chunk_time, time.perf_counter())
+            if not chunk.choices:
+                continue
+            if first_chunk_time is None:
+                first_chunk_time = time.perf_counter()
+            finish_reason = chunk.choices[0].finish_reason or finish_reason
+            content = chunk.choices[0].delta.content
+            if not content:
+                continue
+            full_response += content
+            score_text = extract_complete_score(full_response, criterion_names)
+            if score_text is not None:
+                return score_text
+    finally:
+        response_stream.close()
+
+    if max_tokens and finish_reason == 'length':
+        print(f"评测模型 {model_name} 的回复在 {max_tokens} 个token内没有给出明确的分数，不限制长度重新请求。")
+        return _prompt_query_score_stream(client, model_name, questions, timeouts, criterion_names, None, cancel_event,
+                                          system_prompt)
+    return full_response
+
+def _cached_prompt_query(client, limiter, response_cache, model_name, url, questions, use_cache=True,
+                         timeouts=None, max_row_retries=DEFAULT_ROW_RETRIES, hedge=False,
+                         fast_score=False, criterion_names=None, score_max_tokens=SCORE_MAX_TOKENS, system_prompt=None,
+                         request_log=None):
+    """
+    先查响应缓存，未命中时在限流器控制下请求模型并写回缓存。
+    超时或连接失败时按 max_row_retries 重试；hedge 为 True 时请求耗时超过该端点近期 P95 会再发一次相同请求。
+
+    :param fast_score: 是否使用快速评分（见 _prompt_query_score_stream）；快速评分的回复只保留分数，单独缓存
+    :param criterion_names: 快速评分时合并评测的评测项名称列表（可选）
+    :param score_max_tokens: 快速评分时最多生成的token数
+    :param system_prompt: 系统消息（可选），即编译后模板的固定前缀
+    :param request_log: 列表（可选）；每个实际发出的请求成功后追加 (总耗时秒数, 估算的输出token数)
+    :return: 模型的完整回复
+    """
+    # score_marker 使之前按第一个 "N分" 提前结束的快速评分结果失效（其中可能有把评分标准中的数字误当作分数的回复）
+    sampling_params = {'fast_score': True, 'score_marker': True, 'max_tokens': score_max_tokens} if fast_score else None
+    cache_key = make_cache_key(model_name, url, system_prompt, questions, sampling_params)
+    cached = response_cache.get(cache_key) if use_cache else None
+    if cached is not None:
+        return cached['response']
+    estimated_input_tokens = estimate_tokens(questions) + (estimate_tokens(system_prompt) if system_prompt else 0)
+    latency_tracker = get_latency_tracker(url, model_name)
+
+    def _request(cancel_event):
+        if fast_score:
+            return _prompt_query_score_stream(client, model_name, questions, timeouts, criterion_names,
+                                              score_max_tokens, cancel_event, system_prompt)
+        return _prompt_query_single(client, model_name, questions, timeouts, system_prompt)
+
+    def _attempt(cancel_event):
+        start_time = time.perf_counter()
+        response_text = call_with_rate_limit(
+            limiter,
+            lambda: _request(cancel_event),
+            estimated_tokens=estimated_input_tokens
+        )
+        latency = time.perf_counter() - start_time
+        latency_tracker.record(latency)
+        if request_log is not None:
+            request_log.append((latency, estimate_tokens(response_text)))
+        return response_text
+
+    full_response = call_with_row_retries(
+        lambda: call_with_hedging(_attempt, latency_tracker.percentile(95) if hedge else None, f"评测模型 {model_name} "),
+        max_retries=max_row_retries,
+        label=f"评测模型 {model_name} "
+    )
+    limiter.record_usage(estimated_input_tokens, estimated_input_tokens + estimate_tokens(full_response))
+    response_cache.set(cache_key, full_response, None, model_name, url)
+    return full_response
+
+def ai_prompt_query(file_path, output_response_column_name, key, url, model_name, prompt, rpm=None, tpm=None, use_cache=True, concurrency=1):
     """
     使用OpenAI模型处理提示词转换后的问题，并将结果添加到原来文件中。
 
@@ -180,75 +378,211 @@ def ai_prompt_query(file_path, output_response_column_name, key, url, model_name
     :param url: OpenAI API URL
     :param model_name: 使用的OpenAI模型名称
     :param prompt: 提示词（可选）
+    :param rpm: 该 (url, 模型) 每分钟请求数上限（可选），被限流时会自动降速
+    :param tpm: 该 (url, 模型) 每分钟token数上限（可选）
+    :param use_cache: 是否读取响应缓存；为 False 时跳过缓存直接请求模型，新结果仍会写回缓存
+    :param concurrency: 同时发出的请求数上限
     :return: 修改后的文件路径
     """
+    return ai_prompt_query_batch(file_path, [{'name': output_response_column_name, 'prompt': prompt}], key, url, model_name,
+                                 rpm=rpm, tpm=tpm, use_cache=use_cache, concurrency=concurrency)
+
+def _extract_rubric(prompt_text):
+    """
+    从单项评测模板中取出评分标准部分：去掉开头的评分要求行，截止到"问答数据"之前。
+    """
+    rubric = prompt_text.split('问答数据')[0]
+    rubric_lines = [line for line in rubric.strip().split('\n') if line.strip()]
+    if rubric_lines and '评分' in rubric_lines[0] and rubric_lines[0].rstrip().endswith('：'):
+        rubric_lines = rubric_lines[1:]
+    return '\n'.join(rubric_lines)
+
+def build_combined_prompt(criteria):
+    """
+    把多个评测模板合并成一个提示词，要求模型一次给出所有评测项的分数并以JSON输出。
+
+    :param criteria: 评测项列表，每项为 {'name': 评测项名称, 'prompt': 单项评测模板}
+    :return: 合并后的提示词，仍使用 text1 / text2 作为问题和回答的占位符
+    """
+    rubric_sections = [f"【{criterion['name']}】\n{_extract_rubric(criterion['prompt'])}" for criterion in criteria]
+    example_scores = ', '.join(f'"{criterion["name"]}": 5' for criterion in criteria)
+    return ("请基于以下问答对，分别按照下列每一项的评分标准进行规范性评分（1-5分）：\n\n"
+            + '\n\n'.join(rubric_sections)
+            + "\n\n问答数据：\n\n问：text1\n答：text2\n\n"
+            + "评分示例：只输出一个JSON对象，键为评测项名称，值为整数分数，如{" + example_scores + "}，无需其他文字说明。")
+
+def parse_combined_scores(response_text, criterion_names):
+    """
+    从合并评测的回复中解析各评测项的分数。
+
+    :param response_text: 模型回复
+    :param criterion_names: 评测项名称列表
+    :return: dict，评测项名称 -> "N分"（与单项评测的输出格式一致）；未能解析的评测项不出现在结果中
+    """
+    scores = {}
+    if not response_text:
+        return scores
+    json_match = re.search(r'\{.*\}', str(response_text), re.S)
+    if json_match:
+        try:
+            parsed = json.loads(json_match.group(0))
+        except json.JSONDecodeError:
+            parsed = {}
+        if isinstance(parsed, dict):
+            for name in criterion_names:
+                numbers = extract_numbers(str(parsed.get(name, '')))
+                if numbers:
+                    scores[name] = f"{numbers[0]:g}分"
+    # JSON 不完整时，按 "名称: 分数" 的形式逐项再找一遍
+    for name in criterion_names:
+        if name not in scores:
+            score_match = re.search(re.escape(name) + r'["”】\s]*[:：]?\s*(\d+(?:\.\d+)?)', str(response_text))
+            if score_match:
+                scores[name] = f"{float(score_match.group(1)):g}分"
+    return scores
+
+def ai_prompt_query_batch(file_path, criteria, key, url, model_name, rpm=None, tpm=None, use_cache=True,
+                          concurrency=4, combined=False, progress_callback=None,
+                          timeouts=None, max_row_retries=DEFAULT_ROW_RETRIES, hedge=False,
+                          fast_score=False, score_max_tokens=SCORE_MAX_TOKENS, run_stats=None):
+    """
+    在内存中完成多个评测模板的评测：Excel 只读取一次，所有 (行, 模板) 组合交给同一个有界线程池并发请求，
+    全部完成后只写一次文件。每个模板的结果写入以模板名称命名的列。
 
-    # 读取 Excel 文件
+    :param file_path: 文件路径（第一列为问题，第二列为回答），结果写回该文件
+    :param criteria: 评测项列表，每项为 {'name': 评测项名称（即输出列名）, 'prompt': 单项评测模板}
+    :param key: OpenAI API密钥
+    :param url: OpenAI API URL
+    :param model_name: 使用的OpenAI模型名称
+    :param rpm: 该 (url, 模型) 每分钟请求数上限（可选）
+    :param tpm: 该 (url, 模型) 每分钟token数上限（可选）
+    :param use_cache: 是否读取响应缓存
+    :param concurrency: 线程池大小，即同时发出的请求数上限
+    :param combined: 合并评测模式：每行只请求一次，同时给出所有评测项的分数（见 build_combined_prompt），
+                     回复中缺少的评测项对该行改用单项模板单独请求
+    :param progress_callback: 可选的回调 progress_callback(已完成的(行, 模板)数, 总数)
+    :param timeouts: 超时配置 {'connect', 'first_token', 'total'}（秒），未配置的项使用默认值
+    :param max_row_retries: 单个请求超时或连接失败后的重试次数；重试后仍失败的单元格为 None，不影响其他行
+    :param hedge: 是否启用对冲请求
+    :param fast_score: 快速评分：流式接收并在解析到明确的分数（如 "得分：4分"）后立即停止读取，同时用 max_tokens 限制输出长度；
+                       单元格中只保存解析到的分数，没有明确分数时保存完整回复
+    :param score_max_tokens: 快速评分时单项评测最多生成的token数，合并评测按评测项数相应放大
+    :param run_stats: 可选的字典，函数会写入实际发出的请求数 'requests'、单个请求总耗时的中位数 'latency_p50'
+                      和输出token数的中位数 'output_tokens_p50'（未命中缓存的请求才计入）
+    :return: 修改后的文件路径，失败时返回 None
+    """
     try:
         df = pd.read_excel(file_path)
         print("ai提示词处理模块启动，文件读取成功！")
     except Exception as e:
         print(f"ai提示词处理模块启动，读取 Excel 文件时出错：{e}")
-        exit()
+        return None
 
-    # 获取第二列和第三列的内容（索引为 0 和 1）
-    if len(df.columns) >= 2:  # 确保有足够的列
-        column_bs = df.iloc[:, 0]  # 第一列
-        column_cs = df.iloc[:, 1]  # 第二列
-    else:
-        print("Excel 文件中列数不足，请确保至少有三列。")
+    if len(df.columns) < 2:
+        print("Excel 文件中列数不足，请确保至少有两列。")
         return None
-    
+    column_bs = df.iloc[:, 0].tolist()
+    column_cs = df.iloc[:, 1].tolist()
+
+    # 同名评测项只保留第一个
+    unique_criteria = {}
+    for criterion in criteria:
+        unique_criteria.setdefault(criterion['name'], criterion)
+    criteria = list(unique_criteria.values())
+    criterion_names = [criterion['name'] for criterion in criteria]
+    combined = combined and len(criteria) > 1
+
     try:
-        client = OpenAI(api_key=key, base_url=url)
-        responses_list = []
-
-        for index, column_b in enumerate(column_bs):
-
-            questions = prompt.replace("text1", str(column_b)).replace("text2", str(column_cs[index]))
-            print(questions)
-            start_time = time.time()
-
-            messages = [{"role": "user", "content": str(questions)}]
-
-            response_stream = client.chat.completions.create(
-                model=model_name,
-                messages=messages,
-                stream=True
-            )
-
-            full_response = ""
-            full_response_reasoning = ""
-            for chunk in response_stream:
-                if not chunk.choices:
-                    continue
-                # 模型生成的直接文本回复
-                content = chunk.choices[0].delta.content
-                # 模型生成内容背后的推理过程
-                reasoning_content = chunk.choices[0].delta.reasoning_content
-                
-                if content:
-                    full_response += content
-                    full_response_reasoning += content
-                    # print(content, end="", flush=True) # Optional: for live printing
-                if reasoning_content:
-                    # 模型生成的推理过程，后续添加到日志中。
-                    full_response_reasoning += reasoning_content
-                    # print(reasoning_content, end="", flush=True) # Optional: for live printing
-            # print() # Optional: for live printing
-
-            responses_list.append(full_response)
-            print('-'*10)
-        df[output_response_column_name] = pd.Series(responses_list, index=df.head(len(questions)).index)
-        df.to_excel(file_path, index=False)
+        client = get_openai_client(url, key, max_connections=concurrency)
+        limiter = get_rate_limiter(url, model_name, rpm=rpm, tpm=tpm)
+        response_cache = get_response_cache()
+        # 模板只编译一次：评分标准作为固定的系统消息，每行只替换用户消息中的问答部分
+        compiled_prompts = {criterion['name']: compile_prompt_template(criterion['prompt']) for criterion in criteria}
+        compiled_combined_prompt = compile_prompt_template(build_combined_prompt(criteria)) if combined else None
+        results = {name: [None] * len(column_bs) for name in criterion_names}
+        total_pairs = len(column_bs) * len(criteria)
+        resolved_timeouts = resolve_timeouts(timeouts)
+        progress = {'done': 0, 'fallback': 0, 'failed': 0}
+        progress_lock = threading.Lock()
+        request_log = []
+        start_time = time.time()
+
+        def _query(compiled_prompt, row_index, names=None):
+            system_prompt, user_template = compiled_prompt
+            questions = render_prompt(user_template, column_bs[row_index], column_cs[row_index])
+            max_tokens = score_max_tokens * (len(names) + 1) if names and score_max_tokens else score_max_tokens
+            return _cached_prompt_query(client, limiter, response_cache, model_name, url, questions, use_cache,
+                                        resolved_timeouts, max_row_retries, hedge,
+                                        fast_score, names, max_tokens, system_prompt, request_log)
+
+        def _report(pairs_done, fallback_count=0, failed_count=0):
+            with progress_lock:
+                progress['done'] += pairs_done
+                progress['fallback'] += fallback_count
+                progress['failed'] += failed_count
+                done = progress['done']
+            if progress_callback:
+                progress_callback(done, total_pairs)
+
+        def _query_pair(row_index, criterion):
+            # 单个请求最终失败只影响该单元格（保持为 None）
+            try:
+                results[criterion['name']][row_index] = _query(compiled_prompts[criterion['name']], row_index)
+            except Exception as e:
+                print(f"第{row_index + 1}行评测项 {criterion['name']} 请求失败: {e}")
+                _report(1, failed_count=1)
+                return
+            _report(1)
 
+        def _query_combined_row(row_index):
+            try:
+                row_scores = parse_combined_scores(_query(compiled_combined_prompt, row_index, criterion_names),
+                                                   criterion_names)
+            except Exception as e:
+                print(f"第{row_index + 1}行合并评测请求失败，改为逐项请求: {e}")
+                row_scores = {}
+            fallback_count = 0
+            failed_count = 0
+            for criterion in criteria:
+                if criterion['name'] not in row_scores:
+                    # 合并回复中没有该项分数，退回单项模板
+                    fallback_count += 1
+                    try:
+                        row_scores[criterion['name']] = _query(compiled_prompts[criterion['name']], row_index)
+                    except Exception as e:
+                        print(f"第{row_index + 1}行评测项 {criterion['name']} 请求失败: {e}")
+                        failed_count += 1
+                        continue
+                results[criterion['name']][row_index] = row_scores[criterion['name']]
+            _report(len(criteria), fallback_count, failed_count)
+
+        with ThreadPoolExecutor(max_workers=max(1, concurrency or 1)) as executor:
+            if combined:
+                futures = [executor.submit(_query_combined_row, row_index) for row_index in range(len(column_bs))]
+            else:
+                futures = [executor.submit(_query_pair, row_index, criterion)
+                           for criterion in criteria for row_index in range(len(column_bs))]
+            for future in as_completed(futures):
+                future.result()
+
+        for name in criterion_names:
+            df[name] = results[name]
+        df.to_excel(file_path, index=False)
+        mode_text = f"合并评测，退回单项请求{progress['fallback']}次" if combined else "逐项评测"
+        if fast_score:
+            mode_text += "，快速评分"
+        print(f"评测完成（{mode_text}），共{len(column_bs)}条，{len(criterion_names)}个评测项，失败{progress['failed']}个。")
+        print(f"响应缓存统计: {response_cache.stats()}")
         print(f'总耗时：{time.time() - start_time}')
-        
+        if run_stats is not None:
+            run_stats['requests'] = len(request_log)
+            run_stats['latency_p50'] = float(np.median([latency for latency, _ in request_log])) if request_log else None
+            run_stats['output_tokens_p50'] = float(np.median([tokens for _, tokens in request_log])) if request_log else None
         return file_path
     except Exception as e:
-        print(f"发生错误 (ai_prompt_query): {e}")
+        print(f"发生错误 (ai_prompt_query_batch): {e}")
         return None
-    
+
 # 加载提示词
 def load_prompts(file_path):
     # 读取 JSON 文件
@@ -1,14 +1,30 @@
 import pandas as pd
-import os, time, uuid
+import os, time, uuid, json
 from datetime import datetime
-from openai import OpenAI
+from openai import NOT_GIVEN
 from sentence_transformers import SentenceTransformer
 import numpy as np
-from rouge import Rouge
-import jieba
 from modelscope.hub.snapshot_download import snapshot_download
 import shutil # Added for robustly moving files if necessary
-from collections import defaultdict # Added for CILIN F1 calculation
+import threading
+import hashlib
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from ZhiBiao.rate_limiter import get_rate_limiter, call_with_rate_limit, estimate_tokens
+from ZhiBiao.response_cache import get_response_cache, make_cache_key
+from ZhiBiao.checkpoint import RowCheckpoint, make_checkpoint_path
+from ZhiBiao.request_policy import (DEFAULT_ROW_RETRIES, RequestCancelledError, build_http_timeout, call_with_hedging,
+                                    call_with_row_retries, check_stream_deadlines, get_latency_tracker, resolve_timeouts)
+from ZhiBiao.llm_client import get_openai_client
+from ZhiBiao.endpoint_pool import call_with_replicas, endpoint_pool_key, get_endpoint_pool
+from ZhiBiao.embedding_models import get_embedding_model_cache
+from ZhiBiao.embedding_cache import embedding_text_hash, get_embedding_store
+from ZhiBiao.rouge_engine import ROUGE_VARIANTS, rouge_scores
+from ZhiBiao.tokenization import TokenCache
+from ZhiBiao.cilin_index import DEFAULT_CILIN_PATH, get_cilin_index
+
+# ASS 评估时每批编码的文本条数
+DEFAULT_EMBEDDING_BATCH_SIZE = 64
 
 def extract_column_to_new_excel(input_excel_path, column_letter, output_dir):
     """
@@ -55,7 +71,246 @@ def extract_column_to_new_excel(input_excel_path, column_letter, output_dir):
 
 
 
-def query_ai_model_with_excel(df_input, question_column_name, output_response_column_name, output_first_token_column_name, key, url, model_name, get_first_token, prompt=None):
+def question_dedupe_key(question_text):
+    """
+    问题去重用的键：Unicode NFKC 规范化（统一全角/半角），去掉首尾空白并把连续空白压缩为一个空格后取 sha1。
+    """
+    normalized = ' '.join(unicodedata.normalize('NFKC', str(question_text)).split())
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+# 每个模型端点(base_url)共享的并发上限，跨行、跨任务生效
+_ENDPOINT_SEMAPHORES = {}
+_ENDPOINT_SEMAPHORES_LOCK = threading.Lock()
+
+def get_endpoint_semaphore(url, concurrency):
+    """
+    获取指定模型端点的并发信号量。同一个端点上的所有请求（包括不同任务、不同模型列）共用同一个上限。
+    每个端点在进程内只有一个信号量；请求的上限更大时在原信号量上扩容（取各任务上限的最大值），
+    上限更小时不缩减，在途请求始终释放到同一个信号量上。
+
+    :param url: 模型API URL
+    :param concurrency: 该端点允许的最大并发请求数
+    :return: threading.Semaphore
+    """
+    concurrency = max(1, int(concurrency))
+    with _ENDPOINT_SEMAPHORES_LOCK:
+        entry = _ENDPOINT_SEMAPHORES.get(url)
+        if entry is None:
+            entry = [concurrency, threading.Semaphore(concurrency)]
+            _ENDPOINT_SEMAPHORES[url] = entry
+        elif concurrency > entry[0]:
+            # 多释放的次数即新增的并发名额
+            for _ in range(concurrency - entry[0]):
+                entry[1].release()
+            entry[0] = concurrency
+        return entry[1]
+
+# 延迟画像字段 -> 列名后缀（列名为 "<模型列前缀>_<后缀>"，如 External_Model_Total_Latency）
+LATENCY_PROFILE_COLUMNS = [
+    ('total_latency', 'Total_Latency'),
+    ('itl_mean', 'ITL_Mean'),
+    ('itl_p95', 'ITL_P95'),
+    ('output_chunks', 'Output_Chunks'),
+    ('output_tokens', 'Output_Tokens'),
+    ('tokens_per_second', 'Tokens_Per_Second'),
+    ('reasoning_tokens', 'Reasoning_Tokens'),
+    ('reasoning_time', 'Reasoning_Time'),
+]
+
+def _percentile(values, q):
+    """计算百分位数（线性插值），values 为空时返回 None。"""
+    if not values:
+        return None
+    return float(np.percentile(values, q))
+
+def _build_latency_profile(start_time, first_token_time, chunk_times, end_time, usage_tokens=None,
+                           reasoning_tokens=None, reasoning_time=None):
+    """
+    根据单次流式请求中各输出块的到达时间（单调时钟）生成延迟画像。
+
+    :param start_time: 请求发出时刻
+    :param first_token_time: 首个正文token到达时刻，没有正文时为 None
+    :param chunk_times: 每个输出块（正文或推理内容）的到达时刻列表
+    :param end_time: 流结束时刻
+    :param usage_tokens: 服务端在流中返回的输出token数（usage.completion_tokens），没有时按输出块数计
+    :param reasoning_tokens: 推理（思考）部分的token数，没有推理内容时为 None
+    :param reasoning_time: 从请求发出到最后一个推理块到达的秒数，没有推理内容时为 None
+    :return: dict，包含首token时间、总延迟、token间隔均值/P95、输出块数、输出token数、每秒输出token数、
+             推理token数和推理耗时
+    """
+    inter_token_gaps = [later - earlier for earlier, later in zip(chunk_times, chunk_times[1:])]
+    output_tokens = usage_tokens if usage_tokens else len(chunk_times)
+    # 每秒输出token数按解码阶段计算：从第一个输出块到流结束
+    decode_time = end_time - chunk_times[0] if chunk_times else 0.0
+    if decode_time > 0:
+        tokens_per_second = output_tokens / decode_time
+    elif end_time > start_time:
+        tokens_per_second = output_tokens / (end_time - start_time)
+    else:
+        tokens_per_second = None
+    return {
+        'first_token': first_token_time - start_time if first_token_time is not None else None,
+        'total_latency': end_time - start_time,
+        'itl_mean': sum(inter_token_gaps) / len(inter_token_gaps) if inter_token_gaps else None,
+        'itl_p95': _percentile(inter_token_gaps, 95),
+        'output_chunks': len(chunk_times),
+        'output_tokens': output_tokens,
+        'tokens_per_second': tokens_per_second,
+        'reasoning_tokens': reasoning_tokens,
+        'reasoning_time': reasoning_time,
+    }
+
+def build_reasoning_extra_body(disable_thinking=False, thinking_budget=None):
+    """
+    生成控制推理（思考）过程的请求扩展参数（extra_body）。
+    关闭思考时同时给出 SiliconFlow 等服务使用的顶层 enable_thinking 和 vLLM 部署的 Qwen3 等模型使用的
+    chat_template_kwargs.enable_thinking；限制推理长度使用 thinking_budget（推理最多生成的token数）。
+
+    :param disable_thinking: 是否关闭思考
+    :param thinking_budget: 推理token上限（可选），关闭思考时忽略
+    :return: dict，不做任何控制时返回 None
+    """
+    if disable_thinking:
+        return {'enable_thinking': False, 'chat_template_kwargs': {'enable_thinking': False}}
+    if thinking_budget:
+        return {'thinking_budget': int(thinking_budget)}
+    return None
+
+def _usage_reasoning_tokens(usage):
+    """从 usage.completion_tokens_details.reasoning_tokens 中取推理token数，服务端没有返回时为 None。"""
+    details = getattr(usage, 'completion_tokens_details', None) if usage is not None else None
+    return getattr(details, 'reasoning_tokens', None) if details is not None else None
+
+def _query_single_question(client, model_name, question_text, prompt=None, stream=True, timeouts=None, cancel_event=None,
+                           extra_body=None, reasoning_parts=None):
+    """
+    对单个问题发起一次对话请求。流式请求使用单调时钟记录每个输出块的到达时间；
+    不需要首token时间时可用非流式请求，省去逐块解析的开销，此时延迟画像只有总延迟和输出token数。
+
+    :param stream: 是否使用流式请求
+    :param timeouts: resolve_timeouts 返回的超时配置（可选）；流式读取中超过首token或总期限时抛出 RequestTimeoutError
+    :param cancel_event: threading.Event（可选）；对冲请求中另一次请求先完成时被设置，本次请求关闭流并抛出 RequestCancelledError
+    :param extra_body: 请求的扩展参数（可选），如 build_reasoning_extra_body 的返回值
+    :param reasoning_parts: 列表（可选）；传入时推理内容按到达顺序追加到其中，否则推理内容只计数不保留
+    :return: (完整响应文本, 延迟画像字典)，延迟画像见 _build_latency_profile
+    """
+    start_time = time.perf_counter()
+    first_token_time = None
+    chunk_times = []
+    usage_tokens = None
+    reasoning_tokens = None
+
+    messages = [{"role": "user", "content": str(question_text)}]
+    if prompt:
+        messages.insert(0, {"role": "system", "content": prompt})
+
+    request_timeout = build_http_timeout(timeouts, stream) if timeouts else NOT_GIVEN
+
+    if not stream:
+        response = client.chat.completions.create(
+            model=model_name,
+            messages=messages,
+            stream=False,
+            timeout=request_timeout,
+            extra_body=extra_body
+        )
+        end_time = time.perf_counter()
+        message = response.choices[0].message if response.choices else None
+        # 模型生成的直接文本回复
+        full_response = (message.content if message else None) or ""
+        # 模型生成内容背后的推理过程（标准 OpenAI 接口的 message 中没有该字段）
+        reasoning_content = getattr(message, 'reasoning_content', None) if message else None
+        if response.usage is not None and response.usage.completion_tokens:
+            usage_tokens = response.usage.completion_tokens
+        reasoning_tokens = _usage_reasoning_tokens(response.usage)
+        if reasoning_content:
+            # 服务端没有返回推理token数时按文本估算
+            reasoning_tokens = reasoning_tokens or estimate_tokens(reasoning_content)
+            if reasoning_parts is not None:
+                reasoning_parts.append(reasoning_content)
+        # 非流式请求无法区分推理和正文的耗时，推理耗时留空
+        latency_profile = _build_latency_profile(start_time, None, [end_time], end_time, usage_tokens, reasoning_tokens)
+        return full_response, latency_profile
+
+    response_stream = client.chat.completions.create(
+        model=model_name,
+        messages=messages,
+        stream=True,
+        timeout=request_timeout,
+        extra_body=extra_body
+    )
+
+    # 正文按块收集，结束时一次拼接
+    response_parts = []
+    reasoning_chunks = 0
+    last_reasoning_time = None
+    # 读取过程中出错时也要关闭流，否则连接不会归还到共享连接池
+    try:
+        for chunk in response_stream:
+            if cancel_event is not None and cancel_event.is_set():
+                raise RequestCancelledError("对冲请求已由另一次请求完成")
+            if timeouts:
+                check_stream_deadlines(timeouts, start_time, chunk_times[0] if chunk_times else None, time.perf_counter())
+            # 部分服务端会在最后一个块中附带 usage
+            chunk_usage = getattr(chunk, 'usage', None)
+            if chunk_usage is not None and getattr(chunk_usage, 'completion_tokens', None):
+                usage_tokens = chunk_usage.completion_tokens
+                reasoning_tokens = _usage_reasoning_tokens(chunk_usage)
+            if not chunk.choices:
+                continue
+            # 模型生成的直接文本回复
+            content = chunk.choices[0].delta.content
+            # 模型生成内容背后的推理过程（标准 OpenAI 接口的 delta 中没有该字段）
+            reasoning_content = getattr(chunk.choices[0].delta, 'reasoning_content', None)
+
+            if content or reasoning_content:
+                chunk_times.append(time.perf_counter())
+            if content:
+                if first_token_time is None:
+                    first_token_time = chunk_times[-1]
+                response_parts.append(content)
+                # print(content, end="", flush=True) # Optional: for live printing
+            if reasoning_content:
+                # 模型生成的推理过程：只在需要写入推理日志时保留文本
+                reasoning_chunks += 1
+                last_reasoning_time = chunk_times[-1]
+                if reasoning_parts is not None:
+                    reasoning_parts.append(reasoning_content)
+                # print(reasoning_content, end="", flush=True) # Optional: for live printing
+        # print() # Optional: for live printing
+    finally:
+        response_stream.close()
+
+    # 服务端没有返回推理token数时按推理块数计
+    if reasoning_chunks and not reasoning_tokens:
+        reasoning_tokens = reasoning_chunks
+    reasoning_time = last_reasoning_time - start_time if last_reasoning_time is not None else None
+    latency_profile = _build_latency_profile(start_time, first_token_time, chunk_times, time.perf_counter(), usage_tokens,
+                                             reasoning_tokens, reasoning_time)
+    return ''.join(response_parts), latency_profile
+
+def summarize_latency_profiles(latency_profiles):
+    """
+    汇总一个模型所有请求的延迟画像，给出各指标的 P50/P90/P99。命中响应缓存的行（from_cache）不计入。
+
+    :param latency_profiles: 延迟画像字典列表
+    :return: dict，指标名 -> {'p50', 'p90', 'p99'}，另含实际请求数 requests 和缓存命中数 cache_hits
+    """
+    live_profiles = [profile for profile in latency_profiles if not (profile and profile.get('from_cache'))]
+    summary = {'requests': len(live_profiles), 'cache_hits': len(latency_profiles) - len(live_profiles)}
+    for field in ('first_token', 'total_latency', 'itl_mean', 'itl_p95', 'output_tokens', 'tokens_per_second',
+                  'reasoning_tokens', 'reasoning_time'):
+        values = [profile[field] for profile in live_profiles if profile and profile.get(field) is not None]
+        summary[field] = {
+            'p50': _percentile(values, 50),
+            'p90': _percentile(values, 90),
+            'p99': _percentile(values, 99),
+        }
+    return summary
+
+def query_ai_model_with_excel(df_input, question_column_name, output_response_column_name, output_first_token_column_name, key, url, model_name, get_first_token, prompt=None, concurrency=1, rpm=None, tpm=None, use_cache=True, checkpoint_path=None, run_stats=None, dedupe=False,
+                              timeouts=None, max_row_retries=DEFAULT_ROW_RETRIES, hedge=False,
+                              disable_thinking=False, thinking_budget=None, reasoning_log_path=None):
     """
     使用OpenAI模型处理DataFrame中的问题，并将结果添加到DataFrame中。
 
@@ -64,67 +319,174 @@ def query_ai_model_with_excel(df_input, question_column_name, output_response_co
     :param output_response_column_name: 模型响应将写入的列名
     :param output_first_token_column_name: 首token时间将写入的列名
     :param key: OpenAI API密钥
-    :param url: OpenAI API URL
+    :param url: OpenAI API URL；同一模型部署了多个副本时可传地址列表（或逗号分隔的字符串），
+                每次请求发往在途请求最少的副本，连续失败的副本暂时剔除（见 ZhiBiao.endpoint_pool）
     :param model_name: 使用的OpenAI模型名称
-    :param get_first_token: 是否获取首token
+    :param get_first_token: 是否获取首token；为 False 时使用非流式请求，延迟画像中只有总延迟、输出token数和每秒输出token数
     :param prompt: 提示词（可选）
-    :return: 修改后的DataFrame副本，包含模型响应和首token时间
+    :param concurrency: 该端点的最大并发请求数，1 表示逐条串行请求（默认）
+    :param rpm: 该 (url, 模型) 每分钟请求数上限（可选），被限流时会自动降速；多副本时每个副本分别限流
+    :param tpm: 该 (url, 模型) 每分钟token数上限（可选）
+    :param use_cache: 是否读取响应缓存；为 False 时跳过缓存直接请求模型，新结果仍会写回缓存
+    :param checkpoint_path: 行级断点文件路径（可选）；每完成一行即写入，重新执行时跳过已完成的行
+    :param run_stats: 可选的字典，函数会写入 'latency_profiles'（每个实际请求的延迟画像列表）、
+                      'duplicates_collapsed'（去重合并的行数）、'failed_rows'（最终失败的行数）
+                      和 'endpoints'（各副本的请求数、失败数、剔除次数和延迟，见 EndpointPool.stats），供调用方汇总
+    :param dedupe: 是否对问题去重：规范化后完全相同的问题只请求一次，答案复制到所有相同的行
+    :param timeouts: 超时配置 {'connect', 'first_token', 'total'}（秒），未配置的项使用默认值
+    :param max_row_retries: 单行请求超时或连接失败后的重试次数；重试后仍失败的行响应为 None，不影响其他行
+    :param hedge: 是否启用对冲请求：请求耗时超过该端点近期 P95 时再发一次相同请求，取先完成的结果
+    :param disable_thinking: 是否关闭推理模型的思考过程（见 build_reasoning_extra_body）
+    :param thinking_budget: 推理token上限（可选），用于缩短推理模型的思考时间
+    :param reasoning_log_path: 推理内容日志文件路径（可选，JSON Lines）；设置时每个实际请求的推理内容追加写入该文件，
+                               不设置时推理内容只统计token数和耗时，不保留文本
+    :return: 修改后的DataFrame副本，包含模型响应、首token时间以及延迟画像列
+             （列名前缀为响应列名去掉 "_Response"，如 External_Model_Total_Latency）；
+             命中响应缓存的行没有实际请求，首token时间和延迟画像列为空
     """
     df_output = df_input.copy()
     try:
-        client = OpenAI(api_key=key, base_url=url)
+        # 多副本时 url 为各副本地址用逗号连接后的逻辑标识，响应缓存、并发上限和对冲延迟按逻辑模型共享
+        endpoint_pool = get_endpoint_pool(url, model_name)
+        url = endpoint_pool_key(url)
+        response_cache = get_response_cache()
+        latency_tracker = get_latency_tracker(url, model_name)
+        resolved_timeouts = resolve_timeouts(timeouts)
+        # 思考控制会改变回复，作为采样参数计入缓存键；不控制时缓存键与之前一致
+        extra_body = build_reasoning_extra_body(disable_thinking, thinking_budget)
         questions = df_output[question_column_name].dropna().tolist()
+        reasoning_log_lock = threading.Lock()
+
+        def _log_reasoning(row_index, question_text, reasoning_parts):
+            line = json.dumps({'row': row_index, 'model': model_name, 'question': str(question_text),
+                               'reasoning': ''.join(reasoning_parts)}, ensure_ascii=False)
+            with reasoning_log_lock, open(reasoning_log_path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+
+        def _query_question(row_index, question_text):
+            # 先查响应缓存；命中时只复用回复，本次没有实际请求，延迟画像为空并标记 from_cache，
+            # 不把原始请求的耗时写入延迟列和延迟汇总
+            cache_key = make_cache_key(model_name, url, prompt, question_text, {'extra_body': extra_body} if extra_body else None)
+            if use_cache:
+                cached = response_cache.get(cache_key)
+                if cached is not None:
+                    return cached['response'], {'from_cache': True}
+
+            # 在端点限流器控制下请求，遇到 429/5xx 自动退避重试，并按实际输出修正token用量
+            estimated_input_tokens = estimate_tokens(question_text) + (estimate_tokens(prompt) if prompt else 0)
+
+            def _query_replica(replica_url, max_retries, cancel_event):
+                # 限流器和客户端按副本区分；429/5xx 在该副本上的重试由限流器处理，客户端自带的重试已关闭，避免重复退避
+                limiter = get_rate_limiter(replica_url, model_name, rpm=rpm, tpm=tpm)
+                reasoning_parts = [] if reasoning_log_path else None
+                full_response, latency_profile = call_with_rate_limit(
+                    limiter,
+                    lambda: _query_single_question(get_openai_client(replica_url, key, max_connections=concurrency), model_name, question_text, prompt,
+                                                   get_first_token, resolved_timeouts, cancel_event,
+                                                   extra_body, reasoning_parts),
+                    estimated_tokens=estimated_input_tokens,
+                    max_retries=max_retries
+                )
+                limiter.record_usage(estimated_input_tokens, estimated_input_tokens + estimate_tokens(full_response))
+                return full_response, latency_profile, reasoning_parts
+
+            def _attempt(cancel_event):
+                # 每次尝试（包括重试和对冲请求）各自占用一个端点并发名额，对冲请求不会突破并发上限；
+                # 副本由 call_with_replicas 选择，多副本时 429/5xx 换副本重试，失败计入副本池以便剔除坏副本
+                with endpoint_semaphore:
+                    if cancel_event.is_set():
+                        # 等待并发名额期间另一次请求已先完成
+                        raise RequestCancelledError("对冲请求已由另一次请求完成")
+                    return call_with_replicas(
+                        endpoint_pool,
+                        lambda replica_url, max_retries: _query_replica(replica_url, max_retries, cancel_event),
+                        get_latency=lambda result: result[1].get('total_latency'),
+                        label=f"模型 {model_name} "
+                    )
+
+            # 超时或连接失败时整行重试；启用对冲时以该端点近期总耗时的 P95 作为发出第二次请求的等待时间
+            full_response, latency_profile, reasoning_parts = call_with_row_retries(
+                lambda: call_with_hedging(_attempt, latency_tracker.percentile(95) if hedge else None, f"模型 {model_name} "),
+                max_retries=max_row_retries,
+                label=f"模型 {model_name} "
+            )
+            latency_tracker.record(latency_profile.get('total_latency'))
+            if reasoning_parts:
+                _log_reasoning(row_index, question_text, reasoning_parts)
+            response_cache.set(cache_key, full_response, latency_profile['first_token'], model_name, url, latency_profile)
+            return full_response, latency_profile
+
+        checkpoint = RowCheckpoint(checkpoint_path) if checkpoint_path else None
+        completed_rows = checkpoint.load() if checkpoint else {}
+        if completed_rows:
+            print(f"从断点恢复：模型 {model_name} 已完成 {len(completed_rows)}/{len(questions)} 条，继续请求剩余问题。")
+
+        # 串行模式同样经过端点信号量：对冲请求计入并发上限，并与其他任务共享同一端点的上限
+        endpoint_semaphore = get_endpoint_semaphore(url, concurrency or 1)
+
+        # 去重：每组相同问题只请求第一次出现的行，其余行复用该行的结果
+        if dedupe:
+            representative_rows = {}
+            row_to_representative = [representative_rows.setdefault(question_dedupe_key(question_text), row_index)
+                                     for row_index, question_text in enumerate(questions)]
+            rows_to_query = sorted(set(row_to_representative))
+            duplicates_collapsed = len(questions) - len(rows_to_query)
+            print(f"问题去重：模型 {model_name} 共{len(questions)}条问题，合并重复问题{duplicates_collapsed}条，实际请求{len(rows_to_query)}条。")
+        else:
+            row_to_representative = list(range(len(questions)))
+            rows_to_query = row_to_representative
+            duplicates_collapsed = 0
+
+        def _query_row(row_index):
+            record = completed_rows.get(row_index)
+            if record is not None:
+                return record.pop('response'), record
+            try:
+                full_response, latency_profile = _query_question(row_index, questions[row_index])
+            except Exception as e:
+                # 单行最终失败只影响该行；不写断点，重新提交时会再次请求
+                print(f"模型 {model_name} 第{row_index + 1}行请求失败: {e}")
+                return None, {}
+            if checkpoint:
+                checkpoint.record(row_index, response=full_response, **latency_profile)
+            return full_response, latency_profile
+
+        if concurrency and concurrency > 1:
+            # 并发模式：线程池按问题顺序返回结果，保证答案与首token时间和原始行对齐
+            print(f"并发请求模型 {model_name}，并发上限: {concurrency}，共{len(rows_to_query)}条问题。")
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                queried_results = dict(zip(rows_to_query, executor.map(_query_row, rows_to_query)))
+        else:
+            queried_results = {row_index: _query_row(row_index) for row_index in rows_to_query}
+        results = [queried_results[representative_row] for representative_row in row_to_representative]
+        print(f"模型 {model_name} 请求完成，响应缓存统计: {response_cache.stats()}")
 
         responses_list = []
         first_tokens_list = []
-
-        for index, question_text in enumerate(questions):
-            start_time = time.time()
-            first_token_received = False
-            first_token_time_val = None
-
-            messages = [{"role": "user", "content": str(question_text)}]
-            if prompt:
-                messages.insert(0, {"role": "system", "content": prompt})
-
-            response_stream = client.chat.completions.create(
-                model=model_name,
-                messages=messages,
-                stream=True
-            )
-
-            full_response = ""
-            full_response_reasoning = ""
-            for chunk in response_stream:
-                if not chunk.choices:
-                    continue
-                # 模型生成的直接文本回复
-                content = chunk.choices[0].delta.content
-                # 模型生成内容背后的推理过程
-                reasoning_content = chunk.choices[0].delta.reasoning_content
-                
-                if content:
-                    if not first_token_received:
-                        first_token_time_val = time.time() - start_time
-                        first_token_received = True
-                    full_response += content
-                    full_response_reasoning += content
-                    # print(content, end="", flush=True) # Optional: for live printing
-                if reasoning_content:
-                    # 模型生成的推理过程，后续添加到日志中。
-                    full_response_reasoning += reasoning_content
-                    # print(reasoning_content, end="", flush=True) # Optional: for live printing
-            # print() # Optional: for live printing
-
+        latency_profiles = []
+        for full_response, latency_profile in results:
             responses_list.append(full_response)
+            latency_profiles.append(latency_profile)
             if get_first_token:
-                first_tokens_list.append(first_token_time_val)
+                first_tokens_list.append(latency_profile.get('first_token'))
             else:
                 first_tokens_list.append(None) # Keep lists aligned
 
-        df_output[output_response_column_name] = pd.Series(responses_list, index=df_output.head(len(questions)).index)
+        output_index = df_output.head(len(questions)).index
+        df_output[output_response_column_name] = pd.Series(responses_list, index=output_index)
         if get_first_token:
-            df_output[output_first_token_column_name] = pd.Series(first_tokens_list, index=df_output.head(len(questions)).index)
+            df_output[output_first_token_column_name] = pd.Series(first_tokens_list, index=output_index)
+
+        # 每个请求的延迟画像各占一列
+        latency_column_prefix = output_response_column_name[:-len('_Response')] if output_response_column_name.endswith('_Response') else output_response_column_name
+        for field, column_suffix in LATENCY_PROFILE_COLUMNS:
+            df_output[f'{latency_column_prefix}_{column_suffix}'] = pd.Series(
+                [latency_profile.get(field) for latency_profile in latency_profiles], index=output_index)
+        if run_stats is not None:
+            run_stats['latency_profiles'] = [queried_results[row_index][1] for row_index in rows_to_query]
+            run_stats['duplicates_collapsed'] = duplicates_collapsed
+            run_stats['failed_rows'] = sum(1 for full_response, _ in queried_results.values() if full_response is None)
+            run_stats['endpoints'] = endpoint_pool.stats()
 
         return df_output
 
@@ -140,94 +502,15 @@ def query_ai_model_with_excel(df_input, question_column_name, output_response_co
 
 
 # --- Start of CILIN F1 Calculation Code ---
-CILIN_DATA = None # 初始化 CILIN_DATA，存储 (word_to_direct_synonyms, word_to_codes, code_prefix_to_words)
-
-def load_cilin(cilin_path):
-    """
-    加载哈工大词林文件。
-    每行格式可能为 '编码 词1 词2 ...' 或 '编码=词1 词2 ...'。
-    构建以下数据结构:
-    1. word_to_direct_synonyms: 词 -> {同义词集合} (同一行内的词互为同义词)
-    2. word_to_codes: 词 -> {词林编码集合} (一个词可能对应多个编码)
-    3. code_prefix_to_words: 词林编码前缀 -> {词集合} (用于层次化扩展)
-    """
-    global CILIN_DATA
-    if CILIN_DATA is not None:
-        return CILIN_DATA
-
-    word_to_direct_synonyms = defaultdict(set)
-    word_to_codes = defaultdict(set)
-    code_to_words_temp = defaultdict(set) # 临时存储完整编码到词的映射
-    code_prefix_to_words = defaultdict(set)
-
-    processed_lines = 0
-    malformed_lines = 0 # 记录格式不正确的行数
-
-    try:
-        with open(cilin_path, 'r', encoding='utf-8') as f:
-            for line_number, line_content in enumerate(f, 1):
-                line_content = line_content.strip()
-                if not line_content:
-                    continue
-
-                parts = line_content.split(None, 1) # 按第一个空格分割
-                if len(parts) < 2:
-                    parts = line_content.split('=', 1)
-                    if len(parts) < 2:
-                        malformed_lines += 1
-                        # print(f"Skipping malformed line {line_number}: {line_content} (无法分割编码和词语)")
-                        continue
-                
-                cilin_code_raw = parts[0]
-                words_str = parts[1].strip()
-                actual_code = ''.join(filter(str.isalnum, cilin_code_raw))
-
-                if not actual_code:
-                    malformed_lines +=1
-                    # print(f"Skipping malformed line {line_number}: {line_content} (编码处理后为空)")
-                    continue
-                
-                current_line_words = {word for word in words_str.split() if word}
-                if not current_line_words:
-                    malformed_lines += 1
-                    # print(f"Skipping malformed line {line_number}: {line_content} (没有有效词语)")
-                    continue
-                
-                processed_lines += 1
-                for word in current_line_words:
-                    word_to_direct_synonyms[word].update(current_line_words)
-                    word_to_codes[word].add(actual_code)
-                code_to_words_temp[actual_code].update(current_line_words)
-
-        meaningful_prefix_lengths = [1, 2, 4, 5] # 大类(1), 中类(2), 小类(4), 词群(5)
-
-        for code_val, words in code_to_words_temp.items(): # Renamed 'code' to 'code_val'
-            for length in meaningful_prefix_lengths:
-                if len(code_val) >= length:
-                    prefix = code_val[:length]
-                    code_prefix_to_words[prefix].update(words)
-        
-        CILIN_DATA = (word_to_direct_synonyms, word_to_codes, code_prefix_to_words)
-        print(f"词林加载完毕。共处理 {processed_lines} 行有效词条。")
-        if malformed_lines > 0:
-            print(f"警告：跳过了 {malformed_lines} 行格式不正确的词条。请检查词林文件格式。")
-        return CILIN_DATA
-    except FileNotFoundError:
-        print(f"错误：词林文件未找到于路径 {cilin_path}")
-        CILIN_DATA = None 
-        return None
-    except Exception as e:
-        print(f"加载词林时发生未知错误: {e}")
-        CILIN_DATA = None
-        return None
-
-def calculate_f1_with_cilin(input_excel_path, cilin_path):
+def calculate_f1_with_cilin(input_excel_path, cilin_path, token_cache=None):
     """
     计算两段中文文本之间的F1值，使用jieba进行分词和词林扩展。
 
     :param input_excel_path: 输入的Excel文件路径
-    :param cilin_path: 哈工大词林文件路径
+    :param cilin_path: 哈工大词林文件路径（首次使用时编译为同目录下的 cilin.idx 索引，见 cilin_index）
+    :param token_cache: 任务内共享的 TokenCache，为 None 时单独分词
     """
+    token_cache = token_cache or TokenCache()
     df = pd.read_excel(input_excel_path)
 
     if len(df.columns) < 3:
@@ -258,13 +541,12 @@ def calculate_f1_with_cilin(input_excel_path, cilin_path):
     print('开始F1值_词林_层次化评估...')
     start_time = time.time()
 
-    cilin_data_tuple = load_cilin(cilin_path)
-    if cilin_data_tuple is None:
+    cilin_index = get_cilin_index(cilin_path)
+    if cilin_index is None:
         print(f"词林数据加载失败 (路径: {cilin_path})。跳过F1值_词林_层次化评估。")
         df[output_column_name] = "词林加载失败"
         df.to_excel(input_excel_path, index=False)
         return
-    word_to_direct_synonyms, word_to_codes, code_prefix_to_words = cilin_data_tuple
 
     f1_scores = []
     for index in range(len(df)):
@@ -275,41 +557,18 @@ def calculate_f1_with_cilin(input_excel_path, cilin_path):
         text1 = texts_one[index]
         text2 = texts_two[index]
         
-        tokens1 = set(jieba.cut(text1)) 
-        tokens2 = set(jieba.cut(text2)) 
-
-        expanded_tokens1 = set()
-        for token in tokens1:
-            expanded_tokens1.add(token) 
-            if token in word_to_direct_synonyms: 
-                expanded_tokens1.update(word_to_direct_synonyms[token])
-            if token in word_to_codes: 
-                for code_item in word_to_codes[token]: 
-                    prefixes_lengths = [1, 2, 4, 5] 
-                    for length in prefixes_lengths:
-                        if len(code_item) >= length:
-                            prefix = code_item[:length]
-                            if prefix in code_prefix_to_words:
-                                expanded_tokens1.update(code_prefix_to_words[prefix])
-        
-        expanded_tokens2 = set()
-        for token in tokens2:
-            expanded_tokens2.add(token) 
-            if token in word_to_direct_synonyms: 
-                expanded_tokens2.update(word_to_direct_synonyms[token])
-            if token in word_to_codes: 
-                for code_item in word_to_codes[token]: 
-                    prefixes_lengths = [1, 2, 4, 5]
-                    for length in prefixes_lengths:
-                        if len(code_item) >= length:
-                            prefix = code_item[:length]
-                            if prefix in code_prefix_to_words:
-                                expanded_tokens2.update(code_prefix_to_words[prefix])
-
-        intersection = expanded_tokens1.intersection(expanded_tokens2)
-        
-        precision = len(intersection) / len(expanded_tokens2) if expanded_tokens2 else 0.0
-        recall = len(intersection) / len(expanded_tokens1) if expanded_tokens1 else 0.0
+        tokens1 = set(token_cache.tokenize(text1))
+        tokens2 = set(token_cache.tokenize(text2))
+
+        # 词林扩展：词本身、同义词及同类词；按大类掩码计数，不展开词集
+        expansion1 = cilin_index.expand(tokens1)
+        expansion2 = cilin_index.expand(tokens2)
+        expanded_size1 = cilin_index.expanded_size(expansion1)
+        expanded_size2 = cilin_index.expanded_size(expansion2)
+        intersection_size = cilin_index.intersection_size(expansion1, expansion2)
+
+        precision = intersection_size / expanded_size2 if expanded_size2 else 0.0
+        recall = intersection_size / expanded_size1 if expanded_size1 else 0.0
 
         if precision + recall == 0:
             f1 = 0.0
@@ -335,19 +594,36 @@ def calculate_f1_with_cilin(input_excel_path, cilin_path):
 
 def process_and_evaluate_excel(questions_excel_path, output_dir, prompt,
                                external_model_config, internal_model_config,
-                               selected_metrics, embedding_model_for_ass='BAAI/bge-small-zh-v1.5'):
+                               selected_metrics, embedding_model_for_ass='BAAI/bge-small-zh-v1.5', run_summary=None,
+                               embedding_batch_size=DEFAULT_EMBEDDING_BATCH_SIZE):
     """
     核心处理函数：读取问题Excel，调用内外两个模型，合并结果，执行评估，并保存最终Excel。
 
     :param questions_excel_path: 只包含一列问题的Excel文件路径
     :param output_dir: 最终Excel文件的保存目录
     :param prompt: 通用提示词 (或按需调整为模型特定提示词)
-    :param external_model_config: 外部模型配置字典 {key, url, name, get_first_token}
-    :param internal_model_config: 内部模型配置字典 {key, url, name, get_first_token}
+    :param external_model_config: 外部模型配置字典 {key, url, name, get_first_token, concurrency, rpm, tpm, use_cache, dedupe,
+                                  timeouts, max_retries, hedge, disable_thinking, thinking_budget, log_reasoning}
+    :param internal_model_config: 内部模型配置字典 {key, url, name, get_first_token, concurrency, rpm, tpm, use_cache, dedupe,
+                                  timeouts, max_retries, hedge, disable_thinking, thinking_budget, log_reasoning}；url 可以是多个副本的地址列表（或逗号分隔的字符串）
     :param selected_metrics: 用户选择的评估指标列表 (e.g., ['ass', 'rouge1'])
+    :param embedding_batch_size: ASS 评估时每批编码的文本条数
+    :param run_summary: 可选的字典，函数会写入本次运行的汇总信息（各模型延迟的 P50/P90/P99、各阶段耗时 stage_times、
+                        各副本统计 endpoints、推理内容日志文件路径 reasoning_logs）
     :return: 处理完成的Excel文件路径, 或 None 如果失败
     """
+    # 各阶段耗时（秒），随处理进度写入，失败时也能看到已完成阶段的耗时
+    stage_times = {}
+    if run_summary is not None:
+        run_summary['stage_times'] = stage_times
+
+    def _run_metric(metric_name, metric_func, *args, **kwargs):
+        metric_start = time.perf_counter()
+        metric_func(*args, **kwargs)
+        stage_times[f'metric_{metric_name}'] = time.perf_counter() - metric_start
+
     try:
+        stage_start = time.perf_counter()
         df_questions = pd.read_excel(questions_excel_path)
         if df_questions.empty or len(df_questions.columns) == 0:
             raise ValueError("问题Excel文件为空或没有列。")
@@ -360,52 +636,148 @@ def process_and_evaluate_excel(questions_excel_path, output_dir, prompt,
         if df_result.empty:
             raise ValueError("提取问题后DataFrame为空。")
 
-        # 1. 调用外部模型
-        print("调用外部模型...")
-        df_result_with_ext = query_ai_model_with_excel(
-            df_result.copy(), # Pass a copy to avoid unintended modifications
-            'Questions',
-            'External_Model_Response',
-            'External_Model_First_Token',
-            external_model_config['key'],
-            external_model_config['url'],
-            external_model_config['name'],
-            external_model_config['get_first_token'],
-            prompt
-        )
+        # 行级断点：同样的问题和模型配置重新提交时，从未完成的行继续；思考控制不同时使用不同的断点
+        _reasoning_params = lambda model_config: build_reasoning_extra_body(model_config.get('disable_thinking', False),
+                                                                            model_config.get('thinking_budget'))
+        questions_list = df_result['Questions'].tolist()
+        external_checkpoint_path = make_checkpoint_path(questions_list, external_model_config['name'], endpoint_pool_key(external_model_config['url']), prompt, 'external',
+                                                        sampling_params=_reasoning_params(external_model_config))
+        internal_checkpoint_path = make_checkpoint_path(questions_list, internal_model_config['name'], endpoint_pool_key(internal_model_config['url']), prompt, 'internal',
+                                                        sampling_params=_reasoning_params(internal_model_config))
+        stage_times['load_questions'] = time.perf_counter() - stage_start
+
+        # 推理内容日志：勾选 log_reasoning 的模型把每个请求的推理内容写入输出目录下的 JSON Lines 文件
+        run_id = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{str(uuid.uuid4())[:8]}"
+        reasoning_log_paths = {}
+        for column_prefix, model_config, tag in (('External_Model', external_model_config, 'external'),
+                                                 ('Internal_Model', internal_model_config, 'internal')):
+            if model_config.get('log_reasoning'):
+                if not os.path.exists(output_dir):
+                    os.makedirs(output_dir)
+                reasoning_log_paths[column_prefix] = os.path.join(output_dir, f"reasoning_{tag}_{run_id}.jsonl")
+        external_reasoning_log_path = reasoning_log_paths.get('External_Model')
+        internal_reasoning_log_path = reasoning_log_paths.get('Internal_Model')
+
+        # 1./2. 外部模型与内部模型互不依赖，两轮调用并行执行，总耗时取两者中较长的一个。
+        # 每个模型在各自的线程中独立计时，首token时间仍按模型分别测量。
+        print("并行调用外部模型与内部模型...")
+        stage_start = time.perf_counter()
+        external_run_stats = {}
+        internal_run_stats = {}
+        with ThreadPoolExecutor(max_workers=2) as model_executor:
+            future_ext = model_executor.submit(
+                query_ai_model_with_excel,
+                df_result.copy(), # Pass a copy to avoid unintended modifications
+                'Questions',
+                'External_Model_Response',
+                'External_Model_First_Token',
+                external_model_config['key'],
+                external_model_config['url'],
+                external_model_config['name'],
+                external_model_config['get_first_token'],
+                prompt,
+                external_model_config.get('concurrency', 1),
+                external_model_config.get('rpm'),
+                external_model_config.get('tpm'),
+                external_model_config.get('use_cache', True),
+                external_checkpoint_path,
+                external_run_stats,
+                external_model_config.get('dedupe', False),
+                timeouts=external_model_config.get('timeouts'),
+                max_row_retries=external_model_config.get('max_retries', DEFAULT_ROW_RETRIES),
+                hedge=external_model_config.get('hedge', False),
+                disable_thinking=external_model_config.get('disable_thinking', False),
+                thinking_budget=external_model_config.get('thinking_budget'),
+                reasoning_log_path=external_reasoning_log_path
+            )
+            future_int = model_executor.submit(
+                query_ai_model_with_excel,
+                df_result.copy(), # Pass a copy with only questions for internal model
+                'Questions',
+                'Internal_Model_Response',
+                'Internal_Model_First_Token',
+                internal_model_config['key'],
+                internal_model_config['url'],
+                internal_model_config['name'],
+                internal_model_config['get_first_token'],
+                prompt,
+                internal_model_config.get('concurrency', 1),
+                internal_model_config.get('rpm'),
+                internal_model_config.get('tpm'),
+                internal_model_config.get('use_cache', True),
+                internal_checkpoint_path,
+                internal_run_stats,
+                internal_model_config.get('dedupe', False),
+                timeouts=internal_model_config.get('timeouts'),
+                max_row_retries=internal_model_config.get('max_retries', DEFAULT_ROW_RETRIES),
+                hedge=internal_model_config.get('hedge', False),
+                disable_thinking=internal_model_config.get('disable_thinking', False),
+                thinking_budget=internal_model_config.get('thinking_budget'),
+                reasoning_log_path=internal_reasoning_log_path
+            )
+            df_result_with_ext = future_ext.result()
+            df_result_with_int = future_int.result()
+        stage_times['model_queries'] = time.perf_counter() - stage_start
+
         df_result['External_Model_Response'] = df_result_with_ext.get('External_Model_Response')
         if external_model_config['get_first_token']:
             df_result['External_Model_First_Token'] = df_result_with_ext.get('External_Model_First_Token')
 
-        # 2. 调用内部模型
-        print("调用内部模型...")
-        df_result_with_int = query_ai_model_with_excel(
-            df_result.copy(), # Pass a copy with only questions for internal model
-            'Questions',
-            'Internal_Model_Response',
-            'Internal_Model_First_Token',
-            internal_model_config['key'],
-            internal_model_config['url'],
-            internal_model_config['name'],
-            internal_model_config['get_first_token'],
-            prompt
-        )
         df_result['Internal_Model_Response'] = df_result_with_int.get('Internal_Model_Response')
         if internal_model_config['get_first_token']:
             df_result['Internal_Model_First_Token'] = df_result_with_int.get('Internal_Model_First_Token')
 
+        # 延迟画像列
+        latency_columns = []
+        for column_prefix, df_with_model in (('External_Model', df_result_with_ext), ('Internal_Model', df_result_with_int)):
+            for _, column_suffix in LATENCY_PROFILE_COLUMNS:
+                latency_column = f'{column_prefix}_{column_suffix}'
+                if latency_column in df_with_model.columns:
+                    df_result[latency_column] = df_with_model[latency_column]
+                    latency_columns.append(latency_column)
+
+        # 运行汇总：各模型延迟指标的 P50/P90/P99
+        latency_summary = {}
+        for column_prefix, model_run_stats in (('External_Model', external_run_stats), ('Internal_Model', internal_run_stats)):
+            if model_run_stats.get('latency_profiles'):
+                latency_summary[column_prefix] = summarize_latency_profiles(model_run_stats['latency_profiles'])
+                print(f"{column_prefix} 延迟汇总: {latency_summary[column_prefix]}")
+            # 多副本时输出各副本的请求数和延迟，便于发现慢节点
+            if len(model_run_stats.get('endpoints') or {}) > 1:
+                for replica_url, replica_stats in model_run_stats['endpoints'].items():
+                    print(f"{column_prefix} 副本 {replica_url}: {replica_stats}")
+        if run_summary is not None:
+            run_summary['latency'] = latency_summary
+            run_summary['duplicates_collapsed'] = {
+                'External_Model': external_run_stats.get('duplicates_collapsed', 0),
+                'Internal_Model': internal_run_stats.get('duplicates_collapsed', 0),
+            }
+            run_summary['failed_rows'] = {
+                'External_Model': external_run_stats.get('failed_rows', 0),
+                'Internal_Model': internal_run_stats.get('failed_rows', 0),
+            }
+            # 没有收到任何推理内容的模型不会生成日志文件
+            run_summary['reasoning_logs'] = {column_prefix: log_path for column_prefix, log_path in reasoning_log_paths.items()
+                                             if os.path.exists(log_path)}
+            run_summary['endpoints'] = {
+                'External_Model': external_run_stats.get('endpoints', {}),
+                'Internal_Model': internal_run_stats.get('endpoints', {}),
+            }
+
         # 确保评估函数所需的列顺序：Questions, External, Internal
         final_columns_order = ['Questions', 'External_Model_Response', 'Internal_Model_Response']
         if external_model_config['get_first_token'] and 'External_Model_First_Token' in df_result:
             final_columns_order.append('External_Model_First_Token')
         if internal_model_config['get_first_token'] and 'Internal_Model_First_Token' in df_result:
             final_columns_order.append('Internal_Model_First_Token')
+        final_columns_order.extend(latency_columns)
         
         # Reorder df_result columns if necessary, handling missing columns gracefully
         current_cols = [col for col in final_columns_order if col in df_result.columns]
         df_result = df_result[current_cols]
 
         # 创建唯一文件名并保存包含模型响应的Excel
+        stage_start = time.perf_counter()
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         unique_id = str(uuid.uuid4())[:8]
         output_filename = f"eval_ready_{timestamp}_{unique_id}.xlsx"
@@ -413,31 +785,46 @@ def process_and_evaluate_excel(questions_excel_path, output_dir, prompt,
             os.makedirs(output_dir)
         output_file_path = os.path.join(output_dir, output_filename)
         df_result.to_excel(output_file_path, index=False)
+        stage_times['save_responses'] = time.perf_counter() - stage_start
         print(f"模型响应已保存到: {output_file_path}")
 
+        # 模型响应完整落盘后再清理断点；某一列请求失败时保留断点，供重新提交时续跑
+        for response_column, checkpoint_path in (('External_Model_Response', external_checkpoint_path),
+                                                 ('Internal_Model_Response', internal_checkpoint_path)):
+            if response_column in df_result.columns and df_result[response_column].notna().all():
+                RowCheckpoint(checkpoint_path).remove()
+
         # 3. 执行评估指标计算
         if selected_metrics:
             print(f"开始评估指标计算: {selected_metrics}")
             if 'ass' in selected_metrics:
                 print(f"计算ASS值 (使用嵌入模型: {embedding_model_for_ass})...")
-                excel_ragas(output_file_path, embedding_model_identifier=embedding_model_for_ass) # Modifies file in place
-            if 'rouge1' in selected_metrics:
-                print("计算ROUGE-1...")
-                excel_rouge(output_file_path, 'ROUGE-1') # Modifies file in place
-            if 'rouge2' in selected_metrics:
-                print("计算ROUGE-2...")
-                excel_rouge(output_file_path, 'ROUGE-2') # Modifies file in place
-            if 'rougel' in selected_metrics:
-                print("计算ROUGE-L...")
-                excel_rouge(output_file_path, 'ROUGE-L') # Modifies file in place
+                _run_metric('ass', excel_ragas, output_file_path, embedding_model_identifier=embedding_model_for_ass,
+                            batch_size=embedding_batch_size) # Modifies file in place
+            # 词法指标（ROUGE、F1值、F1值_词林）共用一份分词结果：先把两列答案各分词一次
+            token_cache = TokenCache()
+            if any(metric_name in selected_metrics for metric_name in ('rouge1', 'rouge2', 'rougel', 'f1_chinese', 'f1_cilin')):
+                stage_start = time.perf_counter()
+                answer_texts = [str(text) for column_name in ('External_Model_Response', 'Internal_Model_Response')
+                                if column_name in df_result.columns for text in df_result[column_name].dropna()]
+                token_cache.tokenize_many(dict.fromkeys(answer_texts))
+                stage_times['tokenize'] = time.perf_counter() - stage_start
+                print(f"答案分词完成，共{token_cache.stats()['texts']}条不同文本。")
+
+            # 选中的 ROUGE 指标一次计算并一起写入
+            rouge_indexes = [rouge_index for metric_name, rouge_index in (('rouge1', 'ROUGE-1'), ('rouge2', 'ROUGE-2'), ('rougel', 'ROUGE-L'))
+                             if metric_name in selected_metrics]
+            if rouge_indexes:
+                print(f"计算{'、'.join(rouge_indexes)}...")
+                _run_metric('rouge', excel_rouge, output_file_path, rouge_indexes, token_cache=token_cache) # Modifies file in place
             if 'f1_chinese' in selected_metrics:
                 print("计算F1值(中文分词)...")
-                calculate_f1_chinese(output_file_path) # Modifies file in place
+                _run_metric('f1_chinese', calculate_f1_chinese, output_file_path, token_cache=token_cache) # Modifies file in place
             if 'f1_cilin' in selected_metrics: # New metric for CILIN F1
                 print("计算F1值(词林扩展)...")
-                cilin_txt_path = f"/Users/lpd/Documents/project/ceping/AI_test_utils/ZhiBiao/cilin.txt"
+                cilin_txt_path = DEFAULT_CILIN_PATH
                 if os.path.exists(cilin_txt_path):
-                    calculate_f1_with_cilin(output_file_path, cilin_txt_path) # Modifies file in place
+                    _run_metric('f1_cilin', calculate_f1_with_cilin, output_file_path, cilin_txt_path, token_cache=token_cache) # Modifies file in place
                 else:
                     print(f"错误：词林文件 {cilin_txt_path} 未找到。跳过F1值(词林扩展)计算。")
                     try:
@@ -454,6 +841,7 @@ def process_and_evaluate_excel(questions_excel_path, output_dir, prompt,
                     except Exception as e_excel:
                         print(f"写入词林未找到错误到Excel时出错: {e_excel}")
         
+        print(f"各阶段耗时（秒）: {stage_times}")
         print(f"所有处理和评估完成。最终文件: {output_file_path}")
         return output_file_path
 
@@ -470,13 +858,40 @@ def convert_seconds(seconds):
     seconds = round(seconds % 60, 2)
     return hours, minutes, seconds
 
+def _load_sentence_transformer(model_path):
+    print(f"加载 SentenceTransformer 模型: {model_path}")
+    return SentenceTransformer(model_path)
+
+# 模型下载或加载失败改用后备模型后，该模型名在这段时间（秒）内直接使用后备模型，到期后重新尝试
+EMBEDDING_MODEL_RETRY_SECONDS = 600
+
 # Helper function to download/load model
 def get_embedding_model(model_name_or_path='BAAI/bge-small-zh-v1.5', fallback_model='paraphrase-multilingual-MiniLM-L12-v2'):
     """
     Ensures the specified sentence embedding model is available, loading from a local path or downloading if necessary.
     Returns the SentenceTransformer model instance.
     Uses a fallback model if the primary model load/download fails.
+    Loaded models are kept in the process-wide embedding model cache, keyed by the resolved model path.
     """
+    return load_embedding_model(model_name_or_path, fallback_model)[1]
+
+def load_embedding_model(model_name_or_path='BAAI/bge-small-zh-v1.5', fallback_model='paraphrase-multilingual-MiniLM-L12-v2'):
+    """
+    Same as get_embedding_model, but returns (model_key, model): model_key is the resolved model path,
+    or the fallback model name when the fallback was used. It identifies the model actually loaded.
+    The resolved key is remembered per requested name, so later calls go straight to the model cache
+    without re-resolving the path or contacting ModelScope. A failed download is remembered for
+    EMBEDDING_MODEL_RETRY_SECONDS, during which later calls use the fallback model directly.
+    """
+    model_cache = get_embedding_model_cache()
+    remembered_key = model_cache.resolve(model_name_or_path)
+    if remembered_key is not None:
+        try:
+            return remembered_key, model_cache.get_or_load(remembered_key, lambda: _load_sentence_transformer(remembered_key))
+        except Exception as e:
+            print(f"按已记录的路径 {remembered_key} 加载模型 '{model_name_or_path}' 失败，重新解析: {e}")
+            model_cache.forget(model_name_or_path)
+
     project_root = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
     model_base_dir = os.path.join(project_root, 'models')
     
@@ -522,8 +937,10 @@ def get_embedding_model(model_name_or_path='BAAI/bge-small-zh-v1.5', fallback_mo
 
     try:
         if model_to_load and os.path.isdir(model_to_load):
-            print(f"加载 SentenceTransformer 模型: {model_to_load}")
-            return SentenceTransformer(model_to_load)
+            model_key = os.path.realpath(model_to_load)
+            model = model_cache.get_or_load(model_key, lambda: _load_sentence_transformer(model_key))
+            model_cache.remember(model_name_or_path, model_key)
+            return model_key, model
         else:
             if model_to_load:
                  print(f"错误: 解析后的模型路径 '{model_to_load}' 不是一个有效的目录。")
@@ -533,38 +950,37 @@ def get_embedding_model(model_name_or_path='BAAI/bge-small-zh-v1.5', fallback_mo
         print(f"处理或加载模型 '{model_name_or_path}' (最终尝试路径: {model_to_load if model_to_load else 'N/A'}) 失败: {e}")
         print(f"尝试使用后备模型: {fallback_model}")
         try:
-            return SentenceTransformer(fallback_model)
+            model = model_cache.get_or_load(fallback_model, lambda: _load_sentence_transformer(fallback_model))
+            model_cache.remember(model_name_or_path, fallback_model, ttl_seconds=EMBEDDING_MODEL_RETRY_SECONDS)
+            print(f"{EMBEDDING_MODEL_RETRY_SECONDS} 秒内再次请求模型 '{model_name_or_path}' 时将直接使用后备模型 {fallback_model}。")
+            return fallback_model, model
         except Exception as e_fallback:
             print(f"加载后备模型 {fallback_model} 也失败: {e_fallback}")
             raise  # Re-raise the exception if fallback also fails
 
-def excel_ragas(input_excel_path, embedding_model_identifier='BAAI/bge-small-zh-v1.5'):
+def excel_ragas(input_excel_path, embedding_model_identifier='BAAI/bge-small-zh-v1.5', batch_size=DEFAULT_EMBEDDING_BATCH_SIZE):
     """
     对excel中的B列与C列进行ASS值比较，生成比较值，并写入excel中。
+    两列答案去重后一次性分批编码为归一化向量，余弦相似度按行点积向量化计算；只计算两列都有答案的行。
+    向量持久化缓存在本地（按 模型路径 + 文本哈希），只编码缓存中没有的文本。
 
     :param input_excel_path: 输入的Excel文件路径
     :param embedding_model_identifier: 用于ASS评估的嵌入模型的名称、ModelScope ID或本地路径
+    :param batch_size: 每批编码的文本条数
     """
 
     # 读取Excel文件
     df = pd.read_excel(input_excel_path)
 
     # 检查是否有足够的列
-    if len(df.columns) < 2: # 需要至少两列用于比较 (e.g., External_Model_Response, Internal_Model_Response)
+    if len(df.columns) < 3: # 需要至少两列答案用于比较 (e.g., External_Model_Response, Internal_Model_Response)
         raise ValueError("Excel文件中至少需要两列（例如，外部模型响应和内部模型响应）来进行比较。")
 
-    # 获取第二列与第三列的内容作为问题
-    # 这些索引现在应该对应于 'External_Model_Response' 和 'Internal_Model_Response'
     # 在 process_and_evaluate_excel 中，列的顺序是 Questions, External_Model_Response, Internal_Model_Response
-    # 因此，我们比较 df.iloc[:, 1] 和 df.iloc[:, 2]
-    questions_one = df.iloc[:, 1].dropna().tolist()
-    questions_two = df.iloc[:, 2].dropna().tolist()
-
-    if len(questions_one) != len(questions_two):
-        print("警告: 用于ASS评估的两个答案列的长度不匹配。将按较短的列表长度进行处理。")
-        min_len = min(len(questions_one), len(questions_two))
-        questions_one = questions_one[:min_len]
-        questions_two = questions_two[:min_len]
+    # 因此，我们比较 df.iloc[:, 1] 和 df.iloc[:, 2]；某一列请求失败（为空）的行不参与计算，保证两列按行对齐
+    valid_rows = df.iloc[:, 1].notna() & df.iloc[:, 2].notna()
+    answers_one = df.loc[valid_rows, df.columns[1]].astype(str).tolist()
+    answers_two = df.loc[valid_rows, df.columns[2]].astype(str).tolist()
 
     # 准备结果列
     # 使用 embedding_model_identifier 来创建列名，以反映所使用的模型
@@ -572,71 +988,83 @@ def excel_ragas(input_excel_path, embedding_model_identifier='BAAI/bge-small-zh-
     if ass_column_name not in df.columns:
         df[ass_column_name] = pd.Series(dtype='float64') # Ensure float type for scores
 
-    questions_len = len(questions_one)
+    questions_len = len(answers_one)
     if questions_len == 0:
         print("没有可用于ASS评估的数据。")
         return
-    
+
     # 批量数据进行ASS对比
     print(f'获取嵌入模型 ({embedding_model_identifier})...')
     try:
-        model = get_embedding_model(embedding_model_identifier)
+        model_key, model = load_embedding_model(embedding_model_identifier)
     except Exception as e:
         print(f"无法加载ASS评估所需的嵌入模型: {e}。ASS评估无法进行。")
         return
 
     start_time = time.time()
-    ass_scores = []
-    for index in range(questions_len):
-        reference_answer = str(questions_one[index])
-        generated_answer = str(questions_two[index])
-
-        # 计算两个答案的嵌入向量
-        embedding_1 = np.array(model.encode(reference_answer))
-        embedding_2 = np.array(model.encode(generated_answer))
-
-        print(f'进行ASS相似度计算，共{questions_len}条数据，计算第{index+1}条，请耐心等待。。。')
-
-        # 计算余弦相似度
-        norms_1 = np.linalg.norm(embedding_1, keepdims=True)
-        norms_2 = np.linalg.norm(embedding_2, keepdims=True)
-        
-        if norms_1 == 0 or norms_2 == 0:
-            similarity_score = 0.0 # Handle zero vectors
-        else:
-            embedding_1_normalized = embedding_1 / norms_1
-            embedding_2_normalized = embedding_2 / norms_2
-            similarity = embedding_1_normalized @ embedding_2_normalized.T
-            similarity_score = similarity.item() # .flatten().tolist()[0] might fail if not scalar
-
-        ass_scores.append(similarity_score)
-
-    # 将完整响应写入DataFrame
-    # Ensure the series is aligned with the original DataFrame's index for the relevant rows
-    df.loc[df.iloc[:,1].dropna().index[:questions_len], ass_column_name] = ass_scores
+    # 两列答案中相同的文本只编码一次
+    unique_texts = list(dict.fromkeys(answers_one + answers_two))
+    text_index = {text: index for index, text in enumerate(unique_texts)}
+    embedding_store = get_embedding_store(model_key)
+    text_hashes = [embedding_text_hash(text) for text in unique_texts]
+    cached_vectors = embedding_store.get_many(text_hashes)
+    missing = [index for index, text_hash in enumerate(text_hashes) if text_hash not in cached_vectors]
+    print(f'进行ASS相似度计算，共{questions_len}条数据（{len(unique_texts)}条不同文本，缓存命中{len(unique_texts) - len(missing)}条，'
+          f'需编码{len(missing)}条，每批{batch_size}条），请耐心等待。。。')
+    if missing:
+        encoded = np.asarray(model.encode([unique_texts[index] for index in missing],
+                                          batch_size=max(1, int(batch_size or DEFAULT_EMBEDDING_BATCH_SIZE)),
+                                          normalize_embeddings=True, convert_to_numpy=True, show_progress_bar=False))
+        embedding_store.put_many([text_hashes[index] for index in missing], encoded)
+        # 按缓存的精度取整，使新编码与命中缓存的结果一致
+        cached_vectors.update(zip((text_hashes[index] for index in missing),
+                                  encoded.astype(embedding_store.dtype).astype(np.float32)))
+    embeddings = np.stack([cached_vectors[text_hash] for text_hash in text_hashes])
+    # float16 缓存会带来少量舍入误差，重新归一化后相同文本的相似度仍为 1
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    embeddings = np.divide(embeddings, norms, out=np.zeros_like(embeddings), where=norms > 0)
+    embeddings_1 = embeddings[[text_index[text] for text in answers_one]]
+    embeddings_2 = embeddings[[text_index[text] for text in answers_two]]
+
+    # 向量已归一化，逐行点积即余弦相似度；零向量归一化后仍为零，相似度为 0
+    ass_scores = np.einsum('ij,ij->i', embeddings_1, embeddings_2)
+
+    # 将结果写入DataFrame
+    df.loc[valid_rows, ass_column_name] = ass_scores.astype('float64')
 
     # 计算耗时
     end_time = time.time()
     elapsed_time = end_time - start_time
     hours, minutes, seconds = convert_seconds(elapsed_time)
     print(f'ASS相似度计算完成，共耗时：{hours}小时{minutes}分钟{seconds}秒')
+    print(f"嵌入向量缓存统计: {embedding_store.stats()}")
 
     # 保存修改后的Excel文件
     df.to_excel(input_excel_path, index=False)
 
     print(f"ASS值已计算并保存到原文件: {input_excel_path}")
 
-def excel_rouge(input_excel_path,rouge_index='ROUGE-1'):
+def excel_rouge(input_excel_path,rouge_index='ROUGE-1', token_cache=None):
     """
-    rouge 库在处理中文文本时可能会有一些问题，因为它默认是为英文设计的。
+    rouge 库按空格切词，不适合未分词的中文文本，因此这里先用 jieba 分词，再用内置的 ROUGE 实现（rouge_engine）计算。
     在 ROUGE 评估中，Precision（精确率）、Recall（召回率） 和 F1 Score（F1 分数） 是三个重要的指标，它们分别从不同的角度衡量生成文本与参考文本的相似度。
     Precision（精确率）：精确率反映了生成文本中有多大比例的内容是与参考文本匹配的。
     Recall（召回率）：召回率反映了参考文本中有多少内容被生成文本覆盖。
     F1 Score（F1 分数）：F1 分数是一个综合指标，平衡了精确率和召回率。它既考虑了生成文本的质量，也考虑了生成文本的完整性。
+    结果列写入的是 F1 分数。每个答案只分词一次，多个指标一次算完、一起写入；只计算两列都有答案的行。
+    重叠的 n 元组按两边出现次数的较小值计数，与之前用 rouge 库（按空格切词、n 元组按集合去重）算出的分数不可直接比较。
 
     :param input_excel_path: 输入的Excel文件路径
-    :param rouge_index: 指标，可选项为ROUGE-1、ROUGE-2、ROUGE-L，默认为ROUGE-1
+    :param rouge_index: 指标，可选项为ROUGE-1、ROUGE-2、ROUGE-L，默认为ROUGE-1；也可以是这几项的列表
+    :param token_cache: 任务内共享的 TokenCache，为 None 时单独分词
     """
+    token_cache = token_cache or TokenCache()
+    rouge_indexes = [rouge_index] if isinstance(rouge_index, str) else list(rouge_index)
+    unknown_indexes = [index for index in rouge_indexes if index not in ROUGE_VARIANTS]
+    if unknown_indexes:
+        raise ValueError(f"未知的ROUGE指标: {unknown_indexes}，可选项为 {list(ROUGE_VARIANTS)}")
+    rouge_label = '、'.join(rouge_indexes)
+
     # 读取Excel文件
     df = pd.read_excel(input_excel_path)
 
@@ -644,80 +1072,57 @@ def excel_rouge(input_excel_path,rouge_index='ROUGE-1'):
     if len(df.columns) < 2: # As per excel_ragas, expecting at least two columns for comparison
         raise ValueError("Excel文件中至少需要两列（例如，外部模型响应和内部模型响应）来进行ROUGE评估。")
 
-    # 获取第二列与第三列的内容
-    questions_one = df.iloc[:, 1].dropna().tolist()
-    questions_two = df.iloc[:, 2].dropna().tolist()
-
-    if len(questions_one) != len(questions_two):
-        print("警告: 用于ROUGE评估的两个答案列的长度不匹配。将按较短的列表长度进行处理。")
-        min_len = min(len(questions_one), len(questions_two))
-        questions_one = questions_one[:min_len]
-        questions_two = questions_two[:min_len]
+    # 获取第二列与第三列的内容，某一列为空的行不参与计算
+    valid_rows = df.iloc[:, 1].notna() & df.iloc[:, 2].notna()
+    reference_answers = df.loc[valid_rows, df.columns[1]].astype(str).tolist()
+    generated_answers = df.loc[valid_rows, df.columns[2]].astype(str).tolist()
 
     # 准备结果列
-    if rouge_index not in df.columns:
-        df[rouge_index] = pd.Series(dtype='float64')
+    for index in rouge_indexes:
+        if index not in df.columns:
+            df[index] = pd.Series(dtype='float64')
 
-    questions_len = len(questions_one)
+    questions_len = len(reference_answers)
     if questions_len == 0:
         print("没有可用于ROUGE评估的数据。")
         return
 
-    # 初始化 ROUGE 计算器
-    rouge = Rouge()
-    print('加载ROUGE评估，请耐心等待。。。')
-
+    print(f'进行ROUGE评估 ({rouge_label})，共{questions_len}条数据，请耐心等待。。。')
     start_time = time.time()
-    rouge_scores = []
-    for index in range(questions_len):
-        reference_answer = str(questions_one[index])
-        generated_answer = str(questions_two[index])
+    # 相同的答案只分词一次；去掉空白词
+    def _tokens(text):
+        return [token for token in token_cache.tokenize(text) if token.strip()]
 
-        print(f'进行ROUGE评估 ({rouge_index})，共{questions_len}条数据，计算第{index+1}条，请耐心等待。。。')
+    rouge_results = {index: [] for index in rouge_indexes}
+    for reference_answer, generated_answer in zip(reference_answers, generated_answers):
+        # 空引用或生成答案的得分为0
+        scores = rouge_scores(_tokens(reference_answer), _tokens(generated_answer), rouge_indexes)
+        for index in rouge_indexes:
+            rouge_results[index].append(scores[index])
 
-        # 处理空字符串的情况，rouge库可能无法处理
-        if not reference_answer.strip() or not generated_answer.strip():
-            print(f"警告: 第{index+1}条数据中存在空引用或生成答案，ROUGE得分将为0。")
-            rouge_f1_score = 0.0
-        else:
-            try:
-                scores = rouge.get_scores(generated_answer, reference_answer) # Note: order is hyp, ref
-                if rouge_index == 'ROUGE-1':
-                    rouge_f1_score = scores[0]['rouge-1']['f']
-                elif rouge_index == 'ROUGE-2':
-                    rouge_f1_score = scores[0]['rouge-2']['f']
-                elif rouge_index == 'ROUGE-L':
-                    rouge_f1_score = scores[0]['rouge-l']['f']
-                else:
-                    print(f"未知的ROUGE指标: {rouge_index}。将默认为0。")
-                    rouge_f1_score = 0.0
-            except Exception as e:
-                print(f"计算第{index+1}条数据ROUGE得分时出错: {e}。得分为0。")
-                rouge_f1_score = 0.0
-        
-        rouge_scores.append(rouge_f1_score)
-
-    # 将完整响应写入DataFrame
-    df.loc[df.iloc[:,1].dropna().index[:questions_len], rouge_index] = rouge_scores
+    # 将结果写入DataFrame
+    for index in rouge_indexes:
+        df.loc[valid_rows, index] = rouge_results[index]
 
     # 计算耗时
     end_time = time.time()
     elapsed_time = end_time - start_time
     hours, minutes, seconds_val = convert_seconds(elapsed_time)
-    print(f'ROUGE ({rouge_index})评估完成，共耗时：{hours}小时{minutes}分钟{seconds_val}秒')
+    print(f'ROUGE ({rouge_label})评估完成，共耗时：{hours}小时{minutes}分钟{seconds_val}秒')
 
     # 保存修改后的Excel文件
     df.to_excel(input_excel_path, index=False)
 
-    print(f"ROUGE ({rouge_index})值已计算并保存到原文件: {input_excel_path}")
+    print(f"ROUGE ({rouge_label})值已计算并保存到原文件: {input_excel_path}")
 
-def calculate_f1_chinese(input_excel_path):
+def calculate_f1_chinese(input_excel_path, token_cache=None):
     """
     计算两段中文文本之间的F1值，使用jieba进行分词。
 
     :param input_excel_path: 输入的Excel文件路径
-    :param embedding_model_identifier: 用于ASS评估的嵌入模型的名称、ModelScope ID或本地路径
+    :param token_cache: 任务内共享的 TokenCache，为 None 时单独分词
     """
+    token_cache = token_cache or TokenCache()
     # 读取Excel文件
     df = pd.read_excel(input_excel_path)
 
@@ -754,12 +1159,10 @@ def calculate_f1_chinese(input_excel_path):
 
         print(f'进行F1值评估，共{questions_len}条数据，计算第{index+1}条，请耐心等待。。。')
 
-        # 使用jieba进行分词
+        # 使用jieba进行分词（任务内同一文本只分词一次）
         try:
-            # 添加默认词典，防止jieba未初始化
-            jieba.initialize()
-            reference_tokens = set(jieba.cut(reference_text))
-            generated_tokens = set(jieba.cut(generated_text))
+            reference_tokens = set(token_cache.tokenize(reference_text))
+            generated_tokens = set(token_cache.tokenize(generated_text))
         except Exception as e:
             print(f"Jieba分词失败: {e}。请确保jieba已正确安装。")
             f1_scores.append(0.0)
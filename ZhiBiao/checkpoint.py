@@ -0,0 +1,86 @@
+import hashlib
+import json
+import os
+import threading
+
+# 断点文件默认存放在项目 instance/checkpoints 目录下，可用环境变量 LLM_CHECKPOINT_DIR 覆盖
+DEFAULT_CHECKPOINT_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'instance', 'checkpoints'))
+
+
+def _checkpoint_dir():
+    return os.environ.get('LLM_CHECKPOINT_DIR', DEFAULT_CHECKPOINT_DIR)
+
+def make_checkpoint_path(questions, model_name, url, prompt, tag='', checkpoint_dir=None, sampling_params=None):
+    """
+    根据问题列表和模型配置生成断点文件路径。相同的问题与配置重新提交时得到同一个路径，从而可以续跑。
+
+    :param questions: 问题文本列表（顺序有意义）
+    :param model_name: 模型名称
+    :param url: 模型API URL
+    :param prompt: 系统提示词
+    :param tag: 文件名后缀，用于区分同一任务中的不同模型列（如 'external'、'internal'）
+    :param checkpoint_dir: 断点文件目录，None 时取环境变量 LLM_CHECKPOINT_DIR，未设置时为 DEFAULT_CHECKPOINT_DIR
+    :param sampling_params: 影响回复的请求参数（可选），如思考控制；为空时与不传该参数得到同一个路径
+    :return: 断点文件路径
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps([model_name, (url or '').rstrip('/'), prompt or ''], ensure_ascii=False).encode('utf-8'))
+    if sampling_params:
+        digest.update(json.dumps(sampling_params, ensure_ascii=False, sort_keys=True).encode('utf-8'))
+    for question_text in questions:
+        digest.update(b'\x00')
+        digest.update(str(question_text).encode('utf-8'))
+    file_name = f"{digest.hexdigest()[:24]}_{tag}.jsonl" if tag else f"{digest.hexdigest()[:24]}.jsonl"
+    return os.path.join(checkpoint_dir or _checkpoint_dir(), file_name)
+
+
+class RowCheckpoint:
+    """
+    行级断点文件 (JSON Lines)：每完成一行就追加一条 {"row": 行号, ...} 记录并立即刷盘。
+    进程重启或任务重新提交后，通过 load() 读回已完成的行，只需请求剩余的行。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        checkpoint_dir = os.path.dirname(path)
+        if checkpoint_dir and not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+
+    def load(self):
+        """
+        读取已完成的行。
+
+        :return: dict，行号 -> 该行记录（不含 'row' 键）
+        """
+        completed_rows = {}
+        if not os.path.exists(self.path):
+            return completed_rows
+        with self._lock, open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # 进程在写入中途退出时，最后一行可能不完整，直接跳过
+                    continue
+                row_index = record.pop('row', None)
+                if row_index is not None:
+                    completed_rows[row_index] = record
+        return completed_rows
+
+    def record(self, row_index, **fields):
+        """追加一行的完成记录并刷盘。"""
+        line = json.dumps(dict(row=row_index, **fields), ensure_ascii=False)
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def remove(self):
+        """任务全部完成后删除断点文件。"""
+        with self._lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
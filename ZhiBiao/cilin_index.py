@@ -0,0 +1,205 @@
+"""
+哈工大同义词词林的预编译索引。
+
+F1值（词林扩展）把每个词扩展为：词本身 + 同一行的同义词 + 其各个编码在 1、2、4、5 位前缀下的全部词。
+同一编码的长前缀类、同一行的词都包含在 1 位前缀（大类）中，所以扩展结果等价于
+“词本身 + 其所有编码所属大类的全部词”。索引据此只为每个词保存一个大类位掩码：
+
+- 词表按词排序，词的下标即整数词 ID；
+- masks[词 ID] 为 uint64 位掩码，第 i 位表示该词属于第 i 个大类；
+- 一段文本扩展后的词集 = 掩码之并对应大类的全部词 ∪ 不在词林中的词，
+  两段文本扩展词集的大小和交集大小都可以按掩码直接计数，无需展开集合。
+
+索引文件与 cilin.txt 放在同一目录（cilin.idx），记录源文件的 sha256，源文件变化后自动重建。
+也可以离线预先编译：
+
+    python -m ZhiBiao.cilin_index [cilin.txt路径] [输出路径]
+"""
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import threading
+
+import numpy as np
+
+DEFAULT_CILIN_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cilin.txt')
+_MAGIC = b'CILINIDX'
+_VERSION = 1
+# 魔数、版本、词数、大类数、大类名长度、词表长度、源文件 sha256
+_HEADER = struct.Struct('<8sIIIII32s')
+
+
+def _source_digest(cilin_path):
+    with open(cilin_path, 'rb') as f:
+        return hashlib.sha256(f.read()).digest()
+
+def default_index_path(cilin_path):
+    return os.path.splitext(cilin_path)[0] + '.idx'
+
+
+def parse_cilin(cilin_path):
+    """
+    解析词林文本文件。每行格式为 '编码 词1 词2 ...' 或 '编码=词1 词2 ...'。
+
+    :return: (word_to_codes, processed_lines, malformed_lines)，word_to_codes 为 词 -> {词林编码}
+    """
+    word_to_codes = {}
+    processed_lines = 0
+    malformed_lines = 0
+    with open(cilin_path, 'r', encoding='utf-8') as f:
+        for line_content in f:
+            line_content = line_content.strip()
+            if not line_content:
+                continue
+            parts = line_content.split(None, 1) # 按第一个空格分割
+            if len(parts) < 2:
+                parts = line_content.split('=', 1)
+                if len(parts) < 2:
+                    malformed_lines += 1
+                    continue
+            actual_code = ''.join(filter(str.isalnum, parts[0]))
+            current_line_words = {word for word in parts[1].strip().split() if word}
+            if not actual_code or not current_line_words:
+                malformed_lines += 1
+                continue
+            processed_lines += 1
+            for word in current_line_words:
+                word_to_codes.setdefault(word, set()).add(actual_code)
+    return word_to_codes, processed_lines, malformed_lines
+
+def compile_cilin_index(cilin_path=DEFAULT_CILIN_PATH, index_path=None):
+    """
+    把词林文本编译为二进制索引文件（先写临时文件再替换，读取中的进程不受影响）。
+
+    :param cilin_path: cilin.txt 路径
+    :param index_path: 输出路径，默认与 cilin.txt 同目录的 cilin.idx
+    :return: 索引文件路径
+    """
+    index_path = index_path or default_index_path(cilin_path)
+    word_to_codes, processed_lines, malformed_lines = parse_cilin(cilin_path)
+    groups = sorted({code[0] for codes in word_to_codes.values() for code in codes})
+    if len(groups) > 64:
+        raise ValueError(f"词林大类数 {len(groups)} 超过 64，无法用 uint64 位掩码表示。")
+    group_bits = {group: 1 << bit for bit, group in enumerate(groups)}
+
+    words = sorted(word_to_codes)
+    masks = np.zeros(len(words), dtype='<u8')
+    for word_id, word in enumerate(words):
+        mask = 0
+        for code in word_to_codes[word]:
+            mask |= group_bits[code[0]]
+        masks[word_id] = mask
+
+    groups_blob = '\n'.join(groups).encode('utf-8')
+    words_blob = '\n'.join(words).encode('utf-8')
+    header = _HEADER.pack(_MAGIC, _VERSION, len(words), len(groups), len(groups_blob), len(words_blob), _source_digest(cilin_path))
+    temp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(header)
+        f.write(masks.tobytes())
+        f.write(groups_blob)
+        f.write(words_blob)
+    os.replace(temp_path, index_path)
+    print(f"词林索引编译完毕: {index_path}（{processed_lines} 行有效词条，{len(words)} 个词，{len(groups)} 个大类）。")
+    if malformed_lines > 0:
+        print(f"警告：跳过了 {malformed_lines} 行格式不正确的词条。请检查词林文件格式。")
+    return index_path
+
+
+class CilinIndex:
+    """
+    以 mmap 方式加载的词林索引，只读，可在多个线程间共享。
+    """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        with open(index_path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, word_count, group_count, groups_len, words_len, self.source_digest = _HEADER.unpack_from(self._mmap, 0)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError(f"{index_path} 不是可识别的词林索引文件")
+        offset = _HEADER.size
+        self.masks = np.frombuffer(self._mmap, dtype='<u8', count=word_count, offset=offset)
+        offset += self.masks.nbytes
+        self.groups = self._mmap[offset:offset + groups_len].decode('utf-8').split('\n') if group_count else []
+        offset += groups_len
+        words = self._mmap[offset:offset + words_len].decode('utf-8').split('\n') if word_count else []
+        self.word_ids = {word: word_id for word_id, word in enumerate(words)}
+        # 不同掩码值及其词数，用于按掩码计数扩展词集的大小和交集
+        self._mask_values, counts = np.unique(self.masks, return_counts=True)
+        self._mask_counts = counts.astype(np.int64)
+
+    def __len__(self):
+        return len(self.word_ids)
+
+    def expand(self, tokens):
+        """
+        计算一组词的扩展表示：(大类掩码之并, 不在词林中的词集合)。
+        扩展后的词集 = 掩码内各大类的全部词 ∪ 不在词林中的词。
+        """
+        mask = 0
+        unknown_tokens = set()
+        for token in tokens:
+            word_id = self.word_ids.get(token)
+            if word_id is None:
+                unknown_tokens.add(token)
+            else:
+                mask |= int(self.masks[word_id])
+        return mask, unknown_tokens
+
+    def expanded_size(self, expansion):
+        """扩展词集的大小。"""
+        mask, unknown_tokens = expansion
+        in_groups = (self._mask_values & np.uint64(mask)) != 0
+        return int(self._mask_counts[in_groups].sum()) + len(unknown_tokens)
+
+    def intersection_size(self, expansion_1, expansion_2):
+        """两个扩展词集交集的大小。"""
+        mask_1, unknown_tokens_1 = expansion_1
+        mask_2, unknown_tokens_2 = expansion_2
+        in_both = ((self._mask_values & np.uint64(mask_1)) != 0) & ((self._mask_values & np.uint64(mask_2)) != 0)
+        return int(self._mask_counts[in_both].sum()) + len(unknown_tokens_1 & unknown_tokens_2)
+
+
+# cilin.txt 路径 -> CilinIndex，进程内所有任务共享
+_CILIN_INDEXES = {}
+_CILIN_INDEXES_LOCK = threading.Lock()
+
+def get_cilin_index(cilin_path=DEFAULT_CILIN_PATH):
+    """
+    获取词林索引（线程安全，每个进程只加载一次）。索引文件不存在或与 cilin.txt 不一致时先编译。
+
+    :param cilin_path: cilin.txt 路径
+    :return: CilinIndex；词林文件不存在或加载失败时返回 None
+    """
+    cilin_path = os.path.realpath(cilin_path)
+    with _CILIN_INDEXES_LOCK:
+        index = _CILIN_INDEXES.get(cilin_path)
+        if index is not None:
+            return index
+        try:
+            source_digest = _source_digest(cilin_path)
+            index_path = default_index_path(cilin_path)
+            index = None
+            if os.path.exists(index_path):
+                try:
+                    index = CilinIndex(index_path)
+                except Exception as e:
+                    print(f"词林索引 {index_path} 无法读取，重新编译: {e}")
+            if index is None or index.source_digest != source_digest:
+                index = CilinIndex(compile_cilin_index(cilin_path, index_path))
+        except FileNotFoundError:
+            print(f"错误：词林文件未找到于路径 {cilin_path}")
+            return None
+        except Exception as e:
+            print(f"加载词林索引时发生错误: {e}")
+            return None
+        _CILIN_INDEXES[cilin_path] = index
+        return index
+
+
+if __name__ == '__main__':
+    source_path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_CILIN_PATH
+    compile_cilin_index(source_path, sys.argv[2] if len(sys.argv) > 2 else None)
@@ -0,0 +1,215 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+# 向量文件默认存放在项目 instance 目录下，每个嵌入模型一个子目录
+DEFAULT_CACHE_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'instance', 'embedding_cache'))
+DEFAULT_MAX_ENTRIES = 500000
+DEFAULT_DTYPE = 'float16'
+# SQLite 单条语句的参数个数有上限，按批查询
+_QUERY_BATCH = 500
+
+
+def embedding_text_hash(text):
+    """文本内容的 sha256，作为向量缓存的键。"""
+    return hashlib.sha256(str(text).encode('utf-8')).hexdigest()
+
+
+class EmbeddingStore:
+    """
+    单个嵌入模型的持久化向量缓存，保存归一化后的文本向量。
+
+    - vectors.bin：按行追加的向量矩阵（float16 或 float32），读取时以 np.memmap 映射，不整体载入内存。
+    - index.sqlite3：文本哈希 -> 行号及最近访问时间；meta.json：模型标识、向量维度和数据类型。
+    - 超过 max_entries 条时按最近访问时间保留最新的 90%，并重写向量文件回收空间。
+    - 模型输出维度与已有文件不一致（同一路径换了模型）时清空缓存。
+    - hits / misses 为进程内累计的命中与未命中条数。同一缓存目录只应由一个进程写入。
+    """
+
+    def __init__(self, store_dir, model_key, dtype=DEFAULT_DTYPE, max_entries=DEFAULT_MAX_ENTRIES):
+        self.store_dir = store_dir
+        self.model_key = model_key
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._vectors_path = os.path.join(store_dir, 'vectors.bin')
+        self._meta_path = os.path.join(store_dir, 'meta.json')
+        self._memmap = None
+
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        self._conn = sqlite3.connect(os.path.join(store_dir, 'index.sqlite3'), check_same_thread=False, timeout=30)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS vectors (hash TEXT PRIMARY KEY, row INTEGER, last_access REAL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_vectors_last_access ON vectors (last_access)')
+        self._conn.commit()
+
+        self.dtype = np.dtype(dtype)
+        self.dim = None
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            self.dim = meta.get('dim')
+            self.dtype = np.dtype(meta.get('dtype', dtype))
+        self._rows = self._file_rows()
+        self._entry_count = self._conn.execute('SELECT COUNT(*) FROM vectors').fetchone()[0]
+        if self._entry_count and (self.dim is None or self._conn.execute('SELECT MAX(row) FROM vectors').fetchone()[0] >= self._rows):
+            # 索引与向量文件不一致（如写入中途被中断），重建缓存
+            print(f"嵌入向量缓存 {store_dir} 不完整，已清空。")
+            self._reset(self.dim)
+
+    def _file_rows(self):
+        if not self.dim or not os.path.exists(self._vectors_path):
+            return 0
+        row_bytes = self.dim * self.dtype.itemsize
+        file_bytes = os.path.getsize(self._vectors_path)
+        if file_bytes % row_bytes:
+            # 写入中途被中断留下的不完整行，截掉后才能继续按行追加
+            with open(self._vectors_path, 'r+b') as f:
+                f.truncate(file_bytes - file_bytes % row_bytes)
+        return file_bytes // row_bytes
+
+    def _write_meta(self):
+        with open(self._meta_path, 'w', encoding='utf-8') as f:
+            json.dump({'model': self.model_key, 'dim': self.dim, 'dtype': self.dtype.name}, f, ensure_ascii=False)
+
+    def _reset(self, dim):
+        # 调用方需持有 self._lock（构造时除外）
+        self._memmap = None
+        self._conn.execute('DELETE FROM vectors')
+        self._conn.commit()
+        with open(self._vectors_path, 'wb'):
+            pass
+        self.dim = dim
+        self._rows = 0
+        self._entry_count = 0
+        self._write_meta()
+
+    def _vectors(self):
+        # 向量文件追加后需要重新映射
+        if self._memmap is None or len(self._memmap) != self._rows:
+            self._memmap = np.memmap(self._vectors_path, dtype=self.dtype, mode='r', shape=(self._rows, self.dim)) if self._rows else None
+        return self._memmap
+
+    def get_many(self, text_hashes):
+        """
+        批量查询向量。
+
+        :param text_hashes: embedding_text_hash 的列表
+        :return: dict，命中的哈希 -> float32 向量
+        """
+        text_hashes = list(dict.fromkeys(text_hashes))
+        found = {}
+        with self._lock:
+            if self._entry_count:
+                for start in range(0, len(text_hashes), _QUERY_BATCH):
+                    batch = text_hashes[start:start + _QUERY_BATCH]
+                    placeholders = ','.join('?' * len(batch))
+                    found.update(self._conn.execute(f'SELECT hash, row FROM vectors WHERE hash IN ({placeholders})', batch).fetchall())
+            result = {}
+            if found:
+                vectors = self._vectors()
+                rows = np.fromiter(found.values(), dtype=np.int64, count=len(found))
+                for text_hash, vector in zip(found.keys(), np.asarray(vectors[rows], dtype=np.float32)):
+                    result[text_hash] = vector
+                now = time.time()
+                self._conn.executemany('UPDATE vectors SET last_access = ? WHERE hash = ?', [(now, text_hash) for text_hash in found])
+                self._conn.commit()
+            self.hits += len(result)
+            self.misses += len(text_hashes) - len(result)
+            return result
+
+    def put_many(self, text_hashes, vectors):
+        """
+        批量写入向量（已存在的哈希跳过），必要时触发淘汰。
+
+        :param text_hashes: embedding_text_hash 的列表
+        :param vectors: 与 text_hashes 对应的二维数组
+        """
+        vectors = np.asarray(vectors)
+        if not len(text_hashes):
+            return
+        with self._lock:
+            if self.dim != vectors.shape[1]:
+                if self.dim is not None:
+                    print(f"嵌入向量维度由 {self.dim} 变为 {vectors.shape[1]}，清空缓存 {self.store_dir}。")
+                self._reset(vectors.shape[1])
+            existing = set()
+            for start in range(0, len(text_hashes), _QUERY_BATCH):
+                batch = list(text_hashes[start:start + _QUERY_BATCH])
+                placeholders = ','.join('?' * len(batch))
+                existing.update(row[0] for row in self._conn.execute(f'SELECT hash FROM vectors WHERE hash IN ({placeholders})', batch))
+            new_rows = {}
+            for index, text_hash in enumerate(text_hashes):
+                if text_hash not in existing and text_hash not in new_rows:
+                    new_rows[text_hash] = index
+            if not new_rows:
+                return
+            with open(self._vectors_path, 'ab') as f:
+                f.write(np.ascontiguousarray(vectors[list(new_rows.values())], dtype=self.dtype).tobytes())
+            now = time.time()
+            self._conn.executemany('INSERT INTO vectors (hash, row, last_access) VALUES (?, ?, ?)',
+                                   [(text_hash, self._rows + offset, now) for offset, text_hash in enumerate(new_rows)])
+            self._conn.commit()
+            self._rows += len(new_rows)
+            self._entry_count += len(new_rows)
+            if self.max_entries and self._entry_count > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        # 调用方需持有 self._lock；保留最近访问的 90%，按新顺序重写向量文件
+        target = int(self.max_entries * 0.9)
+        kept = self._conn.execute('SELECT hash, row, last_access FROM vectors ORDER BY last_access DESC LIMIT ?', (target,)).fetchall()
+        kept_vectors = np.array(self._vectors()[[row for _, row, _ in kept]], dtype=self.dtype)
+        self._memmap = None
+        temp_path = self._vectors_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(kept_vectors.tobytes())
+        os.replace(temp_path, self._vectors_path)
+        self._conn.execute('DELETE FROM vectors')
+        self._conn.executemany('INSERT INTO vectors (hash, row, last_access) VALUES (?, ?, ?)',
+                               [(text_hash, new_row, last_access) for new_row, (text_hash, _, last_access) in enumerate(kept)])
+        self._conn.commit()
+        self._rows = len(kept)
+        self._entry_count = len(kept)
+
+    def stats(self):
+        """返回缓存的命中统计、当前条目数和向量文件大小。"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 4) if total else 0.0,
+                'entries': self._entry_count,
+                'max_entries': self.max_entries,
+                'dim': self.dim,
+                'dtype': self.dtype.name,
+                'file_bytes': os.path.getsize(self._vectors_path) if os.path.exists(self._vectors_path) else 0,
+            }
+
+
+# 模型标识 -> EmbeddingStore，进程内所有任务共享
+_EMBEDDING_STORES = {}
+_EMBEDDING_STORES_LOCK = threading.Lock()
+
+def get_embedding_store(model_key):
+    """
+    获取指定嵌入模型（解析后的模型路径或模型名）的共享向量缓存，不存在时创建。
+    缓存目录、条数上限和数据类型可用环境变量 EMBEDDING_CACHE_DIR、EMBEDDING_CACHE_MAX_ENTRIES、EMBEDDING_CACHE_DTYPE 覆盖。
+    """
+    with _EMBEDDING_STORES_LOCK:
+        store = _EMBEDDING_STORES.get(model_key)
+        if store is None:
+            cache_dir = os.environ.get('EMBEDDING_CACHE_DIR', DEFAULT_CACHE_DIR)
+            store_dir = os.path.join(cache_dir, hashlib.sha256(model_key.encode('utf-8')).hexdigest()[:16])
+            store = EmbeddingStore(store_dir, model_key,
+                                   dtype=os.environ.get('EMBEDDING_CACHE_DTYPE', DEFAULT_DTYPE),
+                                   max_entries=int(os.environ.get('EMBEDDING_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES)))
+            _EMBEDDING_STORES[model_key] = store
+        return store
@@ -0,0 +1,180 @@
+import gc
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# 进程内缓存的嵌入模型总内存上限（MB），可用环境变量 EMBEDDING_MODEL_CACHE_MB 覆盖
+DEFAULT_MEMORY_BUDGET_MB = 2048
+
+
+def estimate_model_bytes(model):
+    """
+    估算模型权重占用的内存：累加 torch 模块所有参数和缓冲区的字节数。
+    不是 torch 模块或统计失败时返回 0。
+    """
+    try:
+        tensors = list(model.parameters()) + list(model.buffers())
+        return int(sum(tensor.numel() * tensor.element_size() for tensor in tensors))
+    except Exception:
+        return 0
+
+
+class _CachedModel:
+    def __init__(self, key, model, model_bytes, load_seconds):
+        self.key = key
+        self.model = model
+        self.model_bytes = model_bytes
+        self.load_seconds = load_seconds
+        self.loaded_at = time.time()
+        self.last_used = self.loaded_at
+        self.hits = 0
+
+
+class EmbeddingModelCache:
+    """
+    进程内共享的嵌入模型缓存，按解析后的模型路径（或模型名）缓存已加载的模型。
+
+    - 同一模型并发请求时只加载一次，其他线程等待加载完成后直接复用；不同模型可以并行加载。
+    - 已加载模型的权重总大小超过 memory_budget_bytes 时按最近使用时间淘汰 (LRU)，
+      刚加载的模型即使单独超出预算也会保留。被淘汰的模型在正在使用它的任务结束后释放。
+    - remember() / resolve() 记录请求的模型名到缓存键的解析结果，命中时不再解析路径或访问 ModelScope。
+    - stats() 返回已加载的模型及其大小、加载耗时和命中次数。
+    """
+
+    def __init__(self, memory_budget_bytes=DEFAULT_MEMORY_BUDGET_MB * 1024 * 1024):
+        self.memory_budget_bytes = memory_budget_bytes
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._models = OrderedDict()
+        self._load_locks = {}
+        # 请求的模型名或路径 -> (缓存键, 失效时间)，失效时间为 None 表示一直有效
+        self._aliases = {}
+
+    def get_or_load(self, key, loader):
+        """
+        返回 key 对应的已加载模型，未加载时调用 loader() 加载并缓存。
+
+        :param key: 缓存键，通常为解析后的模型路径
+        :param loader: 无参函数，返回加载好的模型
+        :return: 模型实例
+        """
+        with self._lock:
+            cached = self._touch(key)
+            if cached is not None:
+                return cached.model
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        with load_lock:
+            # 等待期间其他线程可能已经加载完成
+            with self._lock:
+                cached = self._touch(key)
+                if cached is not None:
+                    return cached.model
+            start_time = time.perf_counter()
+            model = loader()
+            load_seconds = time.perf_counter() - start_time
+            model_bytes = estimate_model_bytes(model)
+            with self._lock:
+                self._models[key] = _CachedModel(key, model, model_bytes, load_seconds)
+                self._load_locks.pop(key, None)
+                evicted = self._evict()
+            print(f"嵌入模型 {key} 加载完成，耗时 {load_seconds:.2f} 秒，约 {model_bytes / 1024 / 1024:.0f} MB。")
+            if evicted:
+                print(f"嵌入模型缓存超出内存上限，已淘汰: {', '.join(evicted)}")
+                gc.collect()
+            return model
+
+    def resolve(self, name):
+        """
+        返回 remember() 记下的模型名或路径对应的缓存键，没有记录或记录已失效时返回 None。
+
+        :param name: 请求的模型名、ModelScope ID 或路径
+        :return: 缓存键或 None
+        """
+        with self._lock:
+            alias = self._aliases.get(name)
+            if alias is None:
+                return None
+            key, expires_at = alias
+            if expires_at is not None and time.time() >= expires_at:
+                del self._aliases[name]
+                return None
+            return key
+
+    def remember(self, name, key, ttl_seconds=None):
+        """
+        记下请求的模型名或路径解析后的缓存键，之后的任务可以跳过路径解析和下载直接查缓存。
+
+        :param name: 请求的模型名、ModelScope ID 或路径
+        :param key: 解析后的缓存键（模型路径，或改用后备模型时的后备模型名）
+        :param ttl_seconds: 记录的有效秒数，None 表示一直有效；下载失败改用后备模型时设置，到期后重新尝试下载
+        """
+        with self._lock:
+            self._aliases[name] = (key, time.time() + ttl_seconds if ttl_seconds is not None else None)
+
+    def forget(self, name):
+        """删除模型名或路径的解析记录。"""
+        with self._lock:
+            self._aliases.pop(name, None)
+
+    def _touch(self, key):
+        # 调用方需持有 self._lock
+        cached = self._models.get(key)
+        if cached is not None:
+            cached.hits += 1
+            cached.last_used = time.time()
+            self._models.move_to_end(key)
+        return cached
+
+    def _evict(self):
+        # 调用方需持有 self._lock；最近加载的模型在末尾，始终保留
+        evicted = []
+        while len(self._models) > 1 and self._total_bytes() > self.memory_budget_bytes:
+            key, _ = self._models.popitem(last=False)
+            evicted.append(key)
+            self.evictions += 1
+        return evicted
+
+    def _total_bytes(self):
+        return sum(cached.model_bytes for cached in self._models.values())
+
+    def stats(self):
+        """
+        返回缓存统计：内存上限、已用内存、淘汰次数、模型名的解析记录，以及各模型（按最近使用时间从旧到新）的
+        大小、加载耗时、加载时间、最近使用时间和命中次数。
+        """
+        with self._lock:
+            return {
+                'memory_budget_bytes': self.memory_budget_bytes,
+                'total_bytes': self._total_bytes(),
+                'evictions': self.evictions,
+                'aliases': {name: key for name, (key, _) in self._aliases.items()},
+                'models': [{
+                    'key': cached.key,
+                    'bytes': cached.model_bytes,
+                    'load_seconds': round(cached.load_seconds, 3),
+                    'loaded_at': cached.loaded_at,
+                    'last_used': cached.last_used,
+                    'hits': cached.hits,
+                } for cached in self._models.values()],
+            }
+
+    def clear(self):
+        """释放所有已缓存的模型。"""
+        with self._lock:
+            self._models.clear()
+        gc.collect()
+
+
+_EMBEDDING_MODEL_CACHE = None
+_EMBEDDING_MODEL_CACHE_LOCK = threading.Lock()
+
+def get_embedding_model_cache():
+    """获取进程内共享的嵌入模型缓存实例。"""
+    global _EMBEDDING_MODEL_CACHE
+    with _EMBEDDING_MODEL_CACHE_LOCK:
+        if _EMBEDDING_MODEL_CACHE is None:
+            budget_mb = float(os.environ.get('EMBEDDING_MODEL_CACHE_MB', DEFAULT_MEMORY_BUDGET_MB))
+            _EMBEDDING_MODEL_CACHE = EmbeddingModelCache(int(budget_mb * 1024 * 1024))
+        return _EMBEDDING_MODEL_CACHE
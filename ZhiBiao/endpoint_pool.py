@@ -0,0 +1,236 @@
+import random
+import re
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from ZhiBiao.request_policy import RequestCancelledError, get_error_status_code
+
+# 副本连续失败达到该次数后暂时剔除
+DEFAULT_FAILURE_THRESHOLD = 3
+# 首次剔除的时长（秒）；剔除到期后再次失败时时长加倍，最长 DEFAULT_MAX_EJECTION_SECONDS
+DEFAULT_EJECTION_SECONDS = 30.0
+DEFAULT_MAX_EJECTION_SECONDS = 300.0
+
+
+def normalize_endpoint_urls(urls):
+    """
+    把模型配置中的 url 统一为地址列表。支持单个地址、用逗号/分号/空白分隔的多个地址，或地址列表；
+    去掉空项和重复项，保留填写顺序。
+
+    :param urls: str 或 list
+    :return: list[str]
+    """
+    if not urls:
+        return []
+    if isinstance(urls, str):
+        urls = re.split(r'[,;，；\s]+', urls)
+    normalized = []
+    for url in urls:
+        url = str(url).strip()
+        if url and url not in normalized:
+            normalized.append(url)
+    return normalized
+
+def endpoint_pool_key(urls):
+    """
+    逻辑模型的标识：各副本地址用逗号连接。只有一个地址时就是该地址本身，
+    因此单地址配置的响应缓存、断点文件和并发上限与之前保持一致。
+    """
+    return ','.join(normalize_endpoint_urls(urls))
+
+
+def _is_replica_failure(error):
+    """连接失败、超时和 5xx 说明副本本身有问题；4xx（参数、鉴权等）和被取消的对冲请求不计入。"""
+    if isinstance(error, RequestCancelledError):
+        return False
+    status_code = get_error_status_code(error)
+    return status_code is None or status_code >= 500
+
+
+class _Replica:
+    def __init__(self, url, window):
+        self.url = url
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.ejection_seconds = 0.0
+        self.latencies = deque(maxlen=window)
+
+
+class EndpointPool:
+    """
+    同一逻辑模型的多个副本端点。
+
+    - 路由：在未被剔除的副本中选择在途请求最少的一个，相同时按填写顺序。
+    - 剔除：副本连续失败 failure_threshold 次后剔除 ejection_seconds 秒；到期后重新参与路由，
+      若再次失败立即重新剔除且时长加倍（最长 max_ejection_seconds），成功一次即恢复正常。
+      所有副本都被剔除时选择最早到期的副本，保证请求不会因此停住。
+    - 重试：经 call_with_replicas 发出的请求遇到 429/5xx 时换一个副本重试，每次失败都计入副本的连续失败次数。
+    - 统计：每个副本记录请求数、失败数、剔除次数和最近 window 次成功请求的总耗时。
+    """
+
+    def __init__(self, urls, failure_threshold=DEFAULT_FAILURE_THRESHOLD, ejection_seconds=DEFAULT_EJECTION_SECONDS,
+                 max_ejection_seconds=DEFAULT_MAX_EJECTION_SECONDS, window=1000):
+        urls = normalize_endpoint_urls(urls)
+        if not urls:
+            raise ValueError("模型API URL不能为空")
+        self.failure_threshold = failure_threshold
+        self.base_ejection_seconds = ejection_seconds
+        self.max_ejection_seconds = max_ejection_seconds
+        self._lock = threading.Lock()
+        self._replicas = [_Replica(url, window) for url in urls]
+        self._replicas_by_url = {replica.url: replica for replica in self._replicas}
+
+    @property
+    def urls(self):
+        return [replica.url for replica in self._replicas]
+
+    def acquire(self, exclude=None):
+        """
+        选择一个副本并把它的在途请求数加一。调用方完成请求后必须调用 release。
+
+        :param exclude: 优先避开的副本地址集合（如本次请求已失败过的副本）；没有其他可用副本时仍可能选中
+        :return: 副本地址
+        """
+        with self._lock:
+            now = time.monotonic()
+            available = [replica for replica in self._replicas if replica.ejected_until <= now]
+            if exclude:
+                available = [replica for replica in available if replica.url not in exclude] or available
+            if available:
+                replica = min(available, key=lambda r: r.outstanding)
+            else:
+                replica = min(self._replicas, key=lambda r: r.ejected_until)
+            replica.outstanding += 1
+            replica.requests += 1
+            return replica.url
+
+    def release(self, url, latency=None, error=None):
+        """
+        归还副本并记录本次请求的结果。
+
+        :param url: acquire 返回的副本地址
+        :param latency: 成功请求的总耗时（秒）
+        :param error: 请求失败时的异常；为 None 表示成功
+        """
+        with self._lock:
+            replica = self._replicas_by_url[url]
+            replica.outstanding = max(0, replica.outstanding - 1)
+            if error is None:
+                replica.consecutive_failures = 0
+                replica.ejection_seconds = 0.0
+                if latency is not None:
+                    replica.latencies.append(latency)
+                return
+            if not _is_replica_failure(error):
+                return
+            replica.failures += 1
+            replica.consecutive_failures += 1
+            # 只有一个副本时剔除没有意义；已在剔除中的副本，剔除前发出的请求陆续失败不再延长剔除
+            if len(self._replicas) < 2 or replica.ejected_until > time.monotonic():
+                return
+            # 刚从剔除中恢复的副本（ejection_seconds 仍保留）一次失败就重新剔除
+            if replica.consecutive_failures >= self.failure_threshold or replica.ejection_seconds:
+                if replica.ejection_seconds:
+                    replica.ejection_seconds = min(self.max_ejection_seconds, replica.ejection_seconds * 2)
+                else:
+                    replica.ejection_seconds = self.base_ejection_seconds
+                replica.ejected_until = time.monotonic() + replica.ejection_seconds
+                replica.consecutive_failures = 0
+                replica.ejections += 1
+                print(f"模型副本 {url} 连续失败，暂时剔除 {replica.ejection_seconds:.0f} 秒（{error}）。")
+
+    def stats(self):
+        """
+        返回各副本的统计：请求数、失败数、剔除次数、当前在途请求数、是否处于剔除中，以及成功请求总耗时的 P50/P95。
+
+        :return: dict，副本地址 -> 统计字典
+        """
+        with self._lock:
+            now = time.monotonic()
+            snapshot = [(replica.url, replica.requests, replica.failures, replica.ejections, replica.outstanding,
+                         replica.ejected_until > now, list(replica.latencies)) for replica in self._replicas]
+        stats = {}
+        for url, requests, failures, ejections, outstanding, ejected, latencies in snapshot:
+            stats[url] = {
+                'requests': requests,
+                'failures': failures,
+                'ejections': ejections,
+                'outstanding': outstanding,
+                'ejected': ejected,
+                'latency_p50': float(np.percentile(latencies, 50)) if latencies else None,
+                'latency_p95': float(np.percentile(latencies, 95)) if latencies else None,
+            }
+        return stats
+
+
+def _is_server_error(error):
+    status_code = get_error_status_code(error)
+    return status_code is not None and (status_code == 429 or status_code >= 500)
+
+def call_with_replicas(endpoint_pool, request_func, get_latency=None, max_retries=6, base_backoff=1.0, max_backoff=60.0,
+                       label=''):
+    """
+    在副本池上执行一次请求：每次尝试都重新选择副本，并把结果报告给副本池。
+
+    - 只有一个副本时调用 request_func(副本地址, max_retries)，429/5xx 由 request_func 内部
+      （rate_limiter.call_with_rate_limit）在该副本上退避重试。
+    - 有多个副本时调用 request_func(副本地址, 0)，每个副本只尝试一次：遇到 429/5xx 时把失败报告给副本池
+      （连续失败的副本会被剔除），换一个本次还没失败过的副本重试；可用副本都失败过时先按指数退避等待。
+    - 其余错误（4xx、超时、连接失败等）报告给副本池后直接抛出，由调用方（如 call_with_row_retries）处理。
+
+    :param endpoint_pool: EndpointPool
+    :param request_func: request_func(副本地址, 429/5xx 时在该副本上的重试次数) -> 结果
+    :param get_latency: 从结果中取出总耗时（秒）的函数（可选），用于副本的延迟统计
+    :param max_retries: 429/5xx 后的最大重试次数
+    :param base_backoff: 初始退避秒数
+    :param max_backoff: 单次退避的最大秒数
+    :param label: 日志中显示的请求说明
+    :return: request_func 的返回值
+    """
+    single_replica = len(endpoint_pool.urls) < 2
+    failed_urls = set()
+    for attempt in range(max_retries + 1):
+        replica_url = endpoint_pool.acquire(exclude=failed_urls)
+        if replica_url in failed_urls:
+            # 没有其他可用副本，退避后在已失败过的副本上重试
+            backoff = min(max_backoff, base_backoff * (2 ** (attempt - 1)))
+            time.sleep(random.uniform(backoff / 2, backoff))
+        try:
+            result = request_func(replica_url, max_retries if single_replica else 0)
+        except Exception as e:
+            endpoint_pool.release(replica_url, error=e)
+            if single_replica or attempt >= max_retries or not _is_server_error(e):
+                raise
+            failed_urls.add(replica_url)
+            print(f"{label}副本 {replica_url} 请求失败（{e}），换用其他副本进行第{attempt + 1}次重试。")
+            continue
+        endpoint_pool.release(replica_url, latency=get_latency(result) if get_latency else None)
+        return result
+
+
+# (逻辑模型标识, 模型名) -> EndpointPool，进程内所有任务共享，剔除状态和延迟统计跨任务保留
+_ENDPOINT_POOLS = {}
+_ENDPOINT_POOLS_LOCK = threading.Lock()
+
+def get_endpoint_pool(urls, model_name):
+    """
+    获取指定副本地址列表和模型的共享副本池，不存在时创建。
+
+    :param urls: 单个地址、逗号分隔的多个地址或地址列表
+    :param model_name: 模型名称
+    :return: EndpointPool
+    """
+    pool_key = (endpoint_pool_key(urls), model_name)
+    with _ENDPOINT_POOLS_LOCK:
+        pool = _ENDPOINT_POOLS.get(pool_key)
+        if pool is None:
+            pool = EndpointPool(urls)
+            _ENDPOINT_POOLS[pool_key] = pool
+        return pool
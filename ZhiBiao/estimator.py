@@ -0,0 +1,226 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from ZhiBiao.rate_limiter import estimate_tokens
+from ZhiBiao.endpoint_pool import endpoint_pool_key
+
+try:
+    import tiktoken
+except ImportError:  # 可选依赖，没有安装时使用 estimate_tokens 粗略估算
+    tiktoken = None
+
+# 历史运行记录默认存放在项目 instance 目录下，每个模型每次运行一行 (JSON Lines)
+DEFAULT_HISTORY_PATH = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'instance', 'run_history.jsonl'))
+# 估算时每个模型最多参考最近的几次运行
+HISTORY_WINDOW = 10
+# 没有历史记录时每个请求的输出token数：功能1为完整回答，功能4为评测分数
+DEFAULT_OUTPUT_TOKENS = {'function1': 300, 'function4': 8}
+
+_HISTORY_LOCK = threading.Lock()
+_ENCODER = None
+_ENCODER_LOCK = threading.Lock()
+
+
+def _history_path():
+    return os.environ.get('LLM_RUN_HISTORY_PATH', DEFAULT_HISTORY_PATH)
+
+def _get_encoder():
+    """加载 tiktoken 编码器（cl100k_base），未安装或加载失败时返回 None。"""
+    global _ENCODER
+    if tiktoken is None:
+        return None
+    with _ENCODER_LOCK:
+        if _ENCODER is None:
+            try:
+                _ENCODER = tiktoken.get_encoding('cl100k_base')
+            except Exception as e:
+                print(f"加载 tiktoken 编码失败，改用粗略估算: {e}")
+                _ENCODER = False
+        return _ENCODER or None
+
+def count_tokens(text):
+    """
+    统计文本的token数：安装了 tiktoken 时按 cl100k_base 编码计数，否则使用 estimate_tokens 粗略估算。
+    不同模型的分词器不同，结果只用于估算。
+    """
+    encoder = _get_encoder()
+    if encoder is None:
+        return estimate_tokens(text)
+    return len(encoder.encode(str(text or ''), disallowed_special=()))
+
+
+def record_model_run(pipeline, model_name, url, concurrency, requests, latency_p50, first_token_p50=None, output_tokens_p50=None):
+    """
+    追加一条模型运行记录，供之后的任务估算耗时。没有实际请求（如全部命中缓存）时不记录。
+
+    :param pipeline: 'function1' 或 'function4'
+    :param model_name: 模型名称
+    :param url: 模型API URL（多副本时为地址列表或逗号分隔的字符串）
+    :param concurrency: 本次运行的并发请求数
+    :param requests: 实际发出的请求数
+    :param latency_p50: 单个请求总耗时的中位数（秒）
+    :param first_token_p50: 首token时间的中位数（秒，可选）
+    :param output_tokens_p50: 每个请求输出token数的中位数（可选）
+    """
+    if not requests or latency_p50 is None:
+        return
+    record = {
+        'time': time.time(),
+        'pipeline': pipeline,
+        'model': model_name,
+        'url': endpoint_pool_key(url).rstrip('/'),
+        'concurrency': concurrency,
+        'requests': requests,
+        'latency_p50': latency_p50,
+        'first_token_p50': first_token_p50,
+        'output_tokens_p50': output_tokens_p50,
+    }
+    history_path = _history_path()
+    with _HISTORY_LOCK:
+        history_dir = os.path.dirname(history_path)
+        if history_dir and not os.path.exists(history_dir):
+            os.makedirs(history_dir)
+        with open(history_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+def summarize_model_history(pipeline, model_name, url):
+    """
+    汇总某个模型最近 HISTORY_WINDOW 次运行的记录（按请求数加权平均）。
+    优先使用同一地址的记录，没有时使用同名模型在其他地址上的记录。
+
+    :return: dict {'runs', 'latency', 'first_token', 'output_tokens'}，没有任何记录时返回 None
+    """
+    history_path = _history_path()
+    if not os.path.exists(history_path):
+        return None
+    url = endpoint_pool_key(url).rstrip('/')
+    same_endpoint, same_model = [], []
+    with _HISTORY_LOCK, open(history_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get('pipeline') != pipeline or record.get('model') != model_name:
+                continue
+            (same_endpoint if record.get('url') == url else same_model).append(record)
+    records = (same_endpoint or same_model)[-HISTORY_WINDOW:]
+    if not records:
+        return None
+
+    def _weighted_mean(field):
+        pairs = [(record[field], record['requests']) for record in records if record.get(field) is not None]
+        if not pairs:
+            return None
+        values, weights = zip(*pairs)
+        return float(np.average(values, weights=weights))
+
+    return {
+        'runs': len(records),
+        'latency': _weighted_mean('latency_p50'),
+        'first_token': _weighted_mean('first_token_p50'),
+        'output_tokens': _weighted_mean('output_tokens_p50'),
+    }
+
+
+def _estimate_model(pipeline, model_name, url, requests, input_tokens, concurrency, rpm=None, tpm=None):
+    """按历史单请求耗时和并发数估算一个模型的耗时，并考虑 rpm / tpm 限制。"""
+    history = summarize_model_history(pipeline, model_name, url)
+    output_tokens_per_request = (history or {}).get('output_tokens') or DEFAULT_OUTPUT_TOKENS[pipeline]
+    output_tokens = int(round(requests * output_tokens_per_request))
+    estimate = {
+        'model': model_name,
+        'requests': requests,
+        'input_tokens': input_tokens,
+        'output_tokens': output_tokens,
+        'history_runs': history['runs'] if history else 0,
+        'latency_per_request': history['latency'] if history else None,
+        'first_token': history['first_token'] if history else None,
+        'seconds': None,
+        'limited_by': None,
+    }
+    if not history or history['latency'] is None:
+        return estimate
+
+    bounds = {'concurrency': requests * history['latency'] / max(1, concurrency or 1)}
+    if rpm:
+        bounds['rpm'] = requests / rpm * 60
+    if tpm:
+        bounds['tpm'] = (input_tokens + output_tokens) / tpm * 60
+    estimate['limited_by'] = max(bounds, key=bounds.get)
+    estimate['seconds'] = bounds[estimate['limited_by']]
+    return estimate
+
+def _combine_estimates(models, tokenizer_name):
+    """汇总各模型的估算；各模型并行请求，总耗时取最长的一个，有模型缺少历史记录时总耗时为 None。"""
+    seconds = [model_estimate['seconds'] for model_estimate in models.values()]
+    return {
+        'requests': sum(model_estimate['requests'] for model_estimate in models.values()),
+        'input_tokens': sum(model_estimate['input_tokens'] for model_estimate in models.values()),
+        'output_tokens': sum(model_estimate['output_tokens'] for model_estimate in models.values()),
+        'wall_seconds': max(seconds) if seconds and None not in seconds else None,
+        'tokenizer': tokenizer_name,
+        'models': models,
+    }
+
+
+def estimate_function1_task(questions_excel_path, prompt, external_model_config, internal_model_config):
+    """
+    功能1任务的预估：读取问题列，统计两个模型的请求数和输入token数（系统提示词 + 问题），
+    结合历史运行记录估算输出token数和耗时。不计入响应缓存和断点命中，结果是上限。
+
+    :return: dict {'requests', 'input_tokens', 'output_tokens', 'wall_seconds', 'tokenizer', 'models'}；
+             models 为 'External_Model' / 'Internal_Model' -> 单个模型的估算
+    """
+    from ZhiBiao.achieve import question_dedupe_key
+
+    df_questions = pd.read_excel(questions_excel_path)
+    questions = df_questions.iloc[:, 0].dropna().tolist() if len(df_questions.columns) else []
+    question_tokens = [count_tokens(question_text) for question_text in questions]
+    prompt_tokens = count_tokens(prompt) if prompt else 0
+
+    models = {}
+    for column_prefix, model_config in (('External_Model', external_model_config), ('Internal_Model', internal_model_config)):
+        token_counts = question_tokens
+        if model_config.get('dedupe'):
+            unique_rows = {}
+            for row_index, question_text in enumerate(questions):
+                unique_rows.setdefault(question_dedupe_key(question_text), row_index)
+            token_counts = [question_tokens[row_index] for row_index in unique_rows.values()]
+        models[column_prefix] = _estimate_model(
+            'function1', model_config.get('name'), model_config.get('url'), len(token_counts),
+            sum(token_counts) + prompt_tokens * len(token_counts),
+            model_config.get('concurrency', 1), model_config.get('rpm'), model_config.get('tpm'))
+    return _combine_estimates(models, 'tiktoken' if _get_encoder() else 'estimate')
+
+def estimate_function4_task(input_excel_path, criteria, model_name, url, concurrency, combined=False, rpm=None, tpm=None):
+    """
+    功能4任务的预估：按编译后的评测模板统计每个 (行, 评测项) 请求的输入token数，
+    合并评测时每行只计一次请求（不计退回单项请求）。不计入响应缓存命中，结果是上限。
+
+    :param criteria: 评测项列表，每项为 {'name', 'prompt'}
+    :return: 同 estimate_function1_task，models 中只有 'Judge_Model'
+    """
+    from TQ.tools import build_combined_prompt, compile_prompt_template
+
+    df = pd.read_excel(input_excel_path)
+    if len(df.columns) < 2:
+        raise ValueError("Excel 文件中列数不足，请确保至少有两列。")
+    # 问答内容的token数每行只算一次，模板的固定部分（系统消息和用户消息中除占位符外的文字）每个模板只算一次
+    row_tokens = [count_tokens(question) + count_tokens(answer)
+                  for question, answer in zip(df.iloc[:, 0].tolist(), df.iloc[:, 1].tolist())]
+    templates = [build_combined_prompt(criteria)] if combined and len(criteria) > 1 else [criterion['prompt'] for criterion in criteria]
+    template_tokens = 0
+    for template in templates:
+        system_prompt, user_template = compile_prompt_template(template)
+        template_tokens += (count_tokens(system_prompt) if system_prompt else 0) + count_tokens(
+            user_template.replace('text1', '').replace('text2', ''))
+    requests = len(row_tokens) * len(templates)
+    input_tokens = sum(row_tokens) * len(templates) + template_tokens * len(row_tokens)
+    models = {'Judge_Model': _estimate_model('function4', model_name, url, requests, input_tokens, concurrency, rpm, tpm)}
+    return _combine_estimates(models, 'tiktoken' if _get_encoder() else 'estimate')
@@ -0,0 +1,60 @@
+import threading
+
+import httpx
+import requests
+from openai import OpenAI, DefaultHttpxClient
+from requests.adapters import HTTPAdapter
+
+# 每个端点连接池大小的下限；并发请求数更大时按并发数扩大连接池，否则多余的请求会排队等待空闲连接
+DEFAULT_MAX_CONNECTIONS = 64
+# 空闲连接保活秒数，同一端点在此时间内的后续任务可直接复用已建立的 TCP/TLS 连接
+DEFAULT_KEEPALIVE_EXPIRY = 120.0
+
+
+# (url, key) -> [连接池上限, OpenAI 客户端]，进程内所有任务共享
+_OPENAI_CLIENTS = {}
+_OPENAI_CLIENTS_LOCK = threading.Lock()
+
+def get_openai_client(url, key, max_connections=DEFAULT_MAX_CONNECTIONS):
+    """
+    获取指定 (url, key) 的共享 OpenAI 客户端，不存在时创建。
+    客户端底层使用带保活连接池的 httpx 客户端，连接建立和TLS握手每个端点只需进行一次。
+    重试由 rate_limiter.call_with_rate_limit 统一处理，因此客户端自身不重试 (max_retries=0)。
+    连接池上限取各次请求的 max_connections 与 DEFAULT_MAX_CONNECTIONS 中的最大值：请求的上限更大时
+    换成一个连接池更大的新客户端，旧客户端上的在途请求照常完成。调用方传入该端点的并发上限即可，
+    同一端点的在途请求数由端点信号量限制在各任务并发上限的最大值以内。
+
+    :param url: 模型API URL
+    :param key: API密钥
+    :param max_connections: 需要的连接池上限，通常为该端点的并发请求数
+    :return: OpenAI
+    """
+    client_key = ((url or '').rstrip('/'), key)
+    max_connections = max(DEFAULT_MAX_CONNECTIONS, int(max_connections or 0))
+    with _OPENAI_CLIENTS_LOCK:
+        entry = _OPENAI_CLIENTS.get(client_key)
+        if entry is None or max_connections > entry[0]:
+            http_client = DefaultHttpxClient(limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=DEFAULT_KEEPALIVE_EXPIRY
+            ))
+            entry = [max_connections, OpenAI(api_key=key, base_url=url, max_retries=0, http_client=http_client)]
+            _OPENAI_CLIENTS[client_key] = entry
+        return entry[1]
+
+
+_HTTP_SESSION = None
+_HTTP_SESSION_LOCK = threading.Lock()
+
+def get_http_session():
+    """获取进程内共享的 requests.Session（带连接池），用于连接测试等直接HTTP请求。"""
+    global _HTTP_SESSION
+    with _HTTP_SESSION_LOCK:
+        if _HTTP_SESSION is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=DEFAULT_MAX_CONNECTIONS)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _HTTP_SESSION = session
+        return _HTTP_SESSION
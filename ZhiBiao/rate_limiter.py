@@ -0,0 +1,254 @@
+import random
+import re
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+
+def estimate_tokens(text):
+    """
+    粗略估算文本的token数：中日韩字符按1个token计，其余字符按每4个字符1个token计。
+
+    :param text: 待估算的文本
+    :return: 估算的token数（至少为1）
+    """
+    if not text:
+        return 1
+    text = str(text)
+    cjk_count = len(re.findall(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]', text))
+    other_count = len(text) - cjk_count
+    return max(1, cjk_count + (other_count + 3) // 4)
+
+
+class AdaptiveRateLimiter:
+    """
+    单个模型端点 (base_url, model) 的令牌桶限流器。
+
+    - 请求桶按 rpm (每分钟请求数) 补充，token桶按 tpm (每分钟token数) 补充。
+    - 收到 429 时遵守 Retry-After 暂停发送，并将发送速率减半；之后每次成功请求逐步恢复速率 (AIMD)。
+    - 未配置 rpm 时，首次被限流会以最近一分钟实际发送的请求数作为 rpm 基准，再按上述规则自适应。
+    """
+
+    def __init__(self, rpm=None, tpm=None, min_rate_factor=0.05, recovery_step=0.02):
+        self.rpm = rpm if rpm and rpm > 0 else None
+        self.tpm = tpm if tpm and tpm > 0 else None
+        self.min_rate_factor = min_rate_factor
+        self.recovery_step = recovery_step
+
+        self._lock = threading.Lock()
+        self._rate_factor = 1.0
+        self._request_tokens = self._request_capacity()
+        self._token_tokens = self._token_capacity()
+        self._last_refill = time.monotonic()
+        self._blocked_until = 0.0
+        self._recent_sends = deque()
+
+        self.throttled_count = 0
+        self.server_error_count = 0
+
+    def update_limits(self, rpm=None, tpm=None):
+        """更新配置的限额（同一端点被新任务以不同限额使用时调用）。"""
+        with self._lock:
+            self.rpm = rpm if rpm and rpm > 0 else self.rpm
+            self.tpm = tpm if tpm and tpm > 0 else self.tpm
+
+    def _request_capacity(self):
+        if not self.rpm:
+            return 0.0
+        # 桶容量为10秒的配额，避免任务启动瞬间把一分钟的配额全部打出去
+        return max(1.0, self.rpm * self._rate_factor / 6)
+
+    def _token_capacity(self):
+        if not self.tpm:
+            return 0.0
+        return max(1.0, self.tpm * self._rate_factor / 6)
+
+    def _refill(self, now):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        if self.rpm:
+            self._request_tokens = min(self._request_capacity(),
+                                       self._request_tokens + elapsed * self.rpm * self._rate_factor / 60)
+        if self.tpm:
+            self._token_tokens = min(self._token_capacity(),
+                                     self._token_tokens + elapsed * self.tpm * self._rate_factor / 60)
+
+    def acquire(self, estimated_tokens=1):
+        """
+        阻塞直到允许发送一次请求。
+
+        :param estimated_tokens: 本次请求预计消耗的token数（输入+输出）
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait_time = self._blocked_until - now
+                if wait_time <= 0:
+                    # 单次请求超过桶容量时，按桶满即可发送，避免永远等待
+                    needed_tokens = min(estimated_tokens, self._token_capacity()) if self.tpm else 0
+                    request_wait = 0.0
+                    token_wait = 0.0
+                    if self.rpm and self._request_tokens < 1:
+                        request_wait = (1 - self._request_tokens) * 60 / (self.rpm * self._rate_factor)
+                    if self.tpm and self._token_tokens < needed_tokens:
+                        token_wait = (needed_tokens - self._token_tokens) * 60 / (self.tpm * self._rate_factor)
+                    wait_time = max(request_wait, token_wait)
+                    if wait_time <= 0:
+                        if self.rpm:
+                            self._request_tokens -= 1
+                        if self.tpm:
+                            self._token_tokens -= estimated_tokens
+                        self._recent_sends.append(now)
+                        while self._recent_sends and now - self._recent_sends[0] > 60:
+                            self._recent_sends.popleft()
+                        return
+            time.sleep(min(wait_time, 5.0))
+
+    def record_usage(self, estimated_tokens, actual_tokens):
+        """请求完成后按实际token数修正token桶（多退少补）。"""
+        if not self.tpm or actual_tokens is None:
+            return
+        with self._lock:
+            self._token_tokens += estimated_tokens - actual_tokens
+
+    def on_success(self):
+        """成功请求后逐步恢复发送速率。"""
+        with self._lock:
+            if self._rate_factor < 1.0:
+                self._rate_factor = min(1.0, self._rate_factor + self.recovery_step)
+
+    def on_throttled(self, retry_after=None):
+        """
+        收到 429 后调用：暂停发送并降低速率。
+
+        :param retry_after: 服务端要求的等待秒数（Retry-After），None 表示未提供
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.throttled_count += 1
+            if not self.rpm:
+                # 未配置 rpm 时，以最近一分钟观测到的实际发送速率作为可持续速率的基准
+                while self._recent_sends and now - self._recent_sends[0] > 60:
+                    self._recent_sends.popleft()
+                window = max(1.0, now - self._recent_sends[0]) if self._recent_sends else 60.0
+                self.rpm = max(1, int(len(self._recent_sends) * 60 / window))
+                self._request_tokens = 0.0
+            self._rate_factor = max(self.min_rate_factor, self._rate_factor * 0.5)
+            self._request_tokens = min(self._request_tokens, self._request_capacity())
+            self._token_tokens = min(self._token_tokens, self._token_capacity())
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, now + retry_after)
+
+    def on_server_error(self, retry_after=None):
+        """收到 5xx 后调用：只暂停，不降低速率。"""
+        with self._lock:
+            self.server_error_count += 1
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+
+    def stats(self):
+        """返回限流器当前状态，用于日志或任务状态展示。"""
+        with self._lock:
+            return {
+                'rpm': self.rpm,
+                'tpm': self.tpm,
+                'rate_factor': round(self._rate_factor, 3),
+                'throttled_count': self.throttled_count,
+                'server_error_count': self.server_error_count,
+            }
+
+
+# (base_url, model) -> AdaptiveRateLimiter，进程内所有任务共享
+_RATE_LIMITERS = {}
+_RATE_LIMITERS_LOCK = threading.Lock()
+
+def get_rate_limiter(base_url, model_name, rpm=None, tpm=None):
+    """
+    获取指定 (base_url, model) 的共享限流器，不存在时创建。
+
+    :param base_url: 模型API URL
+    :param model_name: 模型名称
+    :param rpm: 每分钟请求数上限（可选）
+    :param tpm: 每分钟token数上限（可选）
+    :return: AdaptiveRateLimiter
+    """
+    limiter_key = ((base_url or '').rstrip('/'), model_name)
+    with _RATE_LIMITERS_LOCK:
+        limiter = _RATE_LIMITERS.get(limiter_key)
+        if limiter is None:
+            limiter = AdaptiveRateLimiter(rpm=rpm, tpm=tpm)
+            _RATE_LIMITERS[limiter_key] = limiter
+        elif rpm or tpm:
+            limiter.update_limits(rpm=rpm, tpm=tpm)
+        return limiter
+
+
+def _get_status_code(error):
+    status_code = getattr(error, 'status_code', None)
+    if status_code is None and getattr(error, 'response', None) is not None:
+        status_code = getattr(error.response, 'status_code', None)
+    return status_code
+
+def parse_retry_after(error):
+    """
+    从异常附带的HTTP响应中解析 Retry-After / retry-after-ms 头，返回等待秒数或 None。
+    """
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms:
+        try:
+            return max(0.0, float(retry_after_ms) / 1000)
+        except ValueError:
+            pass
+    retry_after = headers.get('retry-after')
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        try:
+            retry_at = parsedate_to_datetime(retry_after)
+            return max(0.0, retry_at.timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+def call_with_rate_limit(limiter, request_func, estimated_tokens=1, max_retries=6, base_backoff=1.0, max_backoff=60.0):
+    """
+    在限流器控制下执行一次模型请求；遇到 429 / 5xx 时按 Retry-After 或指数退避重试。
+
+    :param limiter: AdaptiveRateLimiter
+    :param request_func: 无参函数，执行完整请求（包括读取完流式响应）并返回结果
+    :param estimated_tokens: 预计消耗的token数，用于token桶
+    :param max_retries: 最大重试次数
+    :param base_backoff: 未提供 Retry-After 时的初始退避秒数
+    :param max_backoff: 单次退避的最大秒数
+    :return: request_func 的返回值
+    """
+    for attempt in range(max_retries + 1):
+        limiter.acquire(estimated_tokens)
+        try:
+            result = request_func()
+        except Exception as e:
+            status_code = _get_status_code(e)
+            if status_code != 429 and not (status_code and status_code >= 500):
+                raise
+            retry_after = parse_retry_after(e)
+            if status_code == 429:
+                limiter.on_throttled(retry_after)
+            else:
+                limiter.on_server_error(retry_after)
+            if attempt >= max_retries:
+                raise
+            if retry_after is None:
+                backoff = min(max_backoff, base_backoff * (2 ** attempt))
+                retry_after = random.uniform(backoff / 2, backoff)
+            print(f"模型端点返回 {status_code}，{retry_after:.1f}秒后进行第{attempt + 1}次重试。")
+            time.sleep(retry_after)
+            continue
+        limiter.on_success()
+        return result
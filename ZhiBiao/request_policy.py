@@ -0,0 +1,191 @@
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import httpx
+
+# 默认超时（秒）：建立连接、首个输出块（含推理内容）到达、整个请求完成
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_FIRST_TOKEN_TIMEOUT = 120.0
+DEFAULT_TOTAL_TIMEOUT = 600.0
+# 单行请求失败后的默认重试次数（不含首次请求）
+DEFAULT_ROW_RETRIES = 2
+
+
+class RequestTimeoutError(Exception):
+    """单次模型请求超过首token或总耗时期限。"""
+
+
+class RequestCancelledError(Exception):
+    """对冲请求中另一次请求已先完成，本次请求被放弃。"""
+
+
+def resolve_timeouts(timeouts=None):
+    """
+    补全超时配置，未配置或非正数的项使用默认值。
+
+    :param timeouts: dict，可包含 'connect'、'first_token'、'total'（秒）
+    :return: dict，三项均有值
+    """
+    timeouts = timeouts or {}
+    resolved = {
+        'connect': timeouts.get('connect') or DEFAULT_CONNECT_TIMEOUT,
+        'first_token': timeouts.get('first_token') or DEFAULT_FIRST_TOKEN_TIMEOUT,
+        'total': timeouts.get('total') or DEFAULT_TOTAL_TIMEOUT,
+    }
+    return {name: float(value) if value and float(value) > 0 else None for name, value in resolved.items()}
+
+def build_http_timeout(timeouts, stream=True):
+    """
+    把超时配置转换为单次请求的 httpx.Timeout。
+    流式请求的读超时取首token期限，同时限制了首个块的等待时间和块与块之间的停顿；
+    非流式请求要等完整回复，读超时取总期限。
+
+    :param timeouts: resolve_timeouts 的返回值
+    :param stream: 是否为流式请求
+    :return: httpx.Timeout
+    """
+    read_timeout = timeouts['first_token'] if stream else timeouts['total']
+    if stream and timeouts['total']:
+        read_timeout = min(read_timeout or timeouts['total'], timeouts['total'])
+    return httpx.Timeout(timeouts['total'], connect=timeouts['connect'], read=read_timeout)
+
+def check_stream_deadlines(timeouts, start_time, first_chunk_time, now):
+    """
+    流式读取过程中检查期限：尚未收到任何输出块时检查首token期限，之后检查总期限。
+    期限使用 time.perf_counter() 的时刻。
+
+    :raises RequestTimeoutError: 超过期限
+    """
+    elapsed = now - start_time
+    if first_chunk_time is None and timeouts['first_token'] and elapsed > timeouts['first_token']:
+        raise RequestTimeoutError(f"首token超时（{elapsed:.1f}秒 > {timeouts['first_token']}秒）")
+    if timeouts['total'] and elapsed > timeouts['total']:
+        raise RequestTimeoutError(f"请求总耗时超时（{elapsed:.1f}秒 > {timeouts['total']}秒）")
+
+
+def get_error_status_code(error):
+    """取出请求异常对应的 HTTP 状态码，连接失败、超时等没有状态码时返回 None。"""
+    status_code = getattr(error, 'status_code', None)
+    if status_code is None and getattr(error, 'response', None) is not None:
+        status_code = getattr(error.response, 'status_code', None)
+    return status_code
+
+def is_retryable_error(error):
+    """
+    判断单行请求失败后是否值得重试：超时、连接中断等没有HTTP状态码的错误以及 408/409 可以重试。
+    429 和 5xx 已由 rate_limiter.call_with_rate_limit 退避重试过，这里不再重复；
+    其余 4xx（参数错误、鉴权失败、模型不存在等）重试也不会成功。
+    """
+    if isinstance(error, RequestCancelledError):
+        return False
+    status_code = get_error_status_code(error)
+    if status_code is None:
+        return True
+    return status_code in (408, 409)
+
+def call_with_row_retries(request_func, max_retries=DEFAULT_ROW_RETRIES, base_delay=1.0, max_delay=30.0, label=''):
+    """
+    执行单行请求，失败时按带抖动的指数退避重试，最多重试 max_retries 次。
+
+    :param request_func: 无参函数，执行一次完整请求并返回结果
+    :param max_retries: 最大重试次数
+    :param base_delay: 初始退避秒数
+    :param max_delay: 单次退避的最大秒数
+    :param label: 日志中显示的请求说明
+    :return: request_func 的返回值
+    :raises: 最后一次失败的异常
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return request_func()
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable_error(e):
+                raise
+            backoff = min(max_delay, base_delay * (2 ** attempt))
+            delay = random.uniform(backoff / 2, backoff)
+            print(f"{label}请求失败（{e}），{delay:.1f}秒后进行第{attempt + 1}次重试。")
+            time.sleep(delay)
+
+
+class LatencyTracker:
+    """
+    记录某个端点最近若干次成功请求的总耗时，用于计算对冲请求的等待时间。
+    """
+
+    def __init__(self, window=500, min_samples=20):
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+
+    def record(self, latency):
+        if latency is None:
+            return
+        with self._lock:
+            self._latencies.append(latency)
+
+    def percentile(self, q):
+        """样本数不足 min_samples 时返回 None。"""
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            ordered = sorted(self._latencies)
+        index = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+        return ordered[index]
+
+
+# (base_url, model) -> LatencyTracker，进程内所有任务共享
+_LATENCY_TRACKERS = {}
+_LATENCY_TRACKERS_LOCK = threading.Lock()
+
+def get_latency_tracker(base_url, model_name):
+    """获取指定 (base_url, model) 的共享延迟记录器，不存在时创建。"""
+    tracker_key = ((base_url or '').rstrip('/'), model_name)
+    with _LATENCY_TRACKERS_LOCK:
+        tracker = _LATENCY_TRACKERS.get(tracker_key)
+        if tracker is None:
+            tracker = LatencyTracker()
+            _LATENCY_TRACKERS[tracker_key] = tracker
+        return tracker
+
+
+# 对冲请求使用独立的线程池，避免占用调用方的工作线程
+_HEDGE_EXECUTOR = ThreadPoolExecutor(max_workers=256, thread_name_prefix='hedge')
+
+def call_with_hedging(request_func, hedge_delay, label=''):
+    """
+    对冲请求：先发出一次请求，若 hedge_delay 秒后仍未完成，再发出一次相同的请求，取先成功完成的结果，
+    并通知另一次请求停止读取。hedge_delay 为 None 时（如延迟样本不足）直接执行单次请求。
+
+    :param request_func: 函数 request_func(cancel_event) -> 结果；cancel_event 被设置时应尽快结束并关闭连接
+    :param hedge_delay: 发出第二次请求前的等待秒数，通常取该端点总耗时的 P95
+    :param label: 日志中显示的请求说明
+    :return: 先成功完成的请求的结果；两次请求都失败时抛出先失败的异常
+    """
+    if hedge_delay is None:
+        return request_func(threading.Event())
+
+    primary_cancel = threading.Event()
+    primary = _HEDGE_EXECUTOR.submit(request_func, primary_cancel)
+    done, _ = wait([primary], timeout=hedge_delay)
+    if done:
+        return primary.result()
+
+    print(f"{label}请求超过 {hedge_delay:.2f} 秒（P95）仍未完成，发出对冲请求。")
+    hedge_cancel = threading.Event()
+    hedge = _HEDGE_EXECUTOR.submit(request_func, hedge_cancel)
+    cancel_events = {primary: primary_cancel, hedge: hedge_cancel}
+    pending = {primary, hedge}
+    first_error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                for other in pending:
+                    cancel_events[other].set()
+                return future.result()
+            if first_error is None:
+                first_error = future.exception()
+    raise first_error
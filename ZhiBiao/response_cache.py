@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# 缓存文件默认存放在项目 instance 目录下
+DEFAULT_CACHE_PATH = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'instance', 'llm_response_cache.sqlite3'))
+DEFAULT_MAX_ENTRIES = 200000
+
+
+def make_cache_key(model_name, base_url, system_prompt, user_message, sampling_params=None):
+    """
+    根据模型名、端点、系统提示词、用户消息和采样参数生成缓存键 (sha256)。
+
+    :param model_name: 模型名称
+    :param base_url: 模型API URL
+    :param system_prompt: 系统提示词，没有时为 None
+    :param user_message: 渲染后的用户消息
+    :param sampling_params: 采样参数字典（temperature、max_tokens 等），没有时为 None
+    :return: 十六进制缓存键
+    """
+    key_payload = json.dumps({
+        'model': model_name,
+        'base_url': (base_url or '').rstrip('/'),
+        'system': system_prompt or None,
+        'user': str(user_message),
+        'params': sampling_params or {},
+    }, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(key_payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    基于 SQLite 的模型响应持久化缓存。
+
+    - 每条记录保存完整响应文本以及原始请求测得的首token时间和延迟画像。
+    - 超过 max_entries 条时按最近访问时间淘汰最旧的记录 (LRU)，一次淘汰到上限的 90%。
+    - hits / misses 为进程内累计的命中与未命中次数。
+    """
+
+    def __init__(self, db_path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, model TEXT, base_url TEXT, response TEXT, '
+            'first_token REAL, created_at REAL, last_access REAL)'
+        )
+        columns = {row[1] for row in self._conn.execute('PRAGMA table_info(responses)')}
+        if 'profile' not in columns:
+            # 旧版本缓存文件没有延迟画像列，补上即可继续使用
+            self._conn.execute('ALTER TABLE responses ADD COLUMN profile TEXT')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses (last_access)')
+        self._conn.commit()
+        self._entry_count = self._conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    def get(self, key):
+        """
+        查询缓存，命中时返回 {'response', 'first_token', 'profile'}，未命中返回 None。
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT response, first_token, profile FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute('UPDATE responses SET last_access = ? WHERE key = ?', (time.time(), key))
+            self._conn.commit()
+            return {'response': row[0], 'first_token': row[1], 'profile': json.loads(row[2]) if row[2] else None}
+
+    def set(self, key, response, first_token=None, model_name=None, base_url=None, profile=None):
+        """写入或覆盖一条缓存记录（profile 为原始请求的延迟画像），必要时触发淘汰。"""
+        now = time.time()
+        profile_json = json.dumps(profile) if profile else None
+        with self._lock:
+            exists = self._conn.execute('SELECT 1 FROM responses WHERE key = ?', (key,)).fetchone() is not None
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses (key, model, base_url, response, first_token, created_at, last_access, profile) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, model_name, base_url, response, first_token, now, now, profile_json)
+            )
+            if not exists:
+                self._entry_count += 1
+            if self.max_entries and self._entry_count > self.max_entries:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        # 其他进程也可能写入同一个缓存文件，淘汰前重新统计
+        self._entry_count = self._conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        if self._entry_count <= self.max_entries:
+            return
+        target = int(self.max_entries * 0.9)
+        self._conn.execute(
+            'DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_access ASC LIMIT ?)',
+            (self._entry_count - target,)
+        )
+        self._entry_count = target
+
+    def stats(self):
+        """返回缓存的命中统计与当前条目数。"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 4) if total else 0.0,
+                'entries': self._entry_count,
+                'max_entries': self.max_entries,
+            }
+
+    def clear(self):
+        """清空缓存。"""
+        with self._lock:
+            self._conn.execute('DELETE FROM responses')
+            self._conn.commit()
+            self._entry_count = 0
+
+
+_RESPONSE_CACHE = None
+_RESPONSE_CACHE_LOCK = threading.Lock()
+
+def get_response_cache():
+    """获取进程内共享的响应缓存实例（首次调用时打开数据库）。"""
+    global _RESPONSE_CACHE
+    with _RESPONSE_CACHE_LOCK:
+        if _RESPONSE_CACHE is None:
+            max_entries = int(os.environ.get('LLM_RESPONSE_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES))
+            _RESPONSE_CACHE = ResponseCache(os.environ.get('LLM_RESPONSE_CACHE_PATH', DEFAULT_CACHE_PATH), max_entries)
+        return _RESPONSE_CACHE
@@ -0,0 +1,75 @@
+from collections import Counter
+
+# 支持的 ROUGE 指标，对应结果列名
+ROUGE_VARIANTS = ('ROUGE-1', 'ROUGE-2', 'ROUGE-L')
+
+
+def _ngram_counts(tokens, n):
+    """统计 n 元组出现次数。"""
+    return Counter(zip(*(tokens[i:] for i in range(n))))
+
+def _f1(overlap, hypothesis_total, reference_total):
+    if not overlap or not hypothesis_total or not reference_total:
+        return 0.0
+    precision = overlap / hypothesis_total
+    recall = overlap / reference_total
+    return 2 * precision * recall / (precision + recall)
+
+def rouge_n(reference_tokens, hypothesis_tokens, n):
+    """
+    ROUGE-N 的 F1 值：重叠的 n 元组按两边出现次数的较小值计数。
+
+    :param reference_tokens: 参考答案的词列表
+    :param hypothesis_tokens: 生成答案的词列表
+    :param n: n 元组长度
+    :return: float
+    """
+    reference_counts = _ngram_counts(reference_tokens, n)
+    hypothesis_counts = _ngram_counts(hypothesis_tokens, n)
+    overlap = sum((reference_counts & hypothesis_counts).values())
+    return _f1(overlap, sum(hypothesis_counts.values()), sum(reference_counts.values()))
+
+def lcs_length(tokens_a, tokens_b):
+    """
+    最长公共子序列长度，按位并行算法（Hyyrö）：tokens_a 的每个词对应一个位置掩码，
+    逐个处理 tokens_b 的词时用整数的加减和位运算一次更新整行，复杂度 O(len(b) * len(a) / 字长)。
+    """
+    if not tokens_a or not tokens_b:
+        return 0
+    position_masks = {}
+    for position, token in enumerate(tokens_a):
+        position_masks[token] = position_masks.get(token, 0) | (1 << position)
+    full_mask = (1 << len(tokens_a)) - 1
+    row = full_mask
+    for token in tokens_b:
+        match_mask = position_masks.get(token)
+        if match_mask is None:
+            continue
+        matched = row & match_mask
+        row = ((row + matched) | (row - matched)) & full_mask
+    return len(tokens_a) - bin(row).count('1')
+
+def rouge_l(reference_tokens, hypothesis_tokens):
+    """ROUGE-L 的 F1 值，基于最长公共子序列。"""
+    return _f1(lcs_length(reference_tokens, hypothesis_tokens), len(hypothesis_tokens), len(reference_tokens))
+
+def rouge_scores(reference_tokens, hypothesis_tokens, variants=ROUGE_VARIANTS):
+    """
+    一次计算所需的多个 ROUGE 指标（F1 值）。
+
+    :param reference_tokens: 参考答案的词列表
+    :param hypothesis_tokens: 生成答案的词列表
+    :param variants: ROUGE_VARIANTS 中的若干项
+    :return: dict，指标名 -> F1 值
+    """
+    scores = {}
+    for variant in variants:
+        if variant == 'ROUGE-1':
+            scores[variant] = rouge_n(reference_tokens, hypothesis_tokens, 1)
+        elif variant == 'ROUGE-2':
+            scores[variant] = rouge_n(reference_tokens, hypothesis_tokens, 2)
+        elif variant == 'ROUGE-L':
+            scores[variant] = rouge_l(reference_tokens, hypothesis_tokens)
+        else:
+            raise ValueError(f"未知的ROUGE指标: {variant}")
+    return scores
@@ -0,0 +1,196 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import jieba
+
+# 并行分词的进程数，默认为 CPU 核数；设为 1 或 0 时只在当前进程分词
+DEFAULT_WORKERS = os.cpu_count() or 1
+# 待分词的文本少于该数量时直接在当前进程分词，省去进程间传输的开销
+PARALLEL_MIN_TEXTS = 2000
+# 每个子进程任务的文本条数
+CHUNK_SIZE = 256
+# 进程内跨任务共享的分词结果 LRU 缓存条数
+DEFAULT_LRU_SIZE = 200000
+
+logger = logging.getLogger(__name__)
+
+
+def _text_key(text):
+    return hashlib.sha1(text.encode('utf-8')).digest()
+
+
+class _TokenLRU:
+    """进程内共享的分词结果 LRU 缓存，按文本的 sha1 摘要索引。"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, text_key):
+        with self._lock:
+            tokens = self._entries.get(text_key)
+            if tokens is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(text_key)
+            return tokens
+
+    def put(self, text_key, tokens):
+        with self._lock:
+            self._entries[text_key] = tokens
+            self._entries.move_to_end(text_key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {'entries': len(self._entries), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': round(self.hits / total, 4) if total else 0.0}
+
+
+_TOKEN_LRU = _TokenLRU(int(os.environ.get('JIEBA_TOKEN_CACHE_SIZE', DEFAULT_LRU_SIZE)))
+
+def get_token_lru_stats():
+    """返回进程内分词 LRU 缓存的统计。"""
+    return _TOKEN_LRU.stats()
+
+
+def _init_tokenizer_worker():
+    # 子进程启动时预先加载 jieba 词典，之后的分词任务不再等待加载
+    jieba.setLogLevel(logging.WARNING)
+    jieba.initialize()
+
+def _tokenize_chunk(texts):
+    return [tuple(jieba.cut(text)) for text in texts]
+
+
+# 进程数 -> ProcessPoolExecutor，进程池在整个服务进程内常驻复用
+_TOKENIZER_POOLS = {}
+_TOKENIZER_POOLS_LOCK = threading.Lock()
+
+def get_tokenizer_pool(workers):
+    """
+    获取指定进程数的常驻分词进程池，不存在时创建（子进程启动时预加载 jieba 词典）。
+    子进程以 spawn 方式启动：服务进程中有多个任务线程和请求线程，fork 会把其他线程持有的锁原样复制到子进程，可能导致死锁。
+    """
+    with _TOKENIZER_POOLS_LOCK:
+        pool = _TOKENIZER_POOLS.get(workers)
+        if pool is None:
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=_init_tokenizer_worker)
+            _TOKENIZER_POOLS[workers] = pool
+        return pool
+
+def _discard_tokenizer_pool(workers):
+    with _TOKENIZER_POOLS_LOCK:
+        pool = _TOKENIZER_POOLS.pop(workers, None)
+    if pool is not None:
+        pool.shutdown(wait=False)
+
+def segment_texts(texts, workers=None):
+    """
+    对一批文本分词，结果与逐条 tuple(jieba.cut(text)) 完全一致。
+    文本较多且 workers > 1 时按 CHUNK_SIZE 分块交给常驻进程池并行分词，进程池不可用时退回当前进程。
+
+    :param texts: 字符串列表
+    :param workers: 进程数，None 时取环境变量 JIEBA_WORKERS，未设置时为 CPU 核数
+    :return: 与 texts 对应的分词结果列表
+    """
+    if workers is None:
+        workers = int(os.environ.get('JIEBA_WORKERS', DEFAULT_WORKERS))
+    if workers <= 1 or len(texts) < PARALLEL_MIN_TEXTS:
+        return _tokenize_chunk(texts)
+    chunks = [texts[start:start + CHUNK_SIZE] for start in range(0, len(texts), CHUNK_SIZE)]
+    try:
+        results = []
+        for chunk_tokens in get_tokenizer_pool(workers).map(_tokenize_chunk, chunks):
+            results.extend(chunk_tokens)
+        return results
+    except Exception as e:
+        logger.warning("并行分词失败，改为在当前进程分词: %s", e)
+        _discard_tokenizer_pool(workers)
+        return _tokenize_chunk(texts)
+
+
+class TokenCache:
+    """
+    一次评测任务内共享的分词结果：每个不同的文本只用 jieba 分词一次，
+    ROUGE、F1值（中文分词）和F1值（词林扩展）等词法指标都从这里取分词结果。
+
+    - 分词结果为 jieba.cut 的完整输出（含标点和空白），以元组保存，各指标按需过滤。
+    - 任务内没有的文本先查进程内共享的 LRU 缓存，仍没有时才分词；tokenize_many 可并行分词（见 segment_texts）。
+    - hits 为从任务内缓存或 LRU 缓存取到结果的次数，misses 为实际调用 jieba 分词的次数。
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._tokens = {}
+
+    def tokenize(self, text):
+        """
+        返回文本的分词结果，未分词过时调用 jieba 分词并缓存。
+
+        :param text: 文本（非字符串会先转为字符串）
+        :return: tuple[str]
+        """
+        text = str(text)
+        with self._lock:
+            tokens = self._tokens.get(text)
+            if tokens is not None:
+                self.hits += 1
+                return tokens
+        text_key = _text_key(text)
+        tokens = _TOKEN_LRU.get(text_key)
+        segmented = tokens is None
+        if segmented:
+            tokens = tuple(jieba.cut(text))
+            _TOKEN_LRU.put(text_key, tokens)
+        with self._lock:
+            if segmented:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return self._tokens.setdefault(text, tokens)
+
+    def tokenize_many(self, texts):
+        """批量分词，返回与 texts 对应的分词结果列表；未缓存的文本一次性交给 segment_texts（可并行）。"""
+        texts = [str(text) for text in texts]
+        with self._lock:
+            pending = [text for text in dict.fromkeys(texts) if text not in self._tokens]
+        missing = {}
+        for text in pending:
+            text_key = _text_key(text)
+            tokens = _TOKEN_LRU.get(text_key)
+            if tokens is None:
+                missing[text] = text_key
+            else:
+                with self._lock:
+                    self._tokens.setdefault(text, tokens)
+        if missing:
+            for (text, text_key), tokens in zip(missing.items(), segment_texts(list(missing), self.workers)):
+                _TOKEN_LRU.put(text_key, tokens)
+                with self._lock:
+                    self._tokens.setdefault(text, tokens)
+        with self._lock:
+            # 只有实际分词的文本计为未命中，从 LRU 缓存取到的算命中
+            self.misses += len(missing)
+            self.hits += len(texts) - len(missing)
+            return [self._tokens[text] for text in texts]
+
+    def stats(self):
+        """返回缓存的文本数与命中统计。"""
+        with self._lock:
+            return {'texts': len(self._tokens), 'hits': self.hits, 'misses': self.misses}
@@ -1,13 +1,18 @@
 from flask import Blueprint, render_template, request, current_app, send_from_directory, url_for, jsonify
 from datetime import datetime
-from ZhiBiao.achieve import extract_column_to_new_excel, process_and_evaluate_excel
+from ZhiBiao.achieve import DEFAULT_EMBEDDING_BATCH_SIZE, extract_column_to_new_excel, process_and_evaluate_excel
+from ZhiBiao.llm_client import get_http_session
+from ZhiBiao.endpoint_pool import normalize_endpoint_urls
+from ZhiBiao.embedding_models import get_embedding_model_cache
+from ZhiBiao.estimator import estimate_function1_task, estimate_function4_task, record_model_run
 import os
 from werkzeug.utils import secure_filename
 import uuid
 import threading
+import time
 from urllib.parse import urlparse, urlunparse # Added for URL parsing
 import json # Added for json operations
-from TQ.tools import extract_and_save_to_excel, extract_and_save_to_excel_folder, ai_prompt_query, load_prompts, analyze_excel
+from TQ.tools import extract_and_save_to_excel, extract_and_save_to_excel_folder, ai_prompt_query_batch, load_prompts, analyze_excel, SCORE_MAX_TOKENS
 
 main_bp = Blueprint('main', __name__)
 
@@ -28,6 +33,7 @@ def process_task_background(app, task_id, processing_params):
             tasks_status[task_id]['status'] = 'processing'
             tasks_status[task_id]['progress'] = 60 # Simulate some progress
 
+            run_summary = {}
             final_excel_path = process_and_evaluate_excel(
                 processing_params['questions_excel_path'],
                 processing_params['output_dir'],
@@ -35,7 +41,9 @@ def process_task_background(app, task_id, processing_params):
                 processing_params['external_model_config'],
                 processing_params['internal_model_config'],
                 processing_params['selected_metrics'],
-                processing_params.get('embedding_model_for_ass', 'BAAI/bge-small-zh-v1.5') # Pass to background task
+                processing_params.get('embedding_model_for_ass', 'BAAI/bge-small-zh-v1.5'), # Pass to background task
+                run_summary=run_summary,
+                embedding_batch_size=processing_params.get('embedding_batch_size') or DEFAULT_EMBEDDING_BATCH_SIZE
             )
             
             if final_excel_path:
@@ -43,9 +51,18 @@ def process_task_background(app, task_id, processing_params):
                 tasks_status[task_id].update({
                     'status': 'completed', 
                     'progress': 100, 
-                    'processed_filename': processed_filename
+                    'processed_filename': processed_filename,
+                    'run_summary': run_summary # 各模型延迟的 P50/P90/P99 等运行汇总
                 })
                 current_app.logger.info(f'Background processing complete for task {task_id}. Final file: {final_excel_path}')
+                # 记录各模型本次的单请求耗时和输出长度，供之后提交的任务预估耗时
+                for column_prefix, config_name in (('External_Model', 'external_model_config'), ('Internal_Model', 'internal_model_config')):
+                    model_config = processing_params[config_name]
+                    model_latency = run_summary.get('latency', {}).get(column_prefix)
+                    if model_latency:
+                        record_model_run('function1', model_config['name'], model_config['url'], model_config.get('concurrency', 1),
+                                         model_latency['requests'], model_latency['total_latency']['p50'],
+                                         model_latency['first_token']['p50'], model_latency['output_tokens']['p50'])
             else:
                 tasks_status[task_id].update({'status': 'failed', 'progress': 100, 'message': '处理和评估Excel失败'})
                 current_app.logger.error(f'Background processing failed for task {task_id}: process_and_evaluate_excel returned None.')
@@ -142,21 +159,56 @@ def function1():
                 tasks_status[task_id]['progress'] = 30
 
                 prompt = request.form.get('prompt', '')
+                # 勾选“跳过缓存”时本次任务不读取响应缓存，全部重新请求模型
+                use_cache = request.form.get('bypass_cache') != 'true'
+                dedupe_questions = request.form.get('dedupe_questions') == 'true'
+                # 超时、重试与对冲请求设置，两个模型共用；超时留空时使用默认值
+                request_timeouts = {
+                    'connect': request.form.get('connect_timeout', type=float),
+                    'first_token': request.form.get('first_token_timeout', type=float),
+                    'total': request.form.get('total_timeout', type=float),
+                }
+                max_retries = request.form.get('max_retries', 2, type=int)
+                hedge_requests = request.form.get('hedge_requests') == 'true'
                 external_model_config = {
                     'key': request.form.get('external_model_key'),
                     'url': request.form.get('external_model_url'),
                     'name': request.form.get('external_model_name'),
-                    'get_first_token': request.form.get('external_model_get_first_token') == 'true'
+                    'get_first_token': request.form.get('external_model_get_first_token') == 'true',
+                    'concurrency': request.form.get('external_model_concurrency', 1, type=int) or 1,
+                    'rpm': request.form.get('external_model_rpm', type=int),
+                    'tpm': request.form.get('external_model_tpm', type=int),
+                    'disable_thinking': request.form.get('external_model_disable_thinking') == 'true',
+                    'thinking_budget': request.form.get('external_model_thinking_budget', type=int),
+                    'log_reasoning': request.form.get('external_model_log_reasoning') == 'true',
+                    'use_cache': use_cache,
+                    'dedupe': dedupe_questions,
+                    'timeouts': request_timeouts,
+                    'max_retries': max_retries,
+                    'hedge': hedge_requests
                 }
                 internal_model_config = {
                     'key': request.form.get('internal_model_key'),
-                    'url': request.form.get('internal_model_url'),
+                    # 内部模型可填写多个副本地址（逗号分隔），请求按在途数在副本间分配
+                    'url': normalize_endpoint_urls(request.form.get('internal_model_url')),
                     'name': request.form.get('internal_model_name'),
-                    'get_first_token': request.form.get('internal_model_get_first_token') == 'true'
+                    'get_first_token': request.form.get('internal_model_get_first_token') == 'true',
+                    'concurrency': request.form.get('internal_model_concurrency', 1, type=int) or 1,
+                    'rpm': request.form.get('internal_model_rpm', type=int),
+                    'tpm': request.form.get('internal_model_tpm', type=int),
+                    'disable_thinking': request.form.get('internal_model_disable_thinking') == 'true',
+                    'thinking_budget': request.form.get('internal_model_thinking_budget', type=int),
+                    'log_reasoning': request.form.get('internal_model_log_reasoning') == 'true',
+                    'use_cache': use_cache,
+                    'dedupe': dedupe_questions,
+                    'timeouts': request_timeouts,
+                    'max_retries': max_retries,
+                    'hedge': hedge_requests
                 }
                 selected_metrics = request.form.getlist('metrics')
                 embedding_model_for_ass = request.form.get('embedding_model_for_ass', 'BAAI/bge-small-zh-v1.5') # Default if not provided
                 current_app.logger.info(f'Selected embedding model for ASS: {embedding_model_for_ass}')
+                embedding_batch_size = request.form.get('embedding_batch_size', DEFAULT_EMBEDDING_BATCH_SIZE, type=int)
                 tasks_status[task_id]['progress'] = 50
 
                 processing_params = {
@@ -166,9 +218,16 @@ def function1():
                     'external_model_config': external_model_config,
                     'internal_model_config': internal_model_config,
                     'selected_metrics': selected_metrics,
-                    'embedding_model_for_ass': embedding_model_for_ass
+                    'embedding_model_for_ass': embedding_model_for_ass,
+                    'embedding_batch_size': embedding_batch_size
                 }
                 
+                # 提交时预估请求数、token数和耗时，预估失败不影响任务执行
+                try:
+                    tasks_status[task_id]['estimate'] = estimate_function1_task(questions_excel_path, prompt, external_model_config, internal_model_config)
+                except Exception as e:
+                    current_app.logger.warning(f'Task {task_id}: Failed to estimate task budget: {e}')
+
                 # Start background thread for processing
                 thread = threading.Thread(target=process_task_background, args=(current_app._get_current_object(), task_id, processing_params))
                 thread.daemon = True # Daemonize thread
@@ -336,56 +395,63 @@ def process_evaluation_task_background(app, task_id, params):
             final_modified_excel_path = None # Will store the path of the excel after all prompts are processed
             
             selected_prompt_names = params.get('selected_prompt_names', [])
-            total_prompts_to_process = len(selected_prompt_names)
-            prompts_processed_count = 0
-            
-            # Initial progress is 10, processing prompts will take from 10 up to 80 (70% of total progress range)
-
+            selected_criteria = []
             for prompt_name_iter in selected_prompt_names:
                 selected_prompt_object = next((p for p in all_prompts_data if p.get('name') == prompt_name_iter), None)
-                
                 if not selected_prompt_object or 'prompt' not in selected_prompt_object:
                     current_app.logger.warning(f"Task {task_id}: Prompt '{prompt_name_iter}' not found or has no content in PromptTemplate.json. Skipping.")
-                    prompts_processed_count += 1
-                    if total_prompts_to_process > 0:
-                         current_progress_val = 10 + int((prompts_processed_count / total_prompts_to_process) * 70)
-                         tasks_status[task_id]['progress'] = current_progress_val
-                    if prompts_processed_count == total_prompts_to_process and final_modified_excel_path is None:
-                        tasks_status[task_id].update({'status': 'failed', 'message': '所有选择的Prompt均无效或无法处理。'})
-                    continue 
-
-                prompt_content_iter = selected_prompt_object['prompt']
-                output_column_name_iter = prompt_name_iter
-
-                current_app.logger.info(f"Task {task_id}: Processing with prompt '{prompt_name_iter}'. Input: {current_excel_path}")
-                
-                modified_excel_path_for_this_prompt = ai_prompt_query(
-                    current_excel_path, 
-                    output_column_name_iter,
-                    params['model_key'],
-                    params['model_url'],
-                    params['model_name'],
-                    prompt_content_iter
-                )
-
-                if modified_excel_path_for_this_prompt and os.path.exists(modified_excel_path_for_this_prompt):
-                    current_excel_path = modified_excel_path_for_this_prompt 
-                    final_modified_excel_path = current_excel_path 
-                    current_app.logger.info(f"Task {task_id}: Prompt '{prompt_name_iter}' processed. Output now at: {final_modified_excel_path}")
-                else:
-                    current_app.logger.error(f"Task {task_id}: Failed to process prompt '{prompt_name_iter}'. ai_prompt_query returned invalid path ('{modified_excel_path_for_this_prompt}') or file does not exist.")
-                    tasks_status[task_id].update({
-                        'status': 'failed', 
-                        'message': f"处理Prompt '{prompt_name_iter}' 失败。",
-                        'progress': tasks_status[task_id].get('progress', 10)
-                    })
-                    final_modified_excel_path = None 
-                    break 
-
-                prompts_processed_count += 1
-                if total_prompts_to_process > 0:
-                    current_progress_val = 10 + int((prompts_processed_count / total_prompts_to_process) * 70)
-                    tasks_status[task_id]['progress'] = current_progress_val
+                    continue
+                selected_criteria.append(selected_prompt_object)
+
+            if not selected_criteria:
+                tasks_status[task_id].update({'status': 'failed', 'progress': 100, 'message': '所有选择的Prompt均无效或无法处理。'})
+                return
+
+            # Initial progress is 10, processing (row, prompt) pairs will take from 10 up to 80 (70% of total progress range)
+            def update_pair_progress(pairs_done, total_pairs):
+                if total_pairs > 0:
+                    tasks_status[task_id]['progress'] = 10 + int((pairs_done / total_pairs) * 70)
+
+            combined_judge = bool(params.get('combined_judge')) and len(selected_criteria) > 1
+            current_app.logger.info(f"Task {task_id}: Processing prompts {[p['name'] for p in selected_criteria]} (combined: {combined_judge}). Input: {current_excel_path}")
+            stage_times = {}
+            tasks_status[task_id]['stage_times'] = stage_times # 各阶段耗时（秒）
+            stage_start = time.perf_counter()
+            judge_run_stats = {}
+            modified_excel_path = ai_prompt_query_batch(
+                current_excel_path,
+                selected_criteria,
+                params['model_key'],
+                params['model_url'],
+                params['model_name'],
+                params.get('model_rpm'),
+                params.get('model_tpm'),
+                params.get('use_cache', True),
+                params.get('model_concurrency') or 4,
+                combined_judge,
+                update_pair_progress,
+                timeouts=params.get('timeouts'),
+                max_row_retries=params.get('max_retries', 2),
+                hedge=params.get('hedge', False),
+                fast_score=params.get('fast_score', False),
+                score_max_tokens=params.get('score_max_tokens', SCORE_MAX_TOKENS),
+                run_stats=judge_run_stats
+            )
+            stage_times['judge_queries'] = time.perf_counter() - stage_start
+            record_model_run('function4', params['model_name'], params['model_url'], params.get('model_concurrency') or 4,
+                             judge_run_stats.get('requests'), judge_run_stats.get('latency_p50'),
+                             output_tokens_p50=judge_run_stats.get('output_tokens_p50'))
+
+            if modified_excel_path and os.path.exists(modified_excel_path):
+                final_modified_excel_path = modified_excel_path
+                current_app.logger.info(f"Task {task_id}: All prompts processed. Output now at: {final_modified_excel_path}")
+            else:
+                current_app.logger.error(f"Task {task_id}: Failed to process prompts. ai_prompt_query_batch returned invalid path ('{modified_excel_path}') or file does not exist.")
+                tasks_status[task_id].update({
+                    'status': 'failed',
+                    'message': '处理Prompt失败。',
+                    'progress': tasks_status[task_id].get('progress', 10)
+                })
             
             if final_modified_excel_path:
                  tasks_status[task_id]['progress'] = 80
@@ -397,7 +463,9 @@ def process_evaluation_task_background(app, task_id, params):
                 analysis_results = None
                 if final_modified_excel_path and os.path.exists(final_modified_excel_path):
                     try:
+                        stage_start = time.perf_counter()
                         analysis_results = analyze_excel(final_modified_excel_path)
+                        stage_times['analyze'] = time.perf_counter() - stage_start
                         current_app.logger.info(f'Task {task_id}: Excel analysis complete for {final_modified_excel_path}. Results: {analysis_results}')
                     except Exception as ex_analyze:
                         current_app.logger.error(f'Task {task_id}: Error during Excel analysis for {final_modified_excel_path}: {str(ex_analyze)}')
@@ -415,7 +483,7 @@ def process_evaluation_task_background(app, task_id, params):
                 current_app.logger.info(f'Background AI evaluation complete for task {task_id}. Output file: {final_modified_excel_path}')
             else:
                 tasks_status[task_id].update({'status': 'failed', 'progress': 100, 'message': 'AI模型评估处理失败或未生成文件。'})
-                current_app.logger.error(f'Background AI evaluation failed for task {task_id}: ai_prompt_query returned None or file does not exist.')
+                current_app.logger.error(f'Background AI evaluation failed for task {task_id}: ai_prompt_query_batch returned None or file does not exist.')
 
         except Exception as e:
             current_app.logger.error(f'Exception during background AI evaluation for task {task_id}: {str(e)}')
@@ -447,7 +515,7 @@ def function4():
 
             filename = secure_filename(excel_file.filename)
             timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-            # Save the uploaded file to be processed in place by ai_prompt_query
+            # Save the uploaded file to be processed in place by ai_prompt_query_batch
             input_excel_filename = f"{os.path.splitext(filename)[0]}_{timestamp}_{task_id}{os.path.splitext(filename)[1]}"
             input_excel_path = os.path.join(processed_folder, input_excel_filename)
             excel_file.save(input_excel_path)
@@ -457,6 +525,20 @@ def function4():
             model_key = request.form.get('model_key')
             model_url = request.form.get('model_url')
             model_name = request.form.get('model_name')
+            model_rpm = request.form.get('model_rpm', type=int)
+            model_tpm = request.form.get('model_tpm', type=int)
+            model_concurrency = request.form.get('model_concurrency', 4, type=int)
+            use_cache = request.form.get('bypass_cache') != 'true'
+            combined_judge = request.form.get('combined_judge') == 'true'
+            fast_score = request.form.get('fast_score') == 'true'
+            score_max_tokens = request.form.get('score_max_tokens', SCORE_MAX_TOKENS, type=int)
+            request_timeouts = {
+                'connect': request.form.get('connect_timeout', type=float),
+                'first_token': request.form.get('first_token_timeout', type=float),
+                'total': request.form.get('total_timeout', type=float),
+            }
+            max_retries = request.form.get('max_retries', 2, type=int)
+            hedge_requests = request.form.get('hedge_requests') == 'true'
             selected_prompt_names = request.form.getlist('selected_prompts') # Get list of selected prompt names
 
             if not selected_prompt_names:
@@ -472,9 +554,30 @@ def function4():
                 'model_key': model_key,
                 'model_url': model_url,
                 'model_name': model_name,
+                'model_rpm': model_rpm,
+                'model_tpm': model_tpm,
+                'model_concurrency': model_concurrency,
+                'use_cache': use_cache,
+                'combined_judge': combined_judge,
+                'fast_score': fast_score,
+                'score_max_tokens': score_max_tokens,
+                'timeouts': request_timeouts,
+                'max_retries': max_retries,
+                'hedge': hedge_requests,
                 'selected_prompt_names': selected_prompt_names # Pass list of names
             }
             
+            # 提交时预估请求数、token数和耗时，预估失败不影响任务执行
+            try:
+                estimate_criteria = {p['name']: p for p in load_prompts('PromptTemplate.json') if p.get('prompt')}
+                estimate_criteria = [estimate_criteria[name] for name in dict.fromkeys(selected_prompt_names) if name in estimate_criteria]
+                if estimate_criteria:
+                    tasks_status[task_id]['estimate'] = estimate_function4_task(
+                        input_excel_path, estimate_criteria, model_name, model_url, model_concurrency or 4,
+                        combined_judge, model_rpm, model_tpm)
+            except Exception as e:
+                current_app.logger.warning(f'Task {task_id}: Failed to estimate task budget: {e}')
+
             thread = threading.Thread(target=process_evaluation_task_background, args=(current_app._get_current_object(), task_id, processing_params))
             thread.daemon = True
             thread.start()
@@ -510,6 +613,11 @@ def get_llm_models():
     # models_for_frontend = [{'id': m, 'name': m} for m in models]
     return jsonify(models) # Or jsonify(models_for_frontend)
 
+@main_bp.route('/embedding_model_cache', methods=['GET'])
+def embedding_model_cache_status():
+    # 当前进程已加载的嵌入模型、占用内存、加载耗时和命中次数
+    return jsonify(get_embedding_model_cache().stats())
+
 @main_bp.route('/get_prompts', methods=['GET'])
 def get_prompts():
     try:
@@ -533,6 +641,8 @@ def test_ai_model_connection(): # Renamed for clarity
 
     if not api_url or not model_name:
         return jsonify({'success': False, 'message': 'API URL 和模型名称不能为空'}), 400
+    # 填写了多个副本地址时只测试第一个
+    api_url = (normalize_endpoint_urls(api_url) or [api_url])[0]
 
     headers = {'Content-Type': 'application/json'}
     if api_key:
@@ -586,7 +696,8 @@ def test_ai_model_connection(): # Renamed for clarity
         test_request_url = urlunparse(parsed_url._replace(path=final_path_str, query=''))
 
     try:
-        response = requests.post(test_request_url, headers=headers, json=payload, timeout=10)
+        # 使用进程内共享的连接池，重复测试同一端点时复用已建立的连接
+        response = get_http_session().post(test_request_url, headers=headers, json=payload, timeout=10)
         if response.status_code == 200:
             # Further check if response is valid JSON and indicates success
             try:
@@ -0,0 +1,205 @@
+"""
+本地 OpenAI 兼容模拟服务：实现 /v1/chat/completions（流式与非流式）和 /v1/models，
+用于在不依赖真实模型服务的情况下测量评测流水线自身的开销。
+
+用法：
+    python benchmarks/mock_openai_server.py --port 18080 --ttft 0.2 --token-rate 50 --output-tokens 40 --error-rate 0.01
+
+然后在页面或基准脚本中把模型 URL 填为 http://127.0.0.1:18080/v1，API Key 和模型名称任意。
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class MockServerConfig:
+    """
+    模拟服务的行为参数，运行中可直接修改属性。
+
+    - ttft: 首token延迟（秒）
+    - token_rate: 每秒输出token数，0 表示不限速
+    - output_tokens: 每次回复的正文token（块）数
+    - reasoning_chunks: 正文之前输出的 reasoning_content 块数
+    - error_rate: 请求失败的概率，失败时随机返回 429（带 Retry-After）或 500
+    - error_status: 失败时固定返回的状态码（可选），如 500 用于模拟持续故障的副本
+    - retry_after: 429 响应中的 Retry-After 秒数
+    - responder: 可选的函数 responder(全部消息内容，按顺序以换行连接) -> 回复正文，用于模拟评测模型的分数输出
+    """
+
+    def __init__(self, ttft=0.2, token_rate=50.0, output_tokens=40, reasoning_chunks=0, error_rate=0.0,
+                 retry_after=0.5, responder=None, seed=None, error_status=None):
+        self.ttft = ttft
+        self.token_rate = token_rate
+        self.output_tokens = output_tokens
+        self.reasoning_chunks = reasoning_chunks
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.error_status = error_status
+        self.responder = responder
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.error_count = 0
+
+    def stats(self):
+        with self.lock:
+            return {'requests': self.request_count, 'errors': self.error_count}
+
+
+class MockHTTPServer(ThreadingHTTPServer):
+    # 默认的监听队列只有5个，高并发基准下会出现连接被重置
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def _default_reply_tokens(user_message, output_tokens):
+    # 回复与问题相关，便于 ROUGE / F1 等指标产生非零结果
+    head = f"关于{str(user_message)[:20]}的回答："
+    return [head] + [f"第{i}段内容。" for i in range(max(0, output_tokens - 1))]
+
+
+def make_handler(config):
+    class MockOpenAIHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status_code, payload, headers=None):
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status_code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for header_name, header_value in (headers or {}).items():
+                self.send_header(header_name, header_value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _write_chunk(self, data):
+            encoded = data.encode('utf-8')
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(encoded), encoded))
+            self.wfile.flush()
+
+        def _write_event(self, payload):
+            self._write_chunk('data: ' + json.dumps(payload, ensure_ascii=False) + '\n\n')
+
+        def do_GET(self):
+            if self.path.rstrip('/').endswith('/models'):
+                self._send_json(200, {'object': 'list', 'data': [{'id': 'mock-model', 'object': 'model', 'owned_by': 'mock'}]})
+            else:
+                self._send_json(404, {'error': {'message': 'not found'}})
+
+        def do_POST(self):
+            if not self.path.rstrip('/').endswith('/chat/completions'):
+                self._send_json(404, {'error': {'message': 'not found'}})
+                return
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            messages = body.get('messages') or [{'content': ''}]
+            user_message = messages[-1].get('content', '')
+            model_name = body.get('model', 'mock-model')
+
+            with config.lock:
+                config.request_count += 1
+                failed = config.error_rate > 0 and config.random.random() < config.error_rate
+                if failed:
+                    config.error_count += 1
+                    error_status = config.error_status or (429 if config.random.random() < 0.5 else 500)
+            if failed:
+                if error_status == 429:
+                    self._send_json(429, {'error': {'message': 'rate limited (mock)'}}, {'Retry-After': str(config.retry_after)})
+                else:
+                    self._send_json(error_status, {'error': {'message': 'internal error (mock)'}})
+                return
+
+            if config.responder:
+                conversation_text = '\n'.join(str(message.get('content', '')) for message in messages)
+                reply_tokens = [config.responder(conversation_text)]
+            else:
+                reply_tokens = _default_reply_tokens(user_message, config.output_tokens)
+            max_tokens = body.get('max_tokens')
+            if max_tokens:
+                reply_tokens = reply_tokens[:max(1, int(max_tokens))]
+            token_interval = 1.0 / config.token_rate if config.token_rate else 0.0
+            usage = {'prompt_tokens': len(str(user_message)), 'completion_tokens': len(reply_tokens) + config.reasoning_chunks,
+                     'total_tokens': len(str(user_message)) + len(reply_tokens) + config.reasoning_chunks}
+            chunk_base = {'id': 'chatcmpl-mock', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model_name}
+
+            if not body.get('stream'):
+                time.sleep(config.ttft + token_interval * (len(reply_tokens) + config.reasoning_chunks))
+                message = {'role': 'assistant', 'content': ''.join(reply_tokens)}
+                if config.reasoning_chunks:
+                    message['reasoning_content'] = '思考。' * config.reasoning_chunks
+                self._send_json(200, {'id': 'chatcmpl-mock', 'object': 'chat.completion', 'created': int(time.time()), 'model': model_name,
+                                      'choices': [{'index': 0, 'finish_reason': 'stop', 'message': message}], 'usage': usage})
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            try:
+                time.sleep(config.ttft)
+                for _ in range(config.reasoning_chunks):
+                    self._write_event(dict(chunk_base, choices=[{'index': 0, 'delta': {'reasoning_content': '思考。'}, 'finish_reason': None}]))
+                    time.sleep(token_interval)
+                for token_index, token in enumerate(reply_tokens):
+                    if token_index:
+                        time.sleep(token_interval)
+                    self._write_event(dict(chunk_base, choices=[{'index': 0, 'delta': {'content': token}, 'finish_reason': None}]))
+                self._write_event(dict(chunk_base, choices=[{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]))
+                self._write_event(dict(chunk_base, choices=[], usage=usage))
+                self._write_chunk('data: [DONE]\n\n')
+                self.wfile.write(b'0\r\n\r\n')
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                # 客户端提前关闭了流
+                pass
+
+    return MockOpenAIHandler
+
+
+def start_mock_server(config=None, host='127.0.0.1', port=0):
+    """
+    在后台线程中启动模拟服务。
+
+    :param config: MockServerConfig，默认使用默认参数
+    :param host: 监听地址
+    :param port: 监听端口，0 表示自动分配
+    :return: (server, base_url)，调用 server.shutdown() 停止服务
+    """
+    config = config or MockServerConfig()
+    server = MockHTTPServer((host, port), make_handler(config))
+    server.config = config
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地 OpenAI 兼容模拟服务')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--ttft', type=float, default=0.2, help='首token延迟（秒）')
+    parser.add_argument('--token-rate', type=float, default=50.0, help='每秒输出token数，0 表示不限速')
+    parser.add_argument('--output-tokens', type=int, default=40, help='每次回复的正文token数')
+    parser.add_argument('--reasoning-chunks', type=int, default=0, help='正文前的 reasoning_content 块数')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='请求失败概率（429/500 各半）')
+    parser.add_argument('--error-status', type=int, default=None, help='失败时固定返回的状态码')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    config = MockServerConfig(ttft=args.ttft, token_rate=args.token_rate, output_tokens=args.output_tokens,
+                              reasoning_chunks=args.reasoning_chunks, error_rate=args.error_rate, seed=args.seed,
+                              error_status=args.error_status)
+    server = MockHTTPServer((args.host, args.port), make_handler(config))
+    print(f"模拟服务已启动: http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"模拟服务已停止，请求统计: {config.stats()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""
+评测流水线端到端基准：启动本地模拟服务（mock_openai_server），分别驱动
+process_and_evaluate_excel（功能1）和 process_evaluation_task_background（功能4），
+按行数报告各阶段耗时和每秒处理行数。模拟服务的延迟是固定可控的，因此结果反映的是流水线自身的开销。
+
+用法（在项目根目录下）：
+    python benchmarks/pipeline_benchmark.py --rows 100 1000 10000 --concurrency 32
+    python benchmarks/pipeline_benchmark.py --rows 1000 --pipeline function1 --metrics rouge1 rouge2 rougel f1_chinese
+
+注意：基准使用临时目录中的响应缓存、断点和运行记录，不会读取或写入 instance/ 下的缓存、断点和历史文件。
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+# 响应缓存与断点放到临时目录，必须在导入流水线模块之前设置
+BENCHMARK_WORK_DIR = tempfile.mkdtemp(prefix='pipeline_benchmark_')
+os.environ['LLM_RESPONSE_CACHE_PATH'] = os.path.join(BENCHMARK_WORK_DIR, 'llm_response_cache.sqlite3')
+os.environ['LLM_RUN_HISTORY_PATH'] = os.path.join(BENCHMARK_WORK_DIR, 'run_history.jsonl')
+os.environ['LLM_CHECKPOINT_DIR'] = os.path.join(BENCHMARK_WORK_DIR, 'checkpoints')
+os.environ['EMBEDDING_CACHE_DIR'] = os.path.join(BENCHMARK_WORK_DIR, 'embedding_cache')
+
+import pandas as pd
+
+from benchmarks.mock_openai_server import MockServerConfig, start_mock_server
+
+
+def _make_questions_excel(rows, output_dir):
+    questions = [f"第{i}个问题：请简要介绍编号为{i}的主题，并说明其主要特点。" for i in range(rows)]
+    questions_excel_path = os.path.join(output_dir, f'benchmark_questions_{rows}.xlsx')
+    pd.DataFrame({'Questions': questions}).to_excel(questions_excel_path, index=False)
+    return questions_excel_path
+
+def _make_judge_excel(rows, output_dir):
+    questions_excel_path = os.path.join(output_dir, f'benchmark_judge_{rows}_{uuid.uuid4().hex[:8]}.xlsx')
+    pd.DataFrame({
+        '问题': [f"第{i}个问题：请简要介绍编号为{i}的主题。" for i in range(rows)],
+        '回答': [f"编号为{i}的主题是一个示例主题，它的主要特点是结构清晰、内容完整。" for i in range(rows)],
+    }).to_excel(questions_excel_path, index=False)
+    return questions_excel_path
+
+def _judge_responder(conversation_text):
+    # 合并评测请求要求输出JSON，其余按单项模板输出 "N分"
+    if '【' in conversation_text:
+        names = [segment.split('】')[0] for segment in conversation_text.split('【')[1:]]
+        return json.dumps({name: 4 for name in names}, ensure_ascii=False)
+    return '4分'
+
+def _format_row(result):
+    stage_text = ', '.join(f"{stage}={seconds:.2f}s" for stage, seconds in result['stage_times'].items())
+    return (f"{result['pipeline']:<10} rows={result['rows']:<6} total={result['total_seconds']:.2f}s "
+            f"rows/s={result['rows_per_second']:.1f}  [{stage_text}]")
+
+
+def bench_function1(rows, base_url, concurrency, metrics, get_first_token=True):
+    """驱动 process_and_evaluate_excel，返回各阶段耗时。"""
+    from ZhiBiao.achieve import process_and_evaluate_excel
+
+    output_dir = os.path.join(BENCHMARK_WORK_DIR, 'function1')
+    os.makedirs(output_dir, exist_ok=True)
+    questions_excel_path = _make_questions_excel(rows, output_dir)
+    model_config = lambda name: {'key': 'mock-key', 'url': base_url, 'name': name, 'get_first_token': get_first_token,
+                                 'concurrency': concurrency, 'use_cache': False}
+    run_summary = {}
+    start_time = time.perf_counter()
+    # 每次运行使用新的提示词，避免命中上一轮留下的断点
+    output_path = process_and_evaluate_excel(questions_excel_path, output_dir, f'基准测试 {uuid.uuid4().hex[:8]}',
+                                             model_config('mock-external'), model_config('mock-internal'),
+                                             metrics, run_summary=run_summary)
+    total_seconds = time.perf_counter() - start_time
+    if not output_path:
+        raise RuntimeError('process_and_evaluate_excel 返回 None')
+    return {'pipeline': 'function1', 'rows': rows, 'total_seconds': total_seconds,
+            'rows_per_second': rows / total_seconds if total_seconds else 0.0,
+            'stage_times': dict(run_summary.get('stage_times', {}))}
+
+
+def bench_function4(rows, base_url, concurrency, combined=False):
+    """驱动 process_evaluation_task_background（使用全部评测模板），返回各阶段耗时。"""
+    from app import create_app
+    from app.routes import process_evaluation_task_background, tasks_status
+    from TQ.tools import load_prompts
+
+    app = create_app()
+    output_dir = os.path.join(BENCHMARK_WORK_DIR, 'function4')
+    os.makedirs(output_dir, exist_ok=True)
+    task_id = str(uuid.uuid4())
+    tasks_status[task_id] = {'status': 'submitted', 'progress': 0, 'task_id': task_id}
+    params = {
+        'input_excel_path': _make_judge_excel(rows, output_dir),
+        'model_key': 'mock-key',
+        'model_url': base_url,
+        'model_name': 'mock-judge',
+        'model_concurrency': concurrency,
+        'use_cache': False,
+        'combined_judge': combined,
+        'selected_prompt_names': [p['name'] for p in load_prompts('PromptTemplate.json')],
+    }
+    start_time = time.perf_counter()
+    process_evaluation_task_background(app, task_id, params)
+    total_seconds = time.perf_counter() - start_time
+    task_status = tasks_status.pop(task_id)
+    if task_status.get('status') != 'completed':
+        raise RuntimeError(f"process_evaluation_task_background 失败: {task_status.get('message')}")
+    return {'pipeline': 'function4' + ('-combined' if combined else ''), 'rows': rows, 'total_seconds': total_seconds,
+            'rows_per_second': rows / total_seconds if total_seconds else 0.0,
+            'stage_times': dict(task_status.get('stage_times', {}))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='评测流水线端到端基准')
+    parser.add_argument('--rows', type=int, nargs='+', default=[100, 1000, 10000], help='测试的行数，可指定多个')
+    parser.add_argument('--pipeline', choices=['function1', 'function4', 'all'], default='all')
+    parser.add_argument('--concurrency', type=int, default=32, help='每个模型的并发请求数')
+    parser.add_argument('--metrics', nargs='*', default=['rouge1', 'f1_chinese'], help='功能1计算的指标')
+    parser.add_argument('--combined-judge', action='store_true', help='功能4使用合并评测模式')
+    parser.add_argument('--ttft', type=float, default=0.05, help='模拟服务首token延迟（秒）')
+    parser.add_argument('--token-rate', type=float, default=400.0, help='模拟服务每秒输出token数')
+    parser.add_argument('--output-tokens', type=int, default=20, help='模拟服务每次回复的token数')
+    parser.add_argument('--reasoning-chunks', type=int, default=0, help='模拟服务每次回复前的推理块数')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='模拟服务请求失败概率')
+    parser.add_argument('--output-json', help='把结果另存为JSON文件')
+    args = parser.parse_args()
+
+    config = MockServerConfig(ttft=args.ttft, token_rate=args.token_rate, output_tokens=args.output_tokens,
+                              reasoning_chunks=args.reasoning_chunks, error_rate=args.error_rate, seed=0)
+    server, base_url = start_mock_server(config)
+    print(f"模拟服务: {base_url}，工作目录: {BENCHMARK_WORK_DIR}")
+
+    results = []
+    try:
+        for rows in args.rows:
+            if args.pipeline in ('function1', 'all'):
+                config.responder = None
+                results.append(bench_function1(rows, base_url, args.concurrency, args.metrics))
+                print(_format_row(results[-1]))
+            if args.pipeline in ('function4', 'all'):
+                config.responder = _judge_responder
+                results.append(bench_function4(rows, base_url, args.concurrency, args.combined_judge))
+                print(_format_row(results[-1]))
+    finally:
+        server.shutdown()
+
+    print('\n===== 基准结果 =====')
+    for result in results:
+        print(_format_row(result))
+    print(f"模拟服务请求统计: {config.stats()}")
+    if args.output_json:
+        with open(args.output_json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 from app import create_app
 
-app = create_app()
-
 if __name__ == '__main__':
+    # 只在直接运行时创建应用：分词子进程以 spawn 方式启动时会重新导入本模块，不应在子进程里再创建一次应用
+    app = create_app()
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,34 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+# 响应缓存、断点、运行记录和向量缓存放到临时目录，必须在导入流水线模块之前设置
+TEST_WORK_DIR = tempfile.mkdtemp(prefix='ceping_tests_')
+os.environ['LLM_RESPONSE_CACHE_PATH'] = os.path.join(TEST_WORK_DIR, 'llm_response_cache.sqlite3')
+os.environ['LLM_RUN_HISTORY_PATH'] = os.path.join(TEST_WORK_DIR, 'run_history.jsonl')
+os.environ['LLM_CHECKPOINT_DIR'] = os.path.join(TEST_WORK_DIR, 'checkpoints')
+os.environ['EMBEDDING_CACHE_DIR'] = os.path.join(TEST_WORK_DIR, 'embedding_cache')
+
+
+@pytest.fixture
+def mock_server():
+    """启动本地模拟服务（benchmarks/mock_openai_server），返回启动函数 start(**MockServerConfig参数) -> (server, base_url)。"""
+    from benchmarks.mock_openai_server import MockServerConfig, start_mock_server
+
+    servers = []
+
+    def start(**config_kwargs):
+        server, base_url = start_mock_server(MockServerConfig(**config_kwargs))
+        servers.append(server)
+        return server, base_url
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,32 @@
+import os
+
+from ZhiBiao.checkpoint import RowCheckpoint, make_checkpoint_path
+
+
+def test_completed_rows_are_loaded_after_reopening(tmp_path):
+    path = str(tmp_path / 'sub' / 'task.jsonl')
+    checkpoint = RowCheckpoint(path)
+    assert checkpoint.load() == {}
+    checkpoint.record(0, response='回答0', first_token=0.5)
+    checkpoint.record(2, response='回答2', first_token=None)
+    # 进程在写入中途退出时留下的不完整行
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('{"row": 3, "respo')
+
+    assert RowCheckpoint(path).load() == {0: {'response': '回答0', 'first_token': 0.5},
+                                          2: {'response': '回答2', 'first_token': None}}
+    checkpoint.remove()
+    assert not os.path.exists(path)
+    assert checkpoint.load() == {}
+
+
+def test_checkpoint_path_depends_on_questions_and_config(tmp_path):
+    checkpoint_dir = str(tmp_path)
+    path = make_checkpoint_path(['问题1', '问题2'], 'model', 'http://host/v1/', 'prompt', 'external', checkpoint_dir)
+    assert path == make_checkpoint_path(['问题1', '问题2'], 'model', 'http://host/v1', 'prompt', 'external', checkpoint_dir)
+    assert path == make_checkpoint_path(['问题1', '问题2'], 'model', 'http://host/v1', 'prompt', 'external', checkpoint_dir,
+                                        sampling_params={})
+    assert path != make_checkpoint_path(['问题2', '问题1'], 'model', 'http://host/v1', 'prompt', 'external', checkpoint_dir)
+    assert path != make_checkpoint_path(['问题1', '问题2'], 'model', 'http://host/v1', 'prompt', 'internal', checkpoint_dir)
+    assert path != make_checkpoint_path(['问题1', '问题2'], 'model', 'http://host/v1', 'prompt', 'external', checkpoint_dir,
+                                        sampling_params={'enable_thinking': False})
@@ -0,0 +1,55 @@
+import random
+
+from ZhiBiao.cilin_index import CilinIndex, compile_cilin_index, parse_cilin
+
+CILIN_LINES = [
+    'Aa01A01= 人 士 人物',
+    'Aa01A02= 人类 全人类',
+    'Ab02B01= 男人 汉子 人',
+    'Ba01A01= 物 东西',
+    'Ba01B01# 物体 物件',
+    'Ca01A01@ 时间',
+    'Ca02A01= 时候 时刻 时间',
+    'Da01A01= 好 优秀',
+    'Db02C01= 坏 恶劣 差',
+    '格式错误的一行',
+]
+
+
+def _naive_expand(tokens, word_to_codes, prefix_words):
+    """按原始定义展开：词本身 + 同一行的同义词 + 各编码在 1、2、4、5 位前缀下的全部词。"""
+    expanded = set()
+    for token in tokens:
+        expanded.add(token)
+        for code in word_to_codes.get(token, ()):
+            for length in (1, 2, 4, 5, len(code)):
+                expanded |= prefix_words.get(code[:length], set())
+    return expanded
+
+
+def test_expansion_sizes_match_naive_sets(tmp_path):
+    cilin_path = tmp_path / 'cilin.txt'
+    cilin_path.write_text('\n'.join(CILIN_LINES) + '\n', encoding='utf-8')
+    index = CilinIndex(compile_cilin_index(str(cilin_path), str(tmp_path / 'cilin.idx')))
+
+    word_to_codes, processed_lines, malformed_lines = parse_cilin(str(cilin_path))
+    assert (processed_lines, malformed_lines) == (9, 1)
+    assert len(index) == len(word_to_codes)
+    prefix_words = {}
+    for word, codes in word_to_codes.items():
+        for code in codes:
+            for length in (1, 2, 4, 5, len(code)):
+                prefix_words.setdefault(code[:length], set()).add(word)
+
+    vocabulary = sorted(word_to_codes) + ['苹果', '跑步', '的']
+    rng = random.Random(0)
+    for _ in range(200):
+        tokens_1 = [rng.choice(vocabulary) for _ in range(rng.randint(0, 6))]
+        tokens_2 = [rng.choice(vocabulary) for _ in range(rng.randint(0, 6))]
+        expected_1 = _naive_expand(tokens_1, word_to_codes, prefix_words)
+        expected_2 = _naive_expand(tokens_2, word_to_codes, prefix_words)
+        expansion_1 = index.expand(tokens_1)
+        expansion_2 = index.expand(tokens_2)
+        assert index.expanded_size(expansion_1) == len(expected_1)
+        assert index.expanded_size(expansion_2) == len(expected_2)
+        assert index.intersection_size(expansion_1, expansion_2) == len(expected_1 & expected_2)
@@ -0,0 +1,64 @@
+import pytest
+
+from ZhiBiao.endpoint_pool import EndpointPool, call_with_replicas
+
+
+class _StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+def test_acquire_prefers_replicas_not_excluded():
+    pool = EndpointPool(['http://a', 'http://b'])
+    assert pool.acquire(exclude={'http://a'}) == 'http://b'
+    # 没有其他可用副本时仍然可以选中被排除的副本
+    assert EndpointPool(['http://a']).acquire(exclude={'http://a'}) == 'http://a'
+
+
+def test_server_errors_are_retried_on_another_replica():
+    pool = EndpointPool(['http://bad', 'http://good'])
+    calls = []
+
+    def request_func(replica_url, max_retries):
+        calls.append((replica_url, max_retries))
+        if replica_url == 'http://bad':
+            raise _StatusError(500)
+        return 'ok'
+
+    for _ in range(3):
+        assert call_with_replicas(pool, request_func) == 'ok'
+    stats = pool.stats()
+    # 每次 500 都计入副本池，连续 3 次后坏副本被剔除；多副本时每个副本只尝试一次
+    assert stats['http://bad']['failures'] == 3
+    assert stats['http://bad']['ejections'] == 1
+    assert all(max_retries == 0 for _, max_retries in calls)
+    assert call_with_replicas(pool, request_func) == 'ok'
+    assert calls[-1][0] == 'http://good'
+
+
+def test_single_replica_retries_inside_request_func():
+    pool = EndpointPool(['http://only'])
+    calls = []
+
+    def request_func(replica_url, max_retries):
+        calls.append(max_retries)
+        raise _StatusError(503)
+
+    with pytest.raises(_StatusError):
+        call_with_replicas(pool, request_func, max_retries=4)
+    assert calls == [4]
+
+
+def test_client_errors_are_not_rerouted():
+    pool = EndpointPool(['http://a', 'http://b'])
+    calls = []
+
+    def request_func(replica_url, max_retries):
+        calls.append(replica_url)
+        raise _StatusError(400)
+
+    with pytest.raises(_StatusError):
+        call_with_replicas(pool, request_func)
+    assert len(calls) == 1
+    assert pool.stats()[calls[0]]['failures'] == 0
@@ -0,0 +1,14 @@
+from ZhiBiao.llm_client import DEFAULT_MAX_CONNECTIONS, get_openai_client
+
+
+def test_client_is_shared_and_grows_with_requested_connections():
+    url = 'http://127.0.0.1:9/v1'
+    client = get_openai_client(url, 'key-a')
+    assert get_openai_client(url + '/', 'key-a') is client
+    assert get_openai_client(url, 'key-a', max_connections=4) is client
+    assert get_openai_client(url, 'key-b') is not client
+
+    larger = get_openai_client(url, 'key-a', max_connections=DEFAULT_MAX_CONNECTIONS * 2)
+    assert larger is not client
+    # 之后请求更小的上限时继续使用连接池更大的客户端
+    assert get_openai_client(url, 'key-a', max_connections=1) is larger
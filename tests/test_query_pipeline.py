@@ -0,0 +1,90 @@
+"""
+query_ai_model_with_excel 对本地模拟服务（benchmarks/mock_openai_server）的端到端测试。
+ZhiBiao.achieve 在导入时需要 sentence_transformers 和 modelscope，未安装时跳过。
+"""
+import re
+import threading
+import time
+import uuid
+
+import pytest
+
+pytest.importorskip('sentence_transformers')
+pytest.importorskip('modelscope')
+
+import pandas as pd
+
+from ZhiBiao.achieve import query_ai_model_with_excel
+from ZhiBiao.checkpoint import RowCheckpoint
+
+
+def _questions(rows):
+    return pd.DataFrame({'Questions': [f"第{i}个问题：请介绍编号为{i}的主题。" for i in range(rows)]})
+
+
+def test_failing_replica_is_ejected_and_all_rows_succeed(mock_server):
+    _, bad_url = mock_server(ttft=0.0, token_rate=0, output_tokens=3, error_rate=1.0, error_status=500)
+    _, good_url = mock_server(ttft=0.01, token_rate=0, output_tokens=3)
+    run_stats = {}
+    df_output = query_ai_model_with_excel(_questions(20), 'Questions', 'Mock_Response', 'Mock_First_Token', 'mock-key',
+                                          f"{bad_url},{good_url}", f"mock-{uuid.uuid4().hex[:8]}", True,
+                                          concurrency=4, use_cache=False, run_stats=run_stats)
+    assert df_output['Mock_Response'].notna().all()
+    assert run_stats['failed_rows'] == 0
+    assert run_stats['endpoints'][bad_url]['ejections'] >= 1
+    assert run_stats['endpoints'][good_url]['failures'] == 0
+
+
+def test_concurrent_output_matches_serial(mock_server):
+    _, base_url = mock_server(ttft=0.0, token_rate=0, output_tokens=8)
+    df_input = _questions(40)
+    outputs = [query_ai_model_with_excel(df_input, 'Questions', 'Mock_Response', 'Mock_First_Token', 'mock-key', base_url,
+                                         f"mock-{uuid.uuid4().hex[:8]}", False, concurrency=concurrency, use_cache=False)
+               for concurrency in (1, 8)]
+    assert outputs[0]['Mock_Response'].notna().all()
+    assert outputs[0]['Mock_Response'].tolist() == outputs[1]['Mock_Response'].tolist()
+
+
+def _tracking_responder():
+    """返回模拟服务的 responder 和记录在途请求数的列表 [当前在途请求数, 最大在途请求数]。"""
+    in_flight = [0, 0]
+    lock = threading.Lock()
+
+    def responder(conversation_text):
+        row_index = int(re.search(r'第(\d+)个问题', conversation_text).group(1))
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight[1], in_flight[0])
+        # 前 20 行积累延迟样本，之后每 5 行有一行明显变慢，触发对冲请求
+        time.sleep(0.3 if row_index >= 20 and row_index % 5 == 0 else 0.01)
+        with lock:
+            in_flight[0] -= 1
+        return f"回答{row_index}"
+
+    return responder, in_flight
+
+
+def test_serial_mode_counts_hedges_against_concurrency(mock_server):
+    responder, in_flight = _tracking_responder()
+    _, base_url = mock_server(ttft=0.0, token_rate=0, responder=responder)
+    df_output = query_ai_model_with_excel(_questions(30), 'Questions', 'Mock_Response', 'Mock_First_Token', 'mock-key', base_url,
+                                          f"mock-{uuid.uuid4().hex[:8]}", False, concurrency=1, use_cache=False, hedge=True)
+    assert df_output['Mock_Response'].tolist() == [f"回答{i}" for i in range(30)]
+    assert in_flight[1] == 1
+
+
+def test_resume_requests_only_rows_missing_from_checkpoint(mock_server, tmp_path):
+    server, base_url = mock_server(ttft=0.0, token_rate=0, output_tokens=3)
+    checkpoint_path = str(tmp_path / 'resume.jsonl')
+    checkpoint = RowCheckpoint(checkpoint_path)
+    for row_index in range(0, 10, 2):
+        checkpoint.record(row_index, response=f"断点中的回答{row_index}", total_latency=1.0)
+
+    df_output = query_ai_model_with_excel(_questions(10), 'Questions', 'Mock_Response', 'Mock_First_Token', 'mock-key', base_url,
+                                          f"mock-{uuid.uuid4().hex[:8]}", False, concurrency=2, use_cache=False,
+                                          checkpoint_path=checkpoint_path)
+    responses = df_output['Mock_Response'].tolist()
+    assert server.config.stats()['requests'] == 5
+    assert [responses[i] for i in range(0, 10, 2)] == [f"断点中的回答{i}" for i in range(0, 10, 2)]
+    assert all(responses[i] and not responses[i].startswith('断点') for i in range(1, 10, 2))
+    assert sorted(RowCheckpoint(checkpoint_path).load()) == list(range(10))
@@ -0,0 +1,32 @@
+import itertools
+import types
+
+from ZhiBiao import response_cache
+from ZhiBiao.response_cache import ResponseCache
+
+
+def test_evicts_least_recently_accessed_entries(tmp_path, monkeypatch):
+    # 用递增的假时钟代替 time.time()，保证每次访问的时间戳各不相同
+    clock = itertools.count(1)
+    monkeypatch.setattr(response_cache, 'time', types.SimpleNamespace(time=lambda: float(next(clock))))
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite3'), max_entries=10)
+    for i in range(10):
+        cache.set(f'k{i}', f'response {i}', first_token=0.1, profile={'total_latency': 1.0})
+    assert cache.get('k0')['response'] == 'response 0'  # k0 变为最近访问
+
+    cache.set('k10', 'response 10')  # 超过上限，淘汰到上限的 90%
+    assert cache.stats()['entries'] == 9
+    assert cache.get('k1') is None
+    assert cache.get('k2') is None
+    for key in ['k0'] + [f'k{i}' for i in range(3, 11)]:
+        assert cache.get(key) is not None
+    assert cache.get('k0') == {'response': 'response 0', 'first_token': 0.1, 'profile': {'total_latency': 1.0}}
+
+
+def test_overwriting_an_entry_does_not_count_twice(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite3'), max_entries=3)
+    for _ in range(5):
+        cache.set('same', 'response')
+    assert cache.stats()['entries'] == 1
+    # 重新打开时从文件统计条目数
+    assert ResponseCache(str(tmp_path / 'cache.sqlite3'), max_entries=3).get('same')['response'] == 'response'
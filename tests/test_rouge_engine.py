@@ -0,0 +1,57 @@
+import random
+
+import pytest
+
+from ZhiBiao.rouge_engine import lcs_length, rouge_scores
+
+
+def _lcs_reference(tokens_a, tokens_b):
+    """朴素的动态规划，作为按位并行实现的对照。"""
+    previous = [0] * (len(tokens_b) + 1)
+    for token_a in tokens_a:
+        current = [0]
+        for j, token_b in enumerate(tokens_b):
+            current.append(previous[j] + 1 if token_a == token_b else max(previous[j + 1], current[j]))
+        previous = current
+    return previous[-1]
+
+
+def test_lcs_length_matches_dynamic_programming():
+    rng = random.Random(0)
+    vocabulary = ['我', '们', '模型', '评估', '的', '结果', '。']
+    for _ in range(300):
+        tokens_a = [rng.choice(vocabulary) for _ in range(rng.randint(0, 90))]
+        tokens_b = [rng.choice(vocabulary) for _ in range(rng.randint(0, 90))]
+        assert lcs_length(tokens_a, tokens_b) == _lcs_reference(tokens_a, tokens_b)
+
+
+def test_lcs_length_empty_input():
+    assert lcs_length([], ['a']) == 0
+    assert lcs_length(['a'], []) == 0
+
+
+def test_rouge_scores_known_values():
+    reference = ['今天', '天气', '很', '好']
+    hypothesis = ['今天', '天气', '不', '好']
+    scores = rouge_scores(reference, hypothesis)
+    assert scores['ROUGE-1'] == pytest.approx(0.75)
+    assert scores['ROUGE-2'] == pytest.approx(1 / 3)
+    assert scores['ROUGE-L'] == pytest.approx(0.75)
+
+
+def test_rouge_n_clips_repeated_ngrams():
+    # 参考答案中 “好” 只出现一次，生成答案重复多次也只算一次重叠
+    scores = rouge_scores(['好', '的'], ['好', '好', '好', '好'], variants=('ROUGE-1',))
+    precision, recall = 1 / 4, 1 / 2
+    assert scores['ROUGE-1'] == pytest.approx(2 * precision * recall / (precision + recall))
+
+
+def test_rouge_scores_identical_and_disjoint():
+    tokens = ['一', '二', '三']
+    assert rouge_scores(tokens, tokens) == {'ROUGE-1': 1.0, 'ROUGE-2': 1.0, 'ROUGE-L': 1.0}
+    assert rouge_scores(tokens, ['四', '五']) == {'ROUGE-1': 0.0, 'ROUGE-2': 0.0, 'ROUGE-L': 0.0}
+
+
+def test_rouge_scores_rejects_unknown_variant():
+    with pytest.raises(ValueError):
+        rouge_scores(['a'], ['a'], variants=('ROUGE-3',))
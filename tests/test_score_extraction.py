@@ -0,0 +1,47 @@
+import pytest
+
+from TQ.tools import _prompt_query_score_stream, extract_complete_score, parse_combined_scores
+from ZhiBiao.llm_client import get_openai_client
+
+
+@pytest.mark.parametrize('response_text, expected', [
+    ('得分：4分', '4分'),
+    ('评分：3.5 分', '3.5分'),
+    ('分数为5分', '5分'),
+    ('我的打分是 2分。理由如下', '2分'),
+    # 评分标准中的范围、满分和 "4/5" 形式都不是明确的分数
+    ('评分范围1-5分，', None),
+    ('1~5分', None),
+    ('满分5分', None),
+    ('4/5分', None),
+    ('得分：4/5分', None),
+    # 复述评分标准时，最前面的 "1分：..." 不能当作结果，要等到后面带标记的分数
+    ('1分：生成的内容信息缺失严重或为空，导致无法理解', None),
+    ('1分：生成的内容信息缺失严重或为空，导致无法理解\n2分：生成的内容有80%的信息缺失\n最终得分：4分', '4分'),
+    # 没有标记的单独分数不提前结束，由流结束后返回完整回复
+    ('4分', None),
+    # 分数还没输出完整
+    ('得分：4', None),
+    ('得分：4.', None),
+])
+def test_extract_complete_score(response_text, expected):
+    assert extract_complete_score(response_text) == expected
+
+
+def test_extract_complete_score_combined_waits_for_all_criteria():
+    names = ['完整度', '有效性']
+    assert extract_complete_score('{"完整度": 4, "有效性"', names) is None
+    assert extract_complete_score('{"完整度": 4, "有效性": 5}', names) == '{"完整度": 4, "有效性": 5}'
+    assert parse_combined_scores('{"完整度": 4, "有效性": 5}', names) == {'完整度': '4分', '有效性': '5分'}
+
+
+@pytest.mark.parametrize('reply, expected', [
+    ('4分', '4分'),
+    ('1分：生成的内容信息缺失严重或为空\n5分：生成的内容全部有用\n得分：4分', '4分'),
+    # 只复述评分标准、没有明确分数的回复原样返回，不截断为第一个 "N分"
+    ('1分：生成的内容信息缺失严重或为空', '1分：生成的内容信息缺失严重或为空'),
+])
+def test_score_stream_returns_marked_score_or_full_reply(mock_server, reply, expected):
+    _, base_url = mock_server(ttft=0.0, token_rate=0, responder=lambda conversation_text: reply)
+    client = get_openai_client(base_url, 'mock-key')
+    assert _prompt_query_score_stream(client, 'mock-judge', '问：text1\n答：text2') == expected